@@ -0,0 +1,19 @@
+"""偽サーバーが受けたリクエスト数と通信量の集計"""
+import threading
+
+def new_counters():
+    return {'requests': 0, 'sub_requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'lock': threading.Lock()}
+
+def add(counters, **values):
+    """集計値を増やす (requests / sub_requests / bytes_in / bytes_out)"""
+    with counters['lock']:
+        for key, value in values.items():
+            counters[key] += value
+
+def take(counters):
+    """現在の集計値を返し、0に戻す"""
+    with counters['lock']:
+        snapshot = {key: value for key, value in counters.items() if key != 'lock'}
+        for key in snapshot:
+            counters[key] = 0
+    return snapshot
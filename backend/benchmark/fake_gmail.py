@@ -0,0 +1,182 @@
+"""ベンチマーク用の偽 Gmail API
+
+gmail_fetcher が呼ぶエンドポイント (profile / messages.list / messages.get /
+messages.modify / messages.batchModify / messages.trash / history.list) と、
+googleapiclient のバッチHTTP (/batch/gmail/v1, multipart/mixed) に対応する。
+"""
+import email.parser
+import json
+import re
+import uuid
+
+import counters
+import fake_http
+import synthetic
+
+LIST_PAGE_SIZE = 100      # messages.list の既定の件数 (maxResults の既定値)
+MAX_LIST_PAGE_SIZE = 500
+HISTORY_PAGE_SIZE = 500
+
+_MESSAGE_PATH_RE = re.compile(r'^/gmail/v1/users/me/messages/([^/]+)(?:/(modify|trash))?$')
+
+def _uid(message_id):
+    return int(message_id[1:])
+
+def _labels(msg):
+    labels = ['INBOX']
+    if msg['unread']:
+        labels.append('UNREAD')
+    if msg['flagged']:
+        labels.append('STARRED')
+    return labels
+
+def _message_json(msg, fmt):
+    data = {'id': msg['id'], 'threadId': msg['id'], 'labelIds': _labels(msg)}
+    if fmt == 'minimal':
+        return data
+    data.update(
+        snippet=msg['snippet'],
+        internalDate=str(int(msg['received_at'].timestamp() * 1000)),
+        sizeEstimate=len(msg['snippet']) * 4,
+        payload={'headers': [
+            {'name': 'Subject', 'value': msg['subject']},
+            {'name': 'From', 'value': f"{msg['sender_name']} <{msg['sender_address']}>"},
+        ]},
+    )
+    return data
+
+def _apply_labels(mailbox, msg, body):
+    add = body.get('addLabelIds', [])
+    remove = body.get('removeLabelIds', [])
+    if 'UNREAD' in remove:
+        msg['unread'] = False
+    if 'UNREAD' in add:
+        msg['unread'] = True
+    if 'STARRED' in add:
+        msg['flagged'] = True
+    if 'STARRED' in remove:
+        msg['flagged'] = False
+    synthetic.record_change(mailbox, msg, 'flags')
+
+def make_app(mailbox, state):
+    """偽 Gmail API のリクエスト処理関数を作る (state には 'counters' が入る)"""
+    unread_cache = {'version': None, 'ids': []}
+
+    def unread_ids():
+        # ページ送りのたびに全件を走査しないよう、メールボックスが変わるまで一覧を使い回す
+        if unread_cache['version'] != mailbox['version']:
+            messages = mailbox['messages']
+            unread_cache['ids'] = [messages[uid]['id'] for uid in reversed(mailbox['order']) if messages[uid]['unread']]
+            unread_cache['version'] = mailbox['version']
+        return unread_cache['ids']
+
+    def handle(method, path, query, headers, body):
+        if path == '/batch/gmail/v1' and method == 'POST':
+            return handle_batch(headers, body)
+        with mailbox['lock']:
+            return route(method, path, query, body)
+
+    def route(method, path, query, body):
+        if path == '/gmail/v1/users/me/profile':
+            return fake_http.json_response(200, {
+                'emailAddress': 'bench@example.com',
+                'messagesTotal': len(mailbox['order']),
+                'historyId': str(mailbox['version']),
+            })
+
+        if path == '/gmail/v1/users/me/messages' and method == 'GET':
+            ids = unread_ids() if query.get('labelIds') == 'UNREAD' else [
+                mailbox['messages'][uid]['id'] for uid in reversed(mailbox['order'])
+            ]
+            page_size = min(int(query.get('maxResults', LIST_PAGE_SIZE)), MAX_LIST_PAGE_SIZE)
+            offset = int(query.get('pageToken') or 0)
+            page = ids[offset:offset + page_size]
+            data = {'messages': [{'id': i, 'threadId': i} for i in page], 'resultSizeEstimate': len(ids)}
+            if offset + page_size < len(ids):
+                data['nextPageToken'] = str(offset + page_size)
+            return fake_http.json_response(200, data)
+
+        if path == '/gmail/v1/users/me/messages/batchModify' and method == 'POST':
+            request = json.loads(body or b'{}')
+            for message_id in request.get('ids', []):
+                msg = mailbox['messages'].get(_uid(message_id))
+                if msg is not None:
+                    _apply_labels(mailbox, msg, request)
+            return fake_http.empty_response()
+
+        if path == '/gmail/v1/users/me/history':
+            start = int(query.get('startHistoryId', 0))
+            changes = synthetic.changes_since(mailbox, start)
+            offset = int(query.get('pageToken') or 0)
+            records = []
+            for uid, kind in changes[offset:offset + HISTORY_PAGE_SIZE]:
+                msg = mailbox['messages'][uid]
+                key = 'messagesAdded' if kind == 'added' else 'labelsAdded'
+                records.append({
+                    'id': str(msg['modseq']),
+                    key: [{'message': {'id': msg['id'], 'threadId': msg['id'], 'labelIds': _labels(msg)}}],
+                })
+            data = {'historyId': str(mailbox['version'])}
+            if records:
+                data['history'] = records
+            if offset + HISTORY_PAGE_SIZE < len(changes):
+                data['nextPageToken'] = str(offset + HISTORY_PAGE_SIZE)
+            return fake_http.json_response(200, data)
+
+        match = _MESSAGE_PATH_RE.match(path)
+        if match:
+            message_id, action = match.groups()
+            msg = mailbox['messages'].get(_uid(message_id)) if message_id[1:].isdigit() else None
+            if msg is None:
+                return fake_http.json_response(404, {'error': {'code': 404, 'message': 'Not Found'}})
+            if action == 'modify':
+                _apply_labels(mailbox, msg, json.loads(body or b'{}'))
+            elif action == 'trash':
+                msg['unread'] = False
+                synthetic.record_change(mailbox, msg, 'flags')
+            return fake_http.json_response(200, _message_json(msg, query.get('format', 'full')))
+
+        return fake_http.json_response(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+
+    def handle_batch(headers, body):
+        """multipart/mixed のバッチリクエストを1件ずつ処理し、multipart/mixed で返す"""
+        content_type = headers.get('Content-Type')
+        request = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        boundary = 'batch_' + uuid.uuid4().hex
+        out = []
+        parts = request.get_payload() if request.is_multipart() else []
+        counters.add(state['counters'], sub_requests=len(parts))
+        for part in parts:
+            content_id = part['Content-ID'].strip('<>')
+            inner = part.get_payload()
+            if isinstance(inner, list):
+                inner = inner[0].as_string()
+            head, _, inner_body = inner.replace('\r\n', '\n').partition('\n\n')
+            request_line = head.split('\n', 1)[0]
+            method, url, _ = request_line.split(' ', 2)
+            path, query = fake_http.split_url(url)
+            with mailbox['lock']:
+                status, sub_type, payload = route(method, path, query, inner_body.encode('utf-8'))
+            out.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n"
+                "\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                f"Content-Type: {sub_type or 'application/json; charset=UTF-8'}\r\n"
+                "\r\n"
+                f"{payload.decode('utf-8')}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        return 200, f'multipart/mixed; boundary={boundary}', ''.join(out).encode('utf-8')
+
+    return handle
+
+def start(mailbox, latency=0.0):
+    """偽 Gmail API を起動し、サーバーの辞書 {'base_url', 'counters', 'stop'} を返す"""
+    state = {}
+    server = fake_http.start(make_app(mailbox, state), latency)
+    state['counters'] = server['counters']
+    return server
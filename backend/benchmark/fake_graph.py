@@ -0,0 +1,138 @@
+"""ベンチマーク用の偽 Microsoft Graph API
+
+outlook_fetcher が呼ぶエンドポイント (受信トレイの一覧、/me/messages の取得・更新・削除、
+受信トレイの delta、JSONバッチ /$batch) に対応する。
+"""
+import json
+import re
+
+import counters
+import fake_http
+import synthetic
+
+DEFAULT_PAGE_SIZE = 100
+
+_MESSAGE_PATH_RE = re.compile(r'^(?:/v1\.0)?/me/messages/([^/]+)$')
+_MAXPAGESIZE_RE = re.compile(r'odata\.maxpagesize=(\d+)')
+
+def _uid(message_id):
+    return int(message_id[1:]) if message_id[1:].isdigit() else None
+
+def _message_json(msg):
+    return {
+        'id': msg['id'],
+        'subject': msg['subject'],
+        'from': {'emailAddress': {'name': msg['sender_name'], 'address': msg['sender_address']}},
+        'bodyPreview': msg['snippet'],
+        'receivedDateTime': msg['received_at'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'flag': {'flagStatus': 'flagged' if msg['flagged'] else 'notFlagged'},
+        'isRead': not msg['unread'],
+    }
+
+def make_app(mailbox, state):
+    """偽 Graph API のリクエスト処理関数を作る (state には 'base_url' と 'counters' が入る)"""
+    unread_cache = {'version': None, 'ids': []}
+
+    def unread_ids():
+        if unread_cache['version'] != mailbox['version']:
+            messages = mailbox['messages']
+            unread_cache['ids'] = [messages[uid]['id'] for uid in reversed(mailbox['order']) if messages[uid]['unread']]
+            unread_cache['version'] = mailbox['version']
+        return unread_cache['ids']
+
+    def handle(method, path, query, headers, body):
+        if path == '/v1.0/$batch' and method == 'POST':
+            return handle_batch(json.loads(body or b'{}'))
+        with mailbox['lock']:
+            return route(method, path, query, headers, body)
+
+    def route(method, path, query, headers, body):
+        if path == '/v1.0/me/mailFolders/inbox/messages' and method == 'GET':
+            # 未読の一覧 ($filter isRead eq false) だけに対応する (新しい順)
+            ids = unread_ids()
+            top = int(query.get('$top', DEFAULT_PAGE_SIZE))
+            offset = int(query.get('$skip', 0))
+            data = {'value': [{'id': i} for i in ids[offset:offset + top]]}
+            if offset + top < len(ids):
+                data['@odata.nextLink'] = f"{state['base_url']}/v1.0/me/mailFolders/inbox/messages?$top={top}&$skip={offset + top}"
+            return fake_http.json_response(200, data)
+
+        if path == '/v1.0/me/mailFolders/inbox/messages/delta':
+            return handle_delta(query, headers)
+
+        match = _MESSAGE_PATH_RE.match(path)
+        if match:
+            uid = _uid(match.group(1))
+            msg = mailbox['messages'].get(uid) if uid is not None else None
+            if msg is None:
+                return fake_http.json_response(404, {'error': {'code': 'ErrorItemNotFound'}})
+            if method == 'PATCH':
+                changes = body if isinstance(body, dict) else json.loads(body or b'{}')
+                if 'isRead' in changes:
+                    msg['unread'] = not changes['isRead']
+                if 'flag' in changes:
+                    msg['flagged'] = changes['flag'].get('flagStatus') == 'flagged'
+                synthetic.record_change(mailbox, msg, 'flags')
+            elif method == 'DELETE':
+                msg['unread'] = False
+                synthetic.record_change(mailbox, msg, 'flags')
+                return fake_http.empty_response()
+            return fake_http.json_response(200, _message_json(msg))
+
+        return fake_http.json_response(404, {'error': {'code': 'BadRequest', 'message': f'Unknown path {path}'}})
+
+    def handle_delta(query, headers):
+        """受信トレイの delta
+
+        $deltatoken なし: 受信トレイ全体を列挙する。$deltatoken=V: V より後に変わったメールだけを返す。
+        ページの途中は $skiptoken="基準のversion.列挙時点のversion.位置" で続きを返す。
+        """
+        match = _MAXPAGESIZE_RE.search(headers.get('Prefer', ''))
+        page_size = int(match.group(1)) if match else DEFAULT_PAGE_SIZE
+        if '$skiptoken' in query:
+            since, snapshot, offset = (int(v) for v in query['$skiptoken'].split('.'))
+        else:
+            since = int(query.get('$deltatoken', 0))
+            snapshot, offset = mailbox['version'], 0
+
+        if since == 0:
+            uids = mailbox['order']
+        else:
+            uids = [uid for uid, _ in synthetic.changes_since(mailbox, since)]
+        page = [_message_json(mailbox['messages'][uid]) for uid in uids[offset:offset + page_size]]
+        data = {'value': page}
+        url = f"{state['base_url']}/v1.0/me/mailFolders/inbox/messages/delta"
+        if offset + page_size < len(uids):
+            data['@odata.nextLink'] = f"{url}?$skiptoken={since}.{snapshot}.{offset + page_size}"
+        else:
+            data['@odata.deltaLink'] = f"{url}?$deltatoken={snapshot}"
+        return fake_http.json_response(200, data)
+
+    def handle_batch(request):
+        """JSONバッチの項目を1件ずつ処理する"""
+        items = request.get('requests', [])
+        counters.add(state['counters'], sub_requests=len(items))
+        responses = []
+        for item in items:
+            path, query = fake_http.split_url(item['url'])
+            with mailbox['lock']:
+                status, _, payload = route(item['method'], path, query, item.get('headers', {}), item.get('body'))
+            responses.append({
+                'id': item['id'],
+                'status': status,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.loads(payload) if payload else None,
+            })
+        return fake_http.json_response(200, {'responses': responses})
+
+    return handle
+
+def start(mailbox, latency=0.0):
+    """偽 Graph API を起動し、サーバーの辞書 {'base_url', 'counters', 'stop'} を返す
+
+    outlook_fetcher.GRAPH_API_ENDPOINT には base_url + '/v1.0' を設定する。
+    """
+    state = {}
+    server = fake_http.start(make_app(mailbox, state), latency)
+    state.update(base_url=server['base_url'], counters=server['counters'])
+    return server
@@ -0,0 +1,71 @@
+"""偽のHTTP APIサーバー (Gmail / Graph 用) の共通部分"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import counters
+
+def json_response(status, data):
+    """(ステータス, Content-Type, 本文) の形の応答を作る"""
+    return status, 'application/json; charset=UTF-8', json.dumps(data).encode('utf-8')
+
+def empty_response(status=204):
+    return status, None, b''
+
+def split_url(url):
+    """URL (またはパス) を (パス, {パラメータ: 値}) に分ける (同じ名前のパラメータは最後の値)"""
+    parts = urlsplit(url)
+    query = {key: values[-1] for key, values in parse_qs(parts.query, keep_blank_values=True).items()}
+    return parts.path, query
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        request_bytes = len(self.requestline) + len(str(self.headers)) + len(body)
+        counters.add(self.server.counters, requests=1, bytes_in=request_bytes)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path, query = split_url(self.path)
+        try:
+            status, content_type, payload = self.server.app(self.command, path, query, self.headers, body)
+        except Exception as e:
+            status, content_type, payload = json_response(500, {'error': {'message': str(e)}})
+
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        counters.add(self.server.counters, bytes_out=len(payload))
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+def start(app, latency=0.0):
+    """app(method, path, query, headers, body) -> (ステータス, Content-Type, 本文) を返すサーバーを起動する
+
+    サーバーの辞書 {'base_url', 'counters', 'stop'} を返す。latency 秒をリクエストごとの応答の前に待つ。
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.app = app
+    server.latency = latency
+    server.counters = counters.new_counters()
+    thread = threading.Thread(target=server.serve_forever, name='fake-http', daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return {'base_url': base_url, 'counters': server.counters, 'stop': stop}
@@ -0,0 +1,171 @@
+"""ベンチマーク用の偽IMAPサーバー (プロセス内のスレッドで動く)
+
+imap_fetcher が使うコマンド (CAPABILITY / LOGIN / SELECT / UID SEARCH / UID FETCH /
+UID STORE / EXPUNGE / NOOP / LOGOUT) だけに対応する。暗号化はしないので、
+アカウント設定に "ssl": false を指定して接続する。
+"""
+import socketserver
+import threading
+import time
+
+import counters
+import synthetic
+
+CAPABILITIES = 'IMAP4rev1 IDLE UIDPLUS'
+UIDVALIDITY = 1
+
+def _flags(msg):
+    flags = []
+    if not msg['unread']:
+        flags.append('\\Seen')
+    if msg['flagged']:
+        flags.append('\\Flagged')
+    return ' '.join(flags)
+
+def _parse_uid_set(text, messages, max_uid):
+    """"1:5,8,10:*" の形のUIDセットを、存在するUIDの昇順リストにする"""
+    uids = set()
+    for part in text.split(','):
+        if ':' in part:
+            start, end = part.split(':', 1)
+            start = max_uid if start == '*' else int(start)
+            end = max_uid if end == '*' else int(end)
+            if start > end:
+                start, end = end, start
+            uids.update(uid for uid in range(start, end + 1) if uid in messages)
+        else:
+            uid = max_uid if part == '*' else int(part)
+            if uid in messages:
+                uids.add(uid)
+    return sorted(uids)
+
+class _Handler(socketserver.StreamRequestHandler):
+    """1つの接続を処理する"""
+
+    def _send(self, data):
+        counters.add(self.server.counters, bytes_out=len(data))
+        self.wfile.write(data)
+
+    def handle(self):
+        self._send(f"* OK [CAPABILITY {CAPABILITIES}] fake IMAP ready\r\n".encode())
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            counters.add(self.server.counters, requests=1, bytes_in=len(line))
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            parts = line.decode('utf-8', 'replace').rstrip('\r\n').split(' ', 2)
+            tag = parts[0]
+            command = parts[1].upper() if len(parts) > 1 else ''
+            args = parts[2] if len(parts) > 2 else ''
+            if command == 'UID':
+                sub, _, args = args.partition(' ')
+                command = 'UID ' + sub.upper()
+            if command == 'LOGOUT':
+                self._send(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+                break
+            handler = getattr(self, '_cmd_' + command.replace(' ', '_'), None)
+            if handler is None:
+                self._send(f"{tag} BAD unknown command\r\n".encode())
+                continue
+            with self.server.mailbox['lock']:
+                response = handler(args)
+            self._send(response + f"{tag} OK {command} completed\r\n".encode())
+
+    def _cmd_CAPABILITY(self, args):
+        return f"* CAPABILITY {CAPABILITIES}\r\n".encode()
+
+    def _cmd_LOGIN(self, args):
+        return b''
+
+    def _cmd_NOOP(self, args):
+        return b''
+
+    def _cmd_EXPUNGE(self, args):
+        return b''
+
+    def _cmd_UID_EXPUNGE(self, args):
+        return b''
+
+    def _cmd_SELECT(self, args):
+        mailbox = self.server.mailbox
+        return (
+            f"* {len(mailbox['order'])} EXISTS\r\n"
+            "* 0 RECENT\r\n"
+            "* FLAGS (\\Seen \\Flagged \\Deleted)\r\n"
+            f"* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid\r\n"
+            f"* OK [UIDNEXT {mailbox['next_uid']}] Predicted next UID\r\n"
+        ).encode()
+
+    def _cmd_UID_SEARCH(self, args):
+        mailbox = self.server.mailbox
+        messages = mailbox['messages']
+        tokens = args.split()
+        if tokens and tokens[0].upper() == 'CHARSET':
+            tokens = tokens[2:]
+        candidates = mailbox['order']
+        i = 0
+        while i < len(tokens):
+            token = tokens[i].upper()
+            if token == 'UID':
+                allowed = set(_parse_uid_set(tokens[i + 1], messages, mailbox['next_uid'] - 1))
+                candidates = [uid for uid in candidates if uid in allowed]
+                i += 1
+            elif token == 'UNSEEN':
+                candidates = [uid for uid in candidates if messages[uid]['unread']]
+            i += 1
+        return ('* SEARCH ' + ' '.join(str(uid) for uid in candidates) + '\r\n').encode()
+
+    def _cmd_UID_FETCH(self, args):
+        mailbox = self.server.mailbox
+        messages = mailbox['messages']
+        uid_set, _, items = args.partition(' ')
+        with_body = 'BODY' in items.upper()
+        out = bytearray()
+        for uid in _parse_uid_set(uid_set, messages, mailbox['next_uid'] - 1):
+            msg = messages[uid]
+            # UIDは追加順に振っていて削除は無いので、シーケンス番号はUIDと同じ
+            head = f"* {uid} FETCH (UID {uid} FLAGS ({_flags(msg)})"
+            if with_body:
+                body = synthetic.rfc822(mailbox, msg)
+                out += f"{head} BODY[] {{{len(body)}}}\r\n".encode() + body + b")\r\n"
+            else:
+                out += (head + ")\r\n").encode()
+        return bytes(out)
+
+    def _cmd_UID_STORE(self, args):
+        mailbox = self.server.mailbox
+        messages = mailbox['messages']
+        uid_set, operation, flags = args.split(' ', 2)
+        add = operation.startswith('+')
+        for uid in _parse_uid_set(uid_set, messages, mailbox['next_uid'] - 1):
+            msg = messages[uid]
+            if '\\Seen' in flags:
+                msg['unread'] = not add
+            if '\\Flagged' in flags:
+                msg['flagged'] = add
+            synthetic.record_change(mailbox, msg, 'flags')
+        return b''
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start(mailbox, latency=0.0):
+    """偽IMAPサーバーを起動し、サーバーの辞書 {'host', 'port', 'counters', 'stop'} を返す
+
+    latency 秒をコマンドごとの応答の前に待つ。
+    """
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.mailbox = mailbox
+    server.latency = latency
+    server.counters = counters.new_counters()
+    thread = threading.Thread(target=server.serve_forever, name='fake-imap', daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    return {'host': '127.0.0.1', 'port': server.server_address[1], 'counters': server.counters, 'stop': stop}
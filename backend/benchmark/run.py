@@ -0,0 +1,285 @@
+"""同期処理のベンチマーク (実際のアカウントには接続しない)
+
+偽サーバー (IMAP / Gmail / Graph) に架空のメールボックスを用意し、
+sync_imap_all / sync_gmail / sync_outlook を最後まで実行して
+所要時間・リクエスト数・通信量・最大メモリ使用量(RSS)を計測する。
+
+各サービス・件数ごとに、空のDBからの初回同期 (cold) と、メールボックスを
+少し変化させた後の2回目の同期 (incremental) を計測する。同期は毎回別のプロセスで
+実行するので、RSS には偽サーバーやメールボックスの分は含まれない。
+
+    python backend/benchmark/run.py --providers imap,outlook --sizes 1000,10000
+    python backend/benchmark/run.py --compare backend/benchmark/results/20240101-120000.json
+
+結果は results/ に JSON で保存する (--compare で以前の結果との差を表示する)。
+Gmail の計測には requirements.txt のライブラリ (google-api-python-client など) が必要。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.normpath(os.path.join(BENCH_DIR, '..', 'src'))
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+PROVIDERS = ('imap', 'gmail', 'outlook')
+DEFAULT_SIZES = '1000,10000'
+CHILD_TIMEOUT = 3600           # 1回の同期にかけてよい最大秒数
+GMAIL_ROOT_URL = 'https://gmail.googleapis.com/'
+IMAP_USERNAME = 'bench@example.com'
+
+# ---- 子プロセス側: 同期を1回実行する ----
+
+def _peak_rss_mb():
+    """このプロセスの最大RSS(MB)"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイトで返す
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def _setup_imap(config):
+    import imap_fetcher
+    credentials_path = os.path.join(config['workdir'], 'imap_credentials.json')
+    with open(credentials_path, 'w', encoding='utf-8') as f:
+        json.dump([{
+            'host': config['host'], 'port': config['port'], 'ssl': False,
+            'username': IMAP_USERNAME, 'password': 'bench',
+        }], f)
+    imap_fetcher.CREDENTIALS_PATH = credentials_path
+    imap_fetcher.ACCOUNT_SYNC_TIMEOUT = CHILD_TIMEOUT
+
+    def sync():
+        report = imap_fetcher.sync_imap_all()
+        return bool(report) and report['failed'] == 0
+    return sync
+
+def _setup_gmail(config):
+    import httplib2
+    from googleapiclient.discovery import build
+    import gmail_fetcher
+
+    base_url = config['base_url'] + '/'
+
+    class LocalHttp(httplib2.Http):
+        """Gmail API への通信を偽サーバーに向ける (バッチHTTPの送信先も含む)"""
+
+        def request(self, uri, *args, **kwargs):
+            if uri.startswith(GMAIL_ROOT_URL):
+                uri = base_url + uri[len(GMAIL_ROOT_URL):]
+            return super().request(uri, *args, **kwargs)
+
+    # 認証の代わりに、偽サーバーに向けた service を使う
+    service = build(
+        'gmail', 'v1', http=LocalHttp(), requestBuilder=gmail_fetcher._TimedHttpRequest, static_discovery=True
+    )
+    gmail_fetcher.get_gmail_service = lambda: service
+    return lambda: gmail_fetcher.sync_gmail(full=config['full']) is True
+
+def _setup_outlook(config):
+    import outlook_fetcher
+    outlook_fetcher.GRAPH_API_ENDPOINT = config['base_url'] + '/v1.0'
+    # 認証の代わりに、期限の長いトークンを入れておく
+    outlook_fetcher._access_token.update(token='bench', expires_at=time.time() + 10 ** 6)
+    return lambda: outlook_fetcher.sync_outlook(full=config['full']) is True
+
+_SETUP = {'imap': _setup_imap, 'gmail': _setup_gmail, 'outlook': _setup_outlook}
+
+def run_child(config_path):
+    """子プロセスの本体: 設定ファイルのとおりに同期を1回実行し、結果をファイルに書く"""
+    with open(config_path, encoding='utf-8') as f:
+        config = json.load(f)
+    sys.path.insert(0, SRC_DIR)
+    import backfill
+    import models
+
+    models.DB_PATH = config['db_path']
+    models.init_db()
+    # 上限で止めずに、見つかった新着をすべて取得する
+    backfill.DEFAULT_MAX_MESSAGES = 10 ** 9
+    backfill.DEFAULT_MAX_BYTES = 10 ** 12
+    backfill.DEFAULT_MAX_SECONDS = CHILD_TIMEOUT
+    sync = _SETUP[config['provider']](config)
+
+    started = time.perf_counter()
+    error = None
+    try:
+        ok = sync()
+    except Exception as e:
+        ok, error = False, f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - started
+
+    conn = models.get_connection()
+    result = {
+        'ok': ok,
+        'error': error,
+        'wall_seconds': round(wall, 3),
+        'peak_rss_mb': _peak_rss_mb(),
+        'emails_in_db': conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0],
+        'backlog': conn.execute("SELECT COUNT(*) FROM backfill_queue").fetchone()[0],
+    }
+    with open(config['result_path'], 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+# ---- 親プロセス側: 偽サーバーを動かし、子プロセスで同期させる ----
+
+def _start_server(provider, mailbox, latency):
+    if provider == 'imap':
+        import fake_imap
+        return fake_imap.start(mailbox, latency)
+    if provider == 'gmail':
+        import fake_gmail
+        return fake_gmail.start(mailbox, latency)
+    import fake_graph
+    return fake_graph.start(mailbox, latency)
+
+def _spawn_child(config, workdir):
+    """子プロセスで同期を1回実行し、結果の辞書を返す"""
+    config_path = os.path.join(workdir, 'config.json')
+    config['result_path'] = os.path.join(workdir, 'result.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    if os.path.exists(config['result_path']):
+        os.remove(config['result_path'])
+
+    # 同期処理のログは大量に出るので捨てる (出力にかかる時間は計測に含まれる)
+    try:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', config_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=CHILD_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired:
+        return {'ok': False, 'error': f'{CHILD_TIMEOUT}秒を超えたため打ち切りました'}
+    if proc.returncode != 0 or not os.path.exists(config['result_path']):
+        stderr = proc.stderr.decode('utf-8', 'replace').strip().splitlines()
+        return {'ok': False, 'error': stderr[-1] if stderr else f'exit code {proc.returncode}'}
+    with open(config['result_path'], encoding='utf-8') as f:
+        return json.load(f)
+
+def run_scenario(provider, size, args):
+    """1つのサービス・件数について cold と incremental の同期を計測し、結果の行のリストを返す"""
+    import counters
+    import synthetic
+
+    mailbox = synthetic.make_mailbox(size, args.unread_ratio, args.flagged_ratio, args.body_bytes, args.seed)
+    server = _start_server(provider, mailbox, args.latency_ms / 1000.0)
+    workdir = tempfile.mkdtemp(prefix='sns-bench-')
+    config = {
+        'provider': provider,
+        'full': args.full,
+        'workdir': workdir,
+        'db_path': os.path.join(workdir, 'emails.db'),
+        'base_url': server.get('base_url'),
+        'host': server.get('host'),
+        'port': server.get('port'),
+    }
+
+    rows = []
+    try:
+        for round_name in ('cold', 'incremental'):
+            churned = None
+            if round_name == 'incremental':
+                churned = synthetic.churn(mailbox, args.churn_ratio, args.new_ratio, args.unread_ratio, args.flagged_ratio)
+            counters.take(server['counters'])
+            result = _spawn_child(dict(config), workdir)
+            traffic = counters.take(server['counters'])
+            rows.append({
+                'provider': provider,
+                'size': size,
+                'round': round_name,
+                'expected_unread': sum(1 for msg in mailbox['messages'].values() if msg['unread']),
+                'churn': churned,
+                **traffic,
+                **result,
+            })
+            print(_format_row(rows[-1]))
+            if not result.get('ok'):
+                break
+    finally:
+        server['stop']()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+def _format_row(row):
+    if row.get('wall_seconds') is None:
+        return f"{row['provider']:8} {row['size']:>7} {row['round']:12} 失敗: {row.get('error')}"
+    status = '' if row['ok'] else f"  失敗: {row.get('error')}"
+    mismatch = '' if row.get('emails_in_db') == row['expected_unread'] else f"  (DB {row.get('emails_in_db')} 件 / 期待 {row['expected_unread']} 件)"
+    return (
+        f"{row['provider']:8} {row['size']:>7} {row['round']:12} "
+        f"{row['wall_seconds']:>9.2f}s {row['requests']:>8} req {row['sub_requests']:>8} sub "
+        f"{row['bytes_out'] / 1024 / 1024:>9.2f} MiB {row.get('peak_rss_mb', 0):>7.1f} MB{status}{mismatch}"
+    )
+
+def compare(previous_path, rows):
+    """以前の結果と比べて、所要時間とリクエスト数の変化を表示する"""
+    with open(previous_path, encoding='utf-8') as f:
+        previous = {(r['provider'], r['size'], r['round']): r for r in json.load(f)['runs']}
+    print(f"\n--- {previous_path} との比較 ---")
+    for row in rows:
+        before = previous.get((row['provider'], row['size'], row['round']))
+        if not before or not before.get('wall_seconds') or row.get('wall_seconds') is None:
+            continue
+        change = (row['wall_seconds'] - before['wall_seconds']) / before['wall_seconds'] * 100
+        print(
+            f"{row['provider']:8} {row['size']:>7} {row['round']:12} "
+            f"{before['wall_seconds']:>9.2f}s -> {row['wall_seconds']:>9.2f}s ({change:+.1f}%)  "
+            f"req {before['requests']} -> {row['requests']}  "
+            f"RSS {before.get('peak_rss_mb')} -> {row.get('peak_rss_mb')} MB"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description='偽サーバーを使った同期処理のベンチマーク')
+    parser.add_argument('--providers', default=','.join(PROVIDERS), help='計測するサービス (カンマ区切り)')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='メールボックスの件数 (カンマ区切り, 例 1000,10000,200000)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='偽サーバーがリクエストごとに待つミリ秒')
+    parser.add_argument('--unread-ratio', type=float, default=0.5, help='未読の割合')
+    parser.add_argument('--flagged-ratio', type=float, default=0.05, help='スター/フラグ付きの割合')
+    parser.add_argument('--churn-ratio', type=float, default=0.02, help='2回目の同期の前に既読・フラグを変えるメールの割合')
+    parser.add_argument('--new-ratio', type=float, default=0.01, help='2回目の同期の前に届く新着の割合')
+    parser.add_argument('--body-bytes', type=int, default=2048, help='IMAPのメール本文のバイト数')
+    parser.add_argument('--full', action='store_true', help='Gmail/Outlook を差分ではなく全件同期で計測する')
+    parser.add_argument('--seed', type=int, default=0, help='メールボックスを作る乱数のシード')
+    parser.add_argument('--output', help='結果を保存するファイル (既定は results/日時.json)')
+    parser.add_argument('--compare', help='比較する以前の結果ファイル')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    providers = [p.strip() for p in args.providers.split(',') if p.strip()]
+    unknown = [p for p in providers if p not in PROVIDERS]
+    if unknown:
+        parser.error(f"未対応のサービス: {', '.join(unknown)}")
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+
+    rows = []
+    for provider in providers:
+        for size in sizes:
+            rows.extend(run_scenario(provider, size, args))
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {key: value for key, value in vars(args).items() if key not in ('child', 'output', 'compare')},
+            'runs': rows,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {output}")
+
+    if args.compare:
+        compare(args.compare, rows)
+
+if __name__ == '__main__':
+    main()
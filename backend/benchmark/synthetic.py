@@ -0,0 +1,124 @@
+"""ベンチマーク用の架空のメールボックス
+
+3つの偽サーバー (IMAP / Gmail / Graph) で同じメールボックスを共有できるよう、
+メールは辞書で表し、変更のたびに version (IMAP の MODSEQ、Gmail の historyId、
+Graph の deltatoken に相当) を進めて履歴に記録する。
+"""
+import datetime
+import email.header
+import email.utils
+import random
+import threading
+
+SUBJECTS = [
+    'Weekly report', 'Invoice', 'Meeting notes', 'お知らせ', '請求書のご案内',
+    'Your order has shipped', 'セキュリティ通知', 'Newsletter', 'Re: 打ち合わせの件', 'Build failed',
+]
+SENDERS = [
+    ('Alice', 'alice@example.com'), ('Bob', 'bob@example.com'), ('サポート', 'support@example.jp'),
+    ('Billing', 'billing@example.com'), ('CI', 'ci@example.org'), ('佐藤', 'sato@example.jp'),
+]
+BASE_TIME = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+def _new_message(mailbox, rng, unread_ratio, flagged_ratio):
+    """メールを1件作ってメールボックスの末尾に追加する (UIDは追加順に増える)"""
+    uid = mailbox['next_uid']
+    mailbox['next_uid'] += 1
+    name, address = rng.choice(SENDERS)
+    subject = rng.choice(SUBJECTS)
+    msg = {
+        'uid': uid,
+        'id': f"m{uid:09d}",
+        'subject': f"{subject} #{uid}",
+        'sender_name': name,
+        'sender_address': address,
+        'snippet': f"{subject} の本文の冒頭です。メッセージ番号 {uid}",
+        'received_at': BASE_TIME + datetime.timedelta(minutes=uid),
+        'unread': rng.random() < unread_ratio,
+        'flagged': rng.random() < flagged_ratio,
+        'modseq': mailbox['version'],
+    }
+    mailbox['messages'][uid] = msg
+    mailbox['order'].append(uid)
+    return msg
+
+def make_mailbox(size, unread_ratio=0.5, flagged_ratio=0.05, body_bytes=2048, seed=0):
+    """size 件のメールを持つメールボックスを作る"""
+    rng = random.Random(seed)
+    mailbox = {
+        'messages': {},       # uid -> メール
+        'order': [],          # 古い順のuid
+        'next_uid': 1,
+        'version': 1,         # 変更のたびに増える
+        'history': [],        # (version, uid, 'added' / 'flags') の古い順
+        'body_bytes': body_bytes,
+        'rng': rng,
+        'lock': threading.Lock(),
+    }
+    for _ in range(size):
+        _new_message(mailbox, rng, unread_ratio, flagged_ratio)
+    return mailbox
+
+def record_change(mailbox, msg, kind):
+    """メールの変更を履歴に記録する (kind は 'added' / 'flags')"""
+    mailbox['version'] += 1
+    msg['modseq'] = mailbox['version']
+    mailbox['history'].append((mailbox['version'], msg['uid'], kind))
+
+def churn(mailbox, change_ratio=0.02, new_ratio=0.01, unread_ratio=0.5, flagged_ratio=0.05):
+    """同期と同期の間の変化を起こす
+
+    全体の change_ratio の割合のメールについて、既読・未読やフラグを切り替え、
+    new_ratio の割合の新着を追加する。変更した件数を {'changed', 'added'} で返す。
+    """
+    rng = mailbox['rng']
+    with mailbox['lock']:
+        size = len(mailbox['order'])
+        changed = 0
+        for uid in rng.sample(mailbox['order'], min(size, int(size * change_ratio))):
+            msg = mailbox['messages'][uid]
+            if msg['unread'] and rng.random() < 0.7:
+                msg['unread'] = False           # 他の端末で読まれた
+            elif rng.random() < 0.5:
+                msg['flagged'] = not msg['flagged']
+            else:
+                msg['unread'] = not msg['unread']
+            record_change(mailbox, msg, 'flags')
+            changed += 1
+
+        added = int(size * new_ratio)
+        for _ in range(added):
+            msg = _new_message(mailbox, rng, unread_ratio, flagged_ratio)
+            record_change(mailbox, msg, 'added')
+    return {'changed': changed, 'added': added}
+
+def changes_since(mailbox, version):
+    """version より後に変わったメールを、変わった順に重複なしで返す [(uid, kind)]"""
+    latest = {}
+    for changed_version, uid, kind in mailbox['history']:
+        if changed_version > version:
+            # 追加されたメールは、その後フラグが変わっても 'added' のままにする
+            if latest.get(uid) != 'added':
+                latest[uid] = kind
+    return list(latest.items())
+
+def rfc822(mailbox, msg):
+    """メールの本文を RFC 822 形式で作る (件名・差出人はエンコードする)"""
+    subject = email.header.Header(msg['subject'], 'utf-8').encode()
+    sender = email.utils.formataddr(
+        (str(email.header.Header(msg['sender_name'], 'utf-8').encode()), msg['sender_address'])
+    )
+    body_line = msg['snippet'] + '\r\n'
+    repeat = max(1, mailbox['body_bytes'] // max(len(body_line.encode('utf-8')), 1))
+    body = (body_line * repeat).encode('utf-8')
+    headers = (
+        f"Subject: {subject}\r\n"
+        f"From: {sender}\r\n"
+        f"Date: {email.utils.format_datetime(msg['received_at'])}\r\n"
+        f"Message-ID: <{msg['id']}@bench.example>\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "Content-Transfer-Encoding: 8bit\r\n"
+        "\r\n"
+    ).encode('ascii')
+    return headers + body
@@ -1,12 +1,42 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 import os
+import sqlite3
+import time
 import models
-import gmail_fetcher
-import imap_fetcher
-import outlook_fetcher
+import events
+import metrics
+import outbox_worker
+import imap_idle
+import sync_scheduler
 
 app = Flask(__name__, static_folder='../../frontend')
 
+# /api/emails/batch で一度に返す最大件数
+MAX_BATCH_SIZE = 50
+# /api/emails/bulk で一度に操作できる最大件数
+MAX_BULK_SIZE = 1000
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    """APIの応答時間を記録する (エンドポイントごと。静的ファイルは除く)"""
+    started = g.get('request_started')
+    if started is not None and request.path.startswith('/api/'):
+        metrics.observe(
+            'http_request_seconds', time.perf_counter() - started,
+            endpoint=request.url_rule.rule if request.url_rule else 'unknown',
+            method=request.method, status=response.status_code,
+        )
+    return response
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """リクエスト終了時にDB接続をプールへ返却する"""
+    models.release_connection()
+
 # 静的ファイルの提供 (index.htmlなど)
 @app.route('/')
 def index():
@@ -24,37 +54,60 @@ def important_page():
 def hold_page():
     return send_from_directory(app.static_folder, 'hold.html')
 
-@app.route('/api/emails/<int:db_id>/read', methods=['POST'])
-def mark_as_read(db_id):
-    """メールを既読にする"""
+# 操作ごとのDBへの反映 (Noneはリストから消す)
+_LOCAL_STATUS = {
+    'read': None,    # 既読になったらリストから消える
+    'delete': None,
+    'star': 2,       # 2: Important
+    'unstar': 0,     # 0: Unread
+}
+
+def _enqueue_remote(emails, action):
+    """サーバーへの反映を送信キュー(outbox)に積む (未対応サービスはDBのみ)"""
+    actions = []
+    for email in emails:
+        service = email['service']
+        if outbox_worker.is_supported(service):
+            actions.append((service, email['message_id'], action))
+        else:
+            print(f"Warning: {service} の連携({action})は未実装です。DBのみ更新します。")
+    models.enqueue_actions(actions)
+
+def _apply_actions(emails, action):
+    """DBに即時反映し、サーバーへの反映は送信キューに積んでバックグラウンドで行う
+
+    DBの更新に失敗したらFalseを返す。
+    """
+    message_ids = [email['message_id'] for email in emails]
+    status = _LOCAL_STATUS[action]
+    # ステータスの更新と送信キューへの追加は1つのトランザクションで行う
+    # (途中でDBのエラーが出たら両方ともロールバックされる)
+    try:
+        with models.transaction():
+            if status is None:
+                models.delete_emails(message_ids)
+            else:
+                models.apply_status_map({message_id: status for message_id in message_ids})
+            _enqueue_remote(emails, action)
+    except sqlite3.Error as e:
+        print(f"DB更新エラー({action}): {e}")
+        return False
+    outbox_worker.wake()
+    return True
+
+def _single_action(db_id, action):
+    """1件のメールに操作を行う"""
     email = models.get_email_by_id(db_id)
     if not email:
         return jsonify({'error': 'Email not found'}), 404
-        
-    service = email['service']
-    message_id = email['message_id']
-    success = False
-    
-    if service == 'gmail':
-        success = gmail_fetcher.mark_as_read(message_id)
-    elif service.startswith('imap:'):
-        success = imap_fetcher.mark_as_read(service, message_id)
-    elif service == 'outlook':
-        success = outlook_fetcher.mark_as_read(message_id)
-    else:
-        # いったんDB削除だけしておく
-        success = True
-        print(f"Warning: {service} の既読連携は未実装です。DBからのみ削除します。")
-
+    if not _apply_actions([email], action):
+        return jsonify({'error': 'Failed to update local status'}), 500
+    return jsonify({'success': True})
 
-    if success:
-        # DBから削除（またはステータス更新）
-        # 今回の要件では「既読になったらリストから消える」＝DB削除 or status=1
-        # models.delete_emails を使うとDBから消える
-        models.delete_emails([message_id])
-        return jsonify({'success': True})
-    else:
-        return jsonify({'error': 'Failed to mark as read'}), 500
+@app.route('/api/emails/<int:db_id>/read', methods=['POST'])
+def mark_as_read(db_id):
+    """メールを既読にする"""
+    return _single_action(db_id, 'read')
 
 @app.route('/api/emails/<int:db_id>/pending', methods=['POST'])
 def mark_as_pending(db_id):
@@ -67,64 +120,12 @@ def mark_as_pending(db_id):
 @app.route('/api/emails/<int:db_id>/important', methods=['POST'])
 def mark_as_important(db_id):
     """メールを重要にする（外部連携あり）"""
-    email = models.get_email_by_id(db_id)
-    if not email:
-        return jsonify({'error': 'Email not found'}), 404
-        
-    service = email['service']
-    message_id = email['message_id']
-    success = False
-    
-    # 各サービスの重要(スター/フラグ)処理を呼び出し
-    if service == 'gmail':
-        success = gmail_fetcher.mark_as_important(message_id)
-    elif service.startswith('imap:'):
-        success = imap_fetcher.mark_as_important(service, message_id)
-    elif service == 'outlook':
-        success = outlook_fetcher.mark_as_important(message_id)
-    else:
-        success = True
-        print(f"Warning: {service} の重要連携は未実装です。")
-
-    if success:
-        # 連携に成功したらDBのステータスを更新 (2: Important)
-        if models.update_email_status(db_id, 2): 
-            return jsonify({'success': True})
-        else:
-            return jsonify({'error': 'Failed to update local status'}), 500
-    else:
-        return jsonify({'error': 'Failed to mark as important on server'}), 500
+    return _single_action(db_id, 'star')
 
 @app.route('/api/emails/<int:db_id>/unimportant', methods=['POST'])
 def mark_as_unimportant(db_id):
     """メールを重要から削除する（スター/フラグを外す）"""
-    email = models.get_email_by_id(db_id)
-    if not email:
-        return jsonify({'error': 'Email not found'}), 404
-        
-    service = email['service']
-    message_id = email['message_id']
-    success = False
-    
-    # 各サービスの重要解除処理を呼び出し
-    if service == 'gmail':
-        success = gmail_fetcher.mark_as_unimportant(message_id)
-    elif service.startswith('imap:'):
-        success = imap_fetcher.mark_as_unimportant(service, message_id)
-    elif service == 'outlook':
-        success = outlook_fetcher.mark_as_unimportant(message_id)
-    else:
-        success = True
-        print(f"Warning: {service} の重要解除連携は未実装です。")
-
-    if success:
-        # 成功したらステータスを未読(0)に戻す
-        if models.update_email_status(db_id, 0): # 0: Unread
-            return jsonify({'success': True})
-        else:
-            return jsonify({'error': 'Failed to update local status'}), 500
-    else:
-        return jsonify({'error': 'Failed to mark as unimportant on server'}), 500
+    return _single_action(db_id, 'unstar')
     
 @app.route('/api/emails/next', methods=['GET'])
 def get_next_email():
@@ -133,74 +134,153 @@ def get_next_email():
     offset = request.args.get('offset', default=0, type=int)
     # status: 0=Unread, 1=Pending, 2=Important
     status = request.args.get('status', default=0, type=int)
+    # カーソル: 最後に表示したメールの received_at と id (指定時はoffsetより優先)
+    after_received_at = request.args.get('after_received_at')
+    after_id = request.args.get('after_id', type=int)
+    after = None
+    if after_received_at is not None and after_id is not None:
+        after = (after_received_at, after_id)
     
-    email = models.get_next_email(status=status, offset=offset)
+    # 世代は先に読む (/api/emails/counts の世代と比べて、古い結果かを判定できる)
+    generation = models.get_queue_generation()
+    email = models.get_next_email(status=status, offset=offset, after=after)
+    headers = {'X-Queue-Generation': str(generation)}
     if email:
-        return jsonify(email)
+        return jsonify(email), 200, headers
     else:
-        return jsonify(None), 404
+        return jsonify(None), 404, headers
+
+@app.route('/api/emails/counts', methods=['GET'])
+def get_email_counts():
+    """ステータスごとの件数を返す (メモリのキャッシュから返すのでDBには触れない)
+
+    {"counts": {"0": 未読, "1": 保留, "2": 重要}, "generation": キャッシュの世代, "version": 一覧のバージョン}
+    """
+    result = models.get_queue_counts()
+    counts = {str(status): result['counts'].get(status, 0) for status in (0, 1, 2)}
+    return jsonify({'counts': counts, 'generation': result['generation'], 'version': result['version']})
+
+@app.route('/api/emails/batch', methods=['GET'])
+def get_email_batch():
+    """メールを最大limit件まとめて取得 (画面側の先読み用)"""
+    status = request.args.get('status', default=0, type=int)
+    limit = request.args.get('limit', default=10, type=int)
+    limit = max(1, min(limit, MAX_BATCH_SIZE))
+    after_received_at = request.args.get('after_received_at')
+    after_id = request.args.get('after_id', type=int)
+    after = None
+    if after_received_at is not None and after_id is not None:
+        after = (after_received_at, after_id)
+
+    # キューの先頭 (QUEUE_CACHE_SIZE 件) の範囲ならメモリのキャッシュから返す
+    return jsonify(models.get_queue_batch(status=status, limit=limit, after=after))
+
+@app.route('/api/emails/search', methods=['GET'])
+def search_emails():
+    """件名・差出人・スニペットを全文検索する (関連度順)
+
+    q: 検索語 (空白区切りで AND)、status: 絞り込むステータス (カンマ区切り, 例 "0,2")、
+    limit / offset: ページ送り
+    """
+    query = request.args.get('q', default='').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    limit = request.args.get('limit', default=20, type=int)
+    limit = max(1, min(limit, MAX_BATCH_SIZE))
+    offset = max(0, request.args.get('offset', default=0, type=int))
+    statuses = None
+    status_param = request.args.get('status')
+    if status_param:
+        try:
+            statuses = [int(s) for s in status_param.split(',') if s.strip()]
+        except ValueError:
+            return jsonify({'error': 'status must be comma-separated integers'}), 400
+
+    # 次のページがあるか判定するため1件多く取得する
+    emails = models.search_emails(query, statuses=statuses, limit=limit + 1, offset=offset)
+    return jsonify({
+        'emails': emails[:limit],
+        'has_more': len(emails) > limit,
+        'limit': limit,
+        'offset': offset,
+    })
 
 @app.route('/api/emails/<int:db_id>/delete', methods=['POST'])
 def delete_email_route(db_id):
     """メールをサーバーから削除し、DBからも消す"""
-    email = models.get_email_by_id(db_id)
-    if not email:
-        return jsonify({'error': 'Email not found'}), 404
-        
-    service = email['service']
-    message_id = email['message_id']
-    success = False
-    
-    # サービスごとの削除処理を実行
-    if service == 'gmail':
-        success = gmail_fetcher.delete_email(message_id)
-    elif service.startswith('imap:'):
-        success = imap_fetcher.delete_email(service, message_id)
-    elif service == 'outlook':
-        success = outlook_fetcher.delete_email(message_id)
-    else:
-        # 未知のサービスならDB削除のみ許可
-        success = True
-        print(f"Warning: {service} の削除連携は未実装です。DBからのみ削除します。")
+    return _single_action(db_id, 'delete')
 
-    if success:
-        # DBから削除
-        models.delete_emails([message_id])
-        return jsonify({'success': True})
-    else:
-        return jsonify({'error': 'Failed to delete email'}), 500
+@app.route('/api/emails/bulk', methods=['POST'])
+def bulk_action():
+    """複数のメールにまとめて操作を行う
 
-@app.route('/api/fetch/gmail', methods=['POST'])
-def fetch_gmail():
-    """Gmailの同期を手動実行"""
-    try:
-        gmail_fetcher.sync_gmail()
-        return jsonify({'success': True, 'message': 'Gmail sync started'})
-    except Exception as e:
-        print(f"Gmail sync error: {e}")
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/api/fetch/outlook', methods=['POST'])
-def fetch_outlook():
-    """Outlookの同期を手動実行"""
-    try:
-        outlook_fetcher.sync_outlook()
-        return jsonify({'success': True, 'message': 'Outlook sync started'})
-    except Exception as e:
-        print(f"Outlook sync error: {e}")
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/api/fetch/imap', methods=['POST'])
-def fetch_imap():
-    """IMAPの同期を手動実行"""
-    try:
-        imap_fetcher.sync_imap_all()
-        return jsonify({'success': True, 'message': 'IMAP sync started'})
-    except Exception as e:
-        print(f"IMAP sync error: {e}")
-        return jsonify({'error': str(e)}), 500
+    JSON: {"ids": [DB上のID, ...], "action": "read" | "star" | "unstar" | "delete"}
+    DBには即時反映し、サーバーへはアカウントごとにまとめて一括で反映する
+    (Gmail は batchModify、Outlook は $batch、IMAP は UID STORE 1回)。
+    """
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    ids = data.get('ids')
+    if action not in _LOCAL_STATUS:
+        return jsonify({'error': 'Unknown action'}), 400
+    if not isinstance(ids, list) or not all(isinstance(db_id, int) for db_id in ids):
+        return jsonify({'error': 'ids must be a list of integers'}), 400
+    if len(ids) > MAX_BULK_SIZE:
+        return jsonify({'error': f'Too many ids (max {MAX_BULK_SIZE})'}), 400
+
+    emails = models.get_emails_by_ids(ids)
+    if emails and not _apply_actions(emails, action):
+        return jsonify({'error': 'Failed to update local status'}), 500
+    found = {email['id'] for email in emails}
+    return jsonify({
+        'success': True,
+        'count': len(emails),
+        'missing': [db_id for db_id in ids if db_id not in found],
+    })
+
+@app.route('/api/events', methods=['GET'])
+def event_stream():
+    """メール一覧の変更 (追加・削除・ステータス変更) を Server-Sent Events で配信する
+
+    event: added   data: {"count", "statuses"}
+    event: removed data: {"message_ids"}
+    event: status  data: {"status", "message_ids"}
+    event: reset   data: {}  (取りこぼし・大量の変更: 一覧を取り直す)
+    """
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(
+        events.stream(last_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """同期・API呼び出し・DBの計測値を Prometheus のテキスト形式で返す"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/fetch/<provider>', methods=['POST'])
+def fetch_provider(provider):
+    """同期を予約してすぐに返す (同期はバックグラウンドのスケジューラーが実行する)"""
+    if provider not in sync_scheduler.PROVIDERS:
+        return jsonify({'error': 'Unknown provider'}), 404
+    state = sync_scheduler.request_sync(provider)
+    if state['disabled']:
+        return jsonify({'error': f'{provider} is not configured', 'status': state}), 409
+    return jsonify({'success': True, 'message': f'{provider} sync queued', 'status': state}), 202
+
+@app.route('/api/sync/status', methods=['GET'])
+def get_sync_status():
+    """サービスごとの同期状況 (実行中か、前回の結果、次回までの秒数など) を返す"""
+    return jsonify(sync_scheduler.get_status())
 
 if __name__ == '__main__':
     # DB初期化確認
     models.init_db()
-    app.run(debug=True, port=5002)
\ No newline at end of file
+    # デバッグ時のリローダーでは子プロセス側でだけワーカーを起動する
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        outbox_worker.start()
+        imap_idle.start()
+        sync_scheduler.start()
+    # 配信中の接続がほかのリクエストを止めないよう、リクエストごとにスレッドで処理する
+    app.run(debug=True, port=5002, threaded=True)
\ No newline at end of file
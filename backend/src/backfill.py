@@ -0,0 +1,62 @@
+import time
+
+import models
+import metrics
+
+# 1回の取得で使ってよい量の既定値 (どれか1つでも使い切ったら次回に回す)
+DEFAULT_MAX_MESSAGES = 200              # 件数
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024    # 受信したデータ量(バイト)
+DEFAULT_MAX_SECONDS = 60                # 時間(秒)
+
+def make_budget(max_messages=None, max_bytes=None, max_seconds=None):
+    """取得量の上限を作る (Noneの項目は既定値を使う)"""
+    return {
+        'messages': DEFAULT_MAX_MESSAGES if max_messages is None else max_messages,
+        'bytes': DEFAULT_MAX_BYTES if max_bytes is None else max_bytes,
+        'deadline': time.monotonic() + (DEFAULT_MAX_SECONDS if max_seconds is None else max_seconds),
+    }
+
+def is_exhausted(budget):
+    """上限を使い切ったか"""
+    return budget['messages'] <= 0 or budget['bytes'] <= 0 or time.monotonic() >= budget['deadline']
+
+def run(service_name, fetch_chunk, chunk_size, budget=None):
+    """取得待ちのメールを新しい順に、上限に達するまでチャンクごとに取得して保存する
+
+    fetch_chunk(message_ids) は (保存するメールのリスト, 処理済みのIDのリスト, 受信バイト数) を返す。
+    処理済みのIDには、保存したもののほか、削除済み・既読で保存しなかったものも含める。
+    処理済みにならなかったID (一時的なエラー) は取得待ちに残り、次回もう一度取得する。
+    チャンクごとにコミットするので、途中で止まっても保存済みの分は失われない。
+    結果を {'fetched', 'bytes', 'remaining'} で返す。
+    """
+    if budget is None:
+        budget = make_budget()
+
+    provider = service_name.split(':')[0]  # 'imap:ユーザー名' は 'imap' にまとめて記録する
+    fetched = 0
+    received_bytes = 0
+    cursor = None
+    while not is_exhausted(budget):
+        rows = models.get_backfill_ids(service_name, min(chunk_size, budget['messages']), before=cursor)
+        if not rows:
+            break
+        cursor = rows[-1]
+
+        with metrics.timer('sync_phase_seconds', provider=provider, phase='fetch_details'):
+            email_list, done_ids, chunk_bytes = fetch_chunk([message_id for _, message_id in rows])
+        models.complete_backfill(service_name, email_list, done_ids)
+        metrics.inc('messages_fetched', len(email_list), provider=provider)
+        metrics.inc('bytes_received', chunk_bytes, provider=provider)
+
+        fetched += len(done_ids)
+        received_bytes += chunk_bytes
+        budget['messages'] -= len(rows)
+        budget['bytes'] -= chunk_bytes
+        if not done_ids:
+            # 1件も処理できなかった (接続エラーなど): 次回に回す
+            break
+
+    remaining = models.count_backfill(service_name)
+    if remaining:
+        print(f"[{service_name}] 取得待ち残り {remaining} 件 (次回続きから取得します)")
+    return {'fetched': fetched, 'bytes': received_bytes, 'remaining': remaining}
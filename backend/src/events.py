@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+from collections import deque
+
+import models
+
+# 設定
+BUFFER_SIZE = 1000          # 再接続したクライアントに再送できるよう保持するイベント数
+MAX_IDS_PER_EVENT = 200     # これより多くのメールが一度に変わったら 'reset' (一覧の取り直し) にまとめる
+HEARTBEAT_INTERVAL = 15     # 何も無いときにコメント行を送る間隔(秒) (途中のプロキシに切られないように)
+STREAM_MAX_SECONDS = 300    # 1本の接続を保つ最大秒数 (EventSource は自動で再接続し、続きから受け取る)
+RETRY_MS = 3000             # 切断後にブラウザが再接続するまでの時間(ミリ秒)
+
+_buffer = deque(maxlen=BUFFER_SIZE)  # (イベントID, イベント) の古い順
+_last_id = 0
+# 新しいイベントを待つクライアントを起こすための条件変数
+# (待っている間はDBに触れず、イベントが届くまで眠っている)
+_condition = threading.Condition()
+
+def _compact(change):
+    """models の変更通知を画面に送るイベントに変換する"""
+    message_ids = change.get('message_ids')
+    if message_ids is not None and len(message_ids) > MAX_IDS_PER_EVENT:
+        # 同期で大量に変わったときは、個別に反映するより取り直した方が速い
+        return {'type': 'reset'}
+    return change
+
+def publish(event):
+    """イベントを全クライアントに配信する"""
+    global _last_id
+    with _condition:
+        _last_id += 1
+        _buffer.append((_last_id, event))
+        _condition.notify_all()
+
+def _on_change(changes):
+    """メール一覧の変更を受け取り、イベントとして配信する"""
+    for change in changes:
+        publish(_compact(change))
+
+models.add_change_listener(_on_change)
+
+def get_last_id():
+    """最後に配信したイベントのIDを返す"""
+    with _condition:
+        return _last_id
+
+def _events_after(last_id):
+    """last_id より後のイベントを返す (取りこぼしがあれば 'reset' 1件を返す)
+
+    _condition を取得した状態で呼ぶ。
+    """
+    if last_id >= _last_id:
+        if last_id > _last_id:
+            # サーバーが再起動してIDが振り直された
+            return [(_last_id, {'type': 'reset'})]
+        return []
+    if not _buffer or _buffer[0][0] > last_id + 1:
+        # 保持している範囲より古い: 途中のイベントが失われている
+        return [(_last_id, {'type': 'reset'})]
+    return [(event_id, event) for event_id, event in _buffer if event_id > last_id]
+
+def wait_for_events(last_id, timeout):
+    """last_id より後のイベントが届くまで最大timeout秒待ち、[(イベントID, イベント)] を返す"""
+    with _condition:
+        _condition.wait_for(lambda: _last_id != last_id, timeout)
+        return _events_after(last_id)
+
+def format_event(event_id, event):
+    """イベントを Server-Sent Events の形式にする"""
+    data = {key: value for key, value in event.items() if key != 'type'}
+    return f"id: {event_id}\nevent: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+def stream(last_id=None):
+    """Server-Sent Events を生成する (STREAM_MAX_SECONDS 経つと終了する)
+
+    last_id には再接続時にブラウザが送る Last-Event-ID を渡す。
+    指定が無ければ、接続した時点より後のイベントだけを送る。
+    """
+    if last_id is None:
+        last_id = get_last_id()
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+
+    yield f"retry: {RETRY_MS}\nid: {last_id}\nevent: ready\ndata: {{}}\n\n"
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        events = wait_for_events(last_id, min(remaining, HEARTBEAT_INTERVAL))
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+        for event_id, event in events:
+            yield format_event(event_id, event)
+            last_id = event_id
@@ -1,11 +1,18 @@
 import os.path
 import datetime
+import json
+import threading
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
 import models
+import backfill
+import metrics
+import rate_limit
 
 # パス設定
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -15,31 +22,152 @@ TOKEN_PATH = os.path.join(BASE_DIR, '..', 'credentials', 'gmail_token.json')
 # 権限のスコープ
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# バッチHTTPの設定
+BATCH_SIZE = 50                # 1回のバッチに入れるリクエスト数 (Gmailの推奨上限)
+BATCH_MODIFY_LIMIT = 1000      # batchModify 1回に渡せるIDの上限
+
+# レート制限の設定 (同期・画面の操作・送信キューで共有する)
+QUOTA_UNITS_PER_SECOND = 250   # ユーザーごとのクォータ (units/秒)
+MAX_CONCURRENCY = 4            # 同時に送るリクエスト数の上限
+MAX_RETRIES = 3                # スロットリングされたときの再送回数
+# メソッドごとの1回あたりのコスト (quota units)
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.trash': 5,
+    'gmail.users.messages.batchModify': 50,
+}
+DEFAULT_QUOTA_UNITS = 5
+# 403 でもスロットリングとして扱うエラーの理由
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+rate_limit.configure('gmail', rate=QUOTA_UNITS_PER_SECOND, max_concurrency=MAX_CONCURRENCY)
+
+# 同期の設定
+HISTORY_STATE_KEY = 'gmail:history_id'  # 差分同期のチェックポイント (sync_stateのキー)
+EXCLUDED_LABELS = ('TRASH', 'SPAM')     # 未読でも同期の対象にしないラベル
+
+# 認証の設定
+REFRESH_AHEAD_SECONDS = 300  # 有効期限のこの秒数前になったら先回りして更新する
+
+_creds = None            # プロセス内で共有する認証情報
+_saved_token_json = None # 最後にファイルへ書き込んだ(または読み込んだ)内容
+_auth_lock = threading.Lock()
+_local = threading.local()  # スレッドごとの service (httplib2 はスレッドセーフでないため)
+
+def _needs_refresh(creds):
+    """有効期限切れ、または期限が近い認証情報か"""
+    if not creds.valid:
+        return True
+    if creds.expiry is None:
+        return False
+    remaining = creds.expiry - datetime.datetime.utcnow()
+    return remaining < datetime.timedelta(seconds=REFRESH_AHEAD_SECONDS)
+
+def _save_credentials(creds):
+    """認証情報が変わったときだけトークンファイルに書き込む"""
+    global _saved_token_json
+    token_json = creds.to_json()
+    if token_json == _saved_token_json:
+        return
+    with open(TOKEN_PATH, 'w') as token:
+        token.write(token_json)
+    _saved_token_json = token_json
+
+def is_configured():
+    """ログイン済みのトークンがあるか (無いと get_credentials がブラウザでのログインを待つ)"""
+    return os.path.exists(TOKEN_PATH)
+
+def get_credentials():
+    """Gmail APIの認証情報を返す (トークンファイルは初回だけ読み込み、期限が近づいたら更新する)"""
+    global _creds, _saved_token_json
+    with _auth_lock:
+        if _creds is None and os.path.exists(TOKEN_PATH):
+            with open(TOKEN_PATH, 'r') as token:
+                _saved_token_json = token.read()
+            _creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+
+        if _creds is None or _needs_refresh(_creds):
+            if _creds and _creds.refresh_token:
+                _creds.refresh(Request())
+            else:
+                if not os.path.exists(CREDENTIALS_PATH):
+                    raise FileNotFoundError(f"認証ファイルが見つかりません: {CREDENTIALS_PATH}")
+                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+                _creds = flow.run_local_server(port=0)
+            _save_credentials(_creds)
+
+        return _creds
+
+def _quota_units(request):
+    """リクエスト1回のコスト (quota units)"""
+    return QUOTA_UNITS.get(request.methodId, DEFAULT_QUOTA_UNITS)
+
+def _is_rate_limited(error):
+    """APIエラーがスロットリング (429、または 403 の userRateLimitExceeded など) かどうか"""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(error.content).get('error', {}).get('errors', [])
+    except (ValueError, AttributeError):
+        return False
+    return any(e.get('reason') in RATE_LIMIT_REASONS for e in errors)
+
+def _retry_after_seconds(error):
+    """APIエラーの Retry-After ヘッダーの秒数 (無ければNone)"""
+    resp = getattr(error, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return None
+
+class _TimedHttpRequest(HttpRequest):
+    """execute() をレート制限の範囲で送り、所要時間とエラーをAPIのメソッドごとに記録するリクエスト
+
+    スロットリングされたら Retry-After (無ければバックオフ) の間待って MAX_RETRIES 回まで再送する。
+    """
+
+    def execute(self, *args, **kwargs):
+        operation = self.methodId or 'unknown'
+        attempt = 0
+        while True:
+            with rate_limit.limit('gmail', _quota_units(self)) as call:
+                try:
+                    with metrics.timer('provider_request_seconds', provider='gmail', operation=operation):
+                        return super().execute(*args, **kwargs)
+                except HttpError as e:
+                    if not _is_rate_limited(e) or attempt >= MAX_RETRIES:
+                        # 5xx は失敗、4xx (削除済みの404など) は成功とも失敗とも数えない
+                        if getattr(e.resp, 'status', 500) < 500:
+                            call['succeeded'] = None
+                        raise
+                    delay = rate_limit.throttled('gmail', _retry_after_seconds(e))
+            attempt += 1
+            print(f"スロットリング(Gmail): {operation} を {delay:.0f} 秒後に再送します")
+
 def get_gmail_service():
-    """Gmail APIへの接続認証を行う"""
-    creds = None
-    if os.path.exists(TOKEN_PATH):
-        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            if not os.path.exists(CREDENTIALS_PATH):
-                raise FileNotFoundError(f"認証ファイルが見つかりません: {CREDENTIALS_PATH}")
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        with open(TOKEN_PATH, 'w') as token:
-            token.write(creds.to_json())
+    """Gmail APIへの接続認証を行う
 
-    return build('gmail', 'v1', credentials=creds)
+    認証情報はプロセス全体で共有し、service はスレッドごとに1回だけ作成して使い回す。
+    """
+    creds = get_credentials()
+    service = getattr(_local, 'service', None)
+    if service is None or getattr(_local, 'creds', None) is not creds:
+        service = build('gmail', 'v1', credentials=creds, requestBuilder=_TimedHttpRequest)
+        _local.service = service
+        _local.creds = creds
+    return service
 
-def fetch_all_unread_ids():
-    """Gmail上の全未読メールのIDだけを取得する"""
+def iter_unread_id_pages():
+    """Gmail上の未読メールのIDを、APIのページ単位(リスト)で順に返す"""
     service = get_gmail_service()
-    
-    unread_ids = set()
     page_token = None
     
     while True:
@@ -51,32 +179,114 @@ def fetch_all_unread_ids():
             pageToken=page_token
         ).execute()
         
-        messages = results.get('messages', [])
-        for msg in messages:
-            unread_ids.add(msg['id'])
+        yield [msg['id'] for msg in results.get('messages', [])]
             
         page_token = results.get('nextPageToken')
         if not page_token:
             break
-            
-    return unread_ids
 
-def fetch_details_and_save(target_ids):
-    """指定されたIDリストのメール詳細を取得して保存"""
+def execute_batch(service, request_map):
+    """{キー: APIリクエスト} をバッチHTTPでまとめて実行する
+
+    BATCH_SIZE件ずつ1回のHTTP通信で送る。送信は中のリクエストのコストの合計で
+    レート制限を通すので、クォータ(units/秒)を超えない。
+    スロットリングされた項目だけを、待ってから MAX_RETRIES 回まで再送する。
+    結果とエラーをそれぞれキーごとの辞書で返す。
+    """
+    results = {}
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            results[request_id] = response
+
+    items = list(request_map.items())
+    for i in range(0, len(items), BATCH_SIZE):
+        chunk = items[i:i + BATCH_SIZE]
+        attempt = 0
+        while chunk:
+            batch = service.new_batch_http_request(callback=callback)
+            for key, request in chunk:
+                errors.pop(key, None)
+                batch.add(request, request_id=key)
+            with rate_limit.limit('gmail', sum(_quota_units(request) for _, request in chunk)):
+                try:
+                    with metrics.timer('provider_request_seconds', provider='gmail', operation='batch'):
+                        batch.execute()
+                except Exception as e:
+                    # バッチ全体が失敗した場合は、そのバッチの全件をエラーとして扱う
+                    for key, _ in chunk:
+                        if key not in results:
+                            errors[key] = e
+
+            # スロットリングされた項目だけ、待ってから再送する
+            throttled = [(key, request) for key, request in chunk if key in errors and _is_rate_limited(errors[key])]
+            if not throttled or attempt >= MAX_RETRIES:
+                break
+            attempt += 1
+            retry_after = max((_retry_after_seconds(errors[key]) or 0 for key, _ in throttled), default=0)
+            delay = rate_limit.throttled('gmail', retry_after or None)
+            print(f"スロットリング(Gmail): {len(throttled)} 件を {delay:.0f} 秒後に再送します")
+            chunk = throttled
+
+    if errors:
+        metrics.inc('provider_request_errors', len(errors), provider='gmail', operation='batch.item')
+    return results, errors
+
+def _is_unread(label_ids):
+    """未読として扱うメールか (ゴミ箱・迷惑メールは UNREAD が付いていても扱わない)
+
+    一覧 (messages.list) も既定でゴミ箱と迷惑メールを含まないので、それに合わせる。
+    アプリの削除 (messages.trash) は UNREAD を外さないので、ここで除かないと同期で戻ってくる。
+    """
+    return 'UNREAD' in label_ids and not any(label in label_ids for label in EXCLUDED_LABELS)
+
+def _is_not_found(error):
+    """APIエラーが404(メールが削除済み)かどうか"""
+    resp = getattr(error, 'resp', None)
+    return resp is not None and getattr(resp, 'status', None) == 404
+
+def fetch_details(target_ids):
+    """指定されたIDリストのメール詳細を取得する
+
+    (保存するメールのリスト, 処理済みのIDのリスト, 受信バイト数) を返す (backfill.run 用)。
+    削除済み(404)や既読になっていたメールは保存せずに処理済みとし、
+    それ以外のエラーのメールは次回もう一度取得する。
+    """
     service = get_gmail_service()
     email_data_list = []
-    
-    count = 0
+    done_ids = []
+    received_bytes = 0
+
+    # 件名と差出人のヘッダーだけあれば良いので metadata 形式で取得
+    request_map = {
+        msg_id: service.users().messages().get(
+            userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject', 'From']
+        )
+        for msg_id in target_ids
+    }
+    results, errors = execute_batch(service, request_map)
+
+    for msg_id, e in errors.items():
+        if _is_not_found(e):
+            done_ids.append(msg_id)
+        else:
+            print(f"エラー(ID: {msg_id}): {e}")
+
     for msg_id in target_ids:
-        if count >= 10: 
-            print("一度の取得上限(10件)に達したため中断します")
-            break
+        detail = results.get(msg_id)
+        if detail is None:
+            continue
+        received_bytes += len(json.dumps(detail))
+
+        if not _is_unread(detail.get('labelIds', [])):
+            # 取得待ちの間に既読になった (またはゴミ箱・迷惑メールに移された)
+            done_ids.append(msg_id)
+            continue
 
         try:
-            detail = service.users().messages().get(
-                userId='me', id=msg_id, format='full'
-            ).execute()
-            
             payload = detail.get('payload', {})
             headers = payload.get('headers', [])
             label_ids = detail.get('labelIds', []) # ラベルIDを取得
@@ -106,138 +316,266 @@ def fetch_details_and_save(target_ids):
                 'received_at': received_at,
                 'status': status # ステータスを追加
             })
+            done_ids.append(msg_id)
             
             status_str = "★重要" if status == 2 else "未読"
             print(f"取得(Gmail): {subject[:20]}... [{status_str}]")
-            count += 1
             
         except Exception as e:
             print(f"エラー(ID: {msg_id}): {e}")
 
-    if email_data_list:
-        models.save_emails(email_data_list)
+    return email_data_list, done_ids, received_bytes
 
-def mark_as_read(message_id):
-    """Gmailのメールを既読にする（UNREADラベルを外す）"""
-    service = get_gmail_service()
-    try:
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'removeLabelIds': ['UNREAD']}
-        ).execute()
-        print(f"Gmail既読化成功: {message_id}")
-        return True
-    except Exception as e:
-        print(f"Gmail既読化エラー: {e}")
-        return False
+def backfill_gmail(budget=None):
+    """取得待ちの新着メールを新しい順に、上限(budget)まで取得して保存する"""
+    return backfill.run('gmail', fetch_details, BATCH_SIZE, budget)
+
+def _modify_bulk(message_ids, body, label):
+    """複数メールのラベルを batchModify でまとめて変更し、成功したIDのリストを返す
 
-def mark_as_important(message_id):
-    """Gmailのメールにスターを付ける（STARREDラベルを追加）"""
+    batchModify は1件でも失敗すると全体が失敗するので、その場合は
+    バッチHTTPで1件ずつ modify をやり直し、成功したものだけを返す。
+    """
     service = get_gmail_service()
-    try:
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'addLabelIds': ['STARRED']}
-        ).execute()
-        print(f"Gmail重要設定(スター)成功: {message_id}")
-        return True
-    except Exception as e:
-        print(f"Gmail重要設定エラー: {e}")
-        return False
+    message_ids = list(message_ids)
+    succeeded = []
+    for i in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+        chunk = message_ids[i:i + BATCH_MODIFY_LIMIT]
+        try:
+            service.users().messages().batchModify(userId='me', body=dict(body, ids=chunk)).execute()
+            succeeded.extend(chunk)
+            continue
+        except Exception as e:
+            if len(chunk) == 1:
+                print(f"Gmail{label}エラー: {e}")
+                continue
+            print(f"Gmail{label}の一括処理に失敗したため1件ずつ送ります: {e}")
+
+        request_map = {
+            msg_id: service.users().messages().modify(userId='me', id=msg_id, body=body)
+            for msg_id in chunk
+        }
+        results, errors = execute_batch(service, request_map)
+        succeeded.extend(results)
+        for msg_id, e in errors.items():
+            print(f"Gmail{label}エラー(ID: {msg_id}): {e}")
+
+    print(f"Gmail{label}成功: {len(succeeded)}/{len(message_ids)} 件")
+    return succeeded
+
+def mark_as_read_bulk(message_ids):
+    """Gmailの複数メールをまとめて既読にする"""
+    return _modify_bulk(message_ids, {'removeLabelIds': ['UNREAD']}, '既読化')
+
+def mark_as_important_bulk(message_ids):
+    """Gmailの複数メールにまとめてスターを付ける"""
+    return _modify_bulk(message_ids, {'addLabelIds': ['STARRED']}, '重要設定(スター)')
 
-def mark_as_unimportant(message_id):
-    """Gmailのメールからスターを外す（STARREDラベルを削除）"""
+def mark_as_unimportant_bulk(message_ids):
+    """Gmailの複数メールからまとめてスターを外す"""
+    return _modify_bulk(message_ids, {'removeLabelIds': ['STARRED']}, '重要解除(スター削除)')
+
+def delete_email_bulk(message_ids):
+    """Gmailの複数メールをまとめてゴミ箱に移動する (削除済みのものも成功として返す)"""
     service = get_gmail_service()
-    try:
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'removeLabelIds': ['STARRED']}
-        ).execute()
-        print(f"Gmail重要解除(スター削除)成功: {message_id}")
-        return True
-    except Exception as e:
-        print(f"Gmail重要解除エラー: {e}")
-        return False
+    request_map = {
+        msg_id: service.users().messages().trash(userId='me', id=msg_id)
+        for msg_id in message_ids
+    }
+    results, errors = execute_batch(service, request_map)
+    succeeded = list(results)
+    for msg_id, e in errors.items():
+        if _is_not_found(e):
+            succeeded.append(msg_id)
+        else:
+            print(f"Gmail削除エラー(ID: {msg_id}): {e}")
+    print(f"Gmail削除成功: {len(succeeded)}/{len(request_map)} 件")
+    return succeeded
 
 def update_starred_status(local_ids):
-    """DBにあるメールのスター状態をGmailと同期する"""
+    """DBにあるメールのスター状態をGmailと同期する
+
+    確認できたメールだけを反映し、確認できなかったメール (削除済みを除く) があれば
+    例外を出す (同期を失敗として扱い、次回もう一度確認する)。
+    """
     if not local_ids:
         return
 
     service = get_gmail_service()
     print(f"既存メール({len(local_ids)}件)のステータスを確認中...")
 
-    for msg_id in local_ids:
+    # IDとラベル情報だけを軽量に取得 (バッチHTTPでまとめて問い合わせる)
+    request_map = {
+        msg_id: service.users().messages().get(
+            userId='me', id=msg_id, format='minimal', fields='id,labelIds'
+        )
+        for msg_id in local_ids
+    }
+    results, errors = execute_batch(service, request_map)
+
+    # 404の場合はメールが削除されている可能性があるので無視
+    failed = {msg_id: e for msg_id, e in errors.items() if not _is_not_found(e)}
+    for msg_id, e in failed.items():
+        print(f"ステータス確認エラー(ID: {msg_id}): {e}")
+
+    # STARREDなら2、そうでなければ0
+    status_map = {
+        msg_id: 2 if 'STARRED' in msg.get('labelIds', []) else 0
+        for msg_id, msg in results.items()
+    }
+
+    # DB上の現在のステータスと比較し、変わったものだけをまとめて更新
+    models.apply_status_map(status_map)
+    if failed:
+        raise Exception(f"Gmailのステータス確認に {len(failed)} 件失敗しました")
+
+def sync_gmail(full=False, budget=None):
+    """GmailとDBを同期する
+
+    前回の historyId が保存されていれば History API で差分だけを同期し、
+    無い場合・期限切れの場合・full=True の場合は全件同期する。
+    新着の詳細は取得待ちに入れ、budget (backfill.make_budget) の範囲で新しい順に取得する。
+    成功したらTrueを返す。
+    """
+    print("Gmailの同期を開始します...")
+
+    history_id = None if full else models.get_sync_state(HISTORY_STATE_KEY)
+    synced = False
+    if history_id:
         try:
-            # IDとラベル情報だけを軽量に取得
-            msg = service.users().messages().get(
-                userId='me', id=msg_id, format='minimal', fields='id,labelIds'
-            ).execute()
-            
-            label_ids = msg.get('labelIds', [])
-            
-            # DB上のメール情報を取得して現在のステータスと比較
-            # STARREDなら2、そうでなければ0
-            new_status = 2 if 'STARRED' in label_ids else 0
-            
-            models.update_email_status_by_message_id(msg_id, new_status)
-            
+            synced = sync_gmail_incremental(history_id)
         except Exception as e:
-            # 404の場合はメールが削除されている可能性があるので無視
-            pass
+            print(f"Gmailの差分同期に失敗しました: {e}")
+            return False
+        if not synced:
+            print("Gmailの履歴が期限切れのため、全件同期に切り替えます")
 
-def sync_gmail():
-    """GmailとDBを同期する"""
-    print("Gmailの同期を開始します...")
-    
-    # 1. サーバー(Gmail)にある未読IDを取得
+    if not synced and not sync_gmail_full():
+        return False
+
+    # 見つかった新着の詳細を、前回の残りも含めて新しい順に取得する
     try:
-        server_unread_ids = fetch_all_unread_ids()
+        backfill_gmail(budget)
     except Exception as e:
-        print(f"Gmailへの接続に失敗しました: {e}")
-        return
-    
-    # 2. ローカル(DB)にあるGmailのIDのみを取得
-    if hasattr(models, 'get_message_ids_by_service'):
-        local_stored_ids = models.get_message_ids_by_service('gmail')
-    else:
-        local_stored_ids = models.get_all_message_ids()
-    
-    # 3. 差分を計算
-    new_ids = server_unread_ids - local_stored_ids
-    read_ids = local_stored_ids - server_unread_ids
-    existing_ids = server_unread_ids & local_stored_ids # 両方にあるID（更新チェック対象）
-    
-    # 4. DBを更新
+        print(f"Gmailの新着取得に失敗しました: {e}")
+        return False
+    return True
+
+def sync_gmail_full():
+    """Gmailの全未読メールとDBを突き合わせて同期する (成功したらTrue)"""
+    try:
+        service = get_gmail_service()
+        # 全件同期の開始時点の historyId (同期中の変更は次回の差分同期で拾う)
+        start_history_id = service.users().getProfile(userId='me', fields='historyId').execute()['historyId']
+
+        # 1. サーバー(Gmail)にある未読IDをページごとにDBの一時テーブルへ書き込む
+        pages = metrics.timed_iter(iter_unread_id_pages(), 'sync_phase_seconds', provider='gmail', phase='list')
+        with models.staged_server_ids('gmail', pages):
+            # 2. 既読になったメール (DBにだけあるID) を削除
+            with metrics.timer('sync_phase_seconds', provider='gmail', phase='diff'):
+                for read_ids in models.iter_diff_ids('gmail', 'gone'):
+                    print(f"既読検知(Gmail): {len(read_ids)} 件 -> DBから削除します")
+                    models.delete_emails(read_ids)
+
+            # 3. 既存メールのスター状態を同期 (新着を保存する前に対象を確定させる)
+            with metrics.timer('sync_phase_seconds', provider='gmail', phase='reconcile_flags'):
+                for existing_ids in models.iter_diff_ids('gmail', 'existing'):
+                    update_starred_status(existing_ids)
+
+            # 4. 新着メールを取得待ちに入れる (一覧は新しい順なので、その順番で取得される)
+            with metrics.timer('sync_phase_seconds', provider='gmail', phase='enqueue_new'):
+                new_count = models.count_diff_ids('gmail', 'new')
+                if new_count:
+                    print(f"新着検知(Gmail): {new_count} 件 -> 取得待ちに追加します")
+                models.enqueue_backfill_from_staging('gmail')
+    except Exception as e:
+        print(f"Gmailの同期に失敗しました: {e}")
+        return False
+
+    # 新着は取得待ちに保存済みなので、チェックポイントを進めてよい
+    models.set_sync_state(HISTORY_STATE_KEY, start_history_id)
+    return True
+
+def iter_history_pages(start_history_id):
+    """History API で start_history_id 以降の変更履歴をページごとに返す"""
+    service = get_gmail_service()
+    page_token = None
+
+    while True:
+        results = service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+            pageToken=page_token
+        ).execute()
+        yield results
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+def sync_gmail_incremental(start_history_id):
+    """前回の historyId 以降の変更だけを同期する (期限切れならFalseを返す)"""
+    # メールごとの最新のラベル (Noneは削除されたメール)
+    latest_labels = {}
+    new_history_id = start_history_id
+    try:
+        for page in metrics.timed_iter(iter_history_pages(start_history_id), 'sync_phase_seconds', provider='gmail', phase='list'):
+            new_history_id = page.get('historyId', new_history_id)
+            for record in page.get('history', []):
+                for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                    for item in record.get(key, []):
+                        msg = item['message']
+                        latest_labels[msg['id']] = msg.get('labelIds', [])
+                for item in record.get('messagesDeleted', []):
+                    latest_labels[item['message']['id']] = None
+    except Exception as e:
+        if _is_not_found(e):
+            # historyId が古すぎる (約1週間で失効する)
+            models.set_sync_state(HISTORY_STATE_KEY, None)
+            return False
+        raise
+
+    if not latest_labels:
+        models.set_sync_state(HISTORY_STATE_KEY, new_history_id)
+        print("Gmail: 変更はありません")
+        return True
+
+    with metrics.timer('sync_phase_seconds', provider='gmail', phase='diff'):
+        _apply_history(latest_labels)
+
+    models.set_sync_state(HISTORY_STATE_KEY, new_history_id)
+    return True
+
+def _apply_history(latest_labels):
+    """履歴から集めたメールごとの最新のラベルをDBに反映する"""
+    # 反映待ちの操作があるメールはサーバー側がまだ古いので触らない
+    pending_ids = models.get_pending_message_ids(latest_labels.keys())
+    local_ids = models.get_existing_message_ids(latest_labels.keys())
+
+    read_ids = []
+    new_ids = []
+    status_map = {}
+    for msg_id, labels in latest_labels.items():
+        if msg_id in pending_ids:
+            continue
+        if labels is None or not _is_unread(labels):
+            if msg_id in local_ids:
+                read_ids.append(msg_id)
+        elif msg_id in local_ids:
+            status_map[msg_id] = 2 if 'STARRED' in labels else 0
+        else:
+            new_ids.append(msg_id)
+
     if read_ids:
         print(f"既読検知(Gmail): {len(read_ids)} 件 -> DBから削除します")
         models.delete_emails(read_ids)
-    
+    models.apply_status_map(status_map)
     if new_ids:
-        print(f"新着検知(Gmail): {len(new_ids)} 件 -> 詳細を取得して保存します")
-        fetch_details_and_save(new_ids)
-        
-    # 5. 既存メールのスター状態を同期
-    if existing_ids:
-        update_starred_status(existing_ids)
+        print(f"新着検知(Gmail): {len(new_ids)} 件 -> 取得待ちに追加します")
+        # 履歴は古い順なので、逆順にして新しいメールから取得されるようにする
+        models.enqueue_backfill('gmail', list(reversed(new_ids)))
 
 if __name__ == '__main__':
     models.init_db()
     sync_gmail()
-
-def delete_email(message_id):
-    """Gmailのメールをゴミ箱に移動する"""
-    service = get_gmail_service()
-    try:
-        service.users().messages().trash(
-            userId='me',
-            id=message_id
-        ).execute()
-        print(f"Gmail削除(ゴミ箱): {message_id}")
-        return True
-    except Exception as e:
-        print(f"Gmail削除エラー: {e}")
-        return False
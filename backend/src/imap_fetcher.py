@@ -1,30 +1,261 @@
+import atexit
 import imaplib
 import email
 import email.header
 import json
 import os
+import re
 import datetime
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import models
+import backfill
+import metrics
 
 # パス設定
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CREDENTIALS_PATH = os.path.join(BASE_DIR, '..', 'credentials', 'imap_credentials.json')
 
+# 同期の設定
+BACKFILL_CHUNK_SIZE = 20  # 取得待ちのメールを1回のトランザクションで保存する件数
+MAX_UID_SET_LENGTH = 1000 # 1回のコマンドに入れるUIDセットの最大文字数 (サーバーの行長制限対策)
+
+# 所要時間を記録するIMAPコマンド (imaplib のメソッド名)
+TIMED_COMMANDS = ('login', 'capability', 'enable', 'select', 'noop', 'uid', 'expunge', 'logout')
+
+# 接続プールの設定
+HEALTH_CHECK_INTERVAL = 60  # これ以上使っていない接続はNOOPで生存確認する(秒)
+SOCKET_TIMEOUT = 60         # 1回の送受信で待つ最大秒数
+
+# 並列同期の設定
+SYNC_WORKERS = 4                  # 同時に同期するアカウント数の上限
+ACCOUNT_SYNC_TIMEOUT = 300        # 1アカウントの同期にかけてよい最大秒数
+DEFAULT_HOST_CONNECTIONS = 2      # 1つのサーバーに同時に使う接続数の上限
+# 並列ログインを制限しているサーバーは個別に絞る
+# (アカウント設定の max_connections でも指定できる)
+HOST_CONNECTION_LIMITS = {
+    'imap.mail.yahoo.com': 1,
+    'imap.mail.me.com': 1,
+}
+
+_sessions = {}  # username -> {'conn', 'last_used', 'lock', 'active_since'}
+_pool_lock = threading.Lock()
+_host_slots = {}  # host -> Semaphore
+_host_limits = {}  # host -> Semaphore の大きさ
+_accounts_cache = {'mtime': None, 'accounts': None}
+_accounts_lock = threading.Lock()
+
+def _timed_command(name, command):
+    """IMAPコマンドの所要時間とエラー(例外・OK以外の応答)を記録するラッパーを返す"""
+    def wrapper(*args, **kwargs):
+        # UID コマンドは FETCH / STORE などの種類ごとに分けて記録する
+        operation = f"UID {args[0]}".upper() if name == 'uid' and args else name.upper()
+        with metrics.timer('provider_request_seconds', provider='imap', operation=operation):
+            typ, data = command(*args, **kwargs)
+        if typ not in ('OK', 'BYE'):
+            metrics.inc('provider_request_errors', provider='imap', operation=operation)
+        return typ, data
+    return wrapper
+
+def _instrument(mail):
+    """接続のコマンド (TIMED_COMMANDS) を計測付きに置き換える"""
+    for name in TIMED_COMMANDS:
+        setattr(mail, name, _timed_command(name, getattr(mail, name)))
+    return mail
+
 def get_imap_connection(account_config):
-    """指定された設定でIMAPサーバーに接続してログインする"""
+    """指定された設定でIMAPサーバーに接続してログインする
+
+    "ssl": false を指定すると暗号化しない接続を使う (手元の検証用サーバー向け)。
+    """
     host = account_config.get('host')
-    port = account_config.get('port', 993)
+    use_ssl = account_config.get('ssl', True)
+    port = account_config.get('port', 993 if use_ssl else 143)
     username = account_config.get('username')
     password = account_config.get('password')
 
     try:
-        mail = imaplib.IMAP4_SSL(host, port)
+        imap_class = imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+        with metrics.timer('provider_request_seconds', provider='imap', operation='CONNECT'):
+            mail = _instrument(imap_class(host, port, timeout=SOCKET_TIMEOUT))
         mail.login(username, password)
+        _refresh_capabilities(mail)
+        _enable_extensions(mail)
         return mail
     except Exception as e:
         print(f"[{username}] 接続エラー: {e}")
         return None
 
+def _refresh_capabilities(mail):
+    """ログイン後の CAPABILITY で mail.capabilities を更新する
+
+    imaplib はログイン前の挨拶で通知された CAPABILITY しか持たないが、多くのサーバー (Dovecot, Gmail など) は
+    ENABLE / CONDSTORE / QRESYNC / UIDPLUS をログイン後にしか通知しない。
+    取得できなければログイン前のままにする。
+    """
+    try:
+        typ, data = mail.capability()
+        if typ == 'OK' and data and data[-1]:
+            mail.capabilities = tuple(data[-1].decode('ascii', 'replace').upper().split())
+    except Exception as e:
+        print(f"CAPABILITY の取得に失敗しました: {e}")
+
+def _enable_extensions(mail):
+    """CONDSTORE/QRESYNC に対応していれば有効にする (有効にした拡張を mail.sync_extensions に記録)
+
+    ENABLE は SELECT 前にしか送れないため、ログイン直後 (_refresh_capabilities の後) に呼ぶ。
+    """
+    mail.sync_extensions = set()
+    try:
+        caps = set(mail.capabilities)
+        if 'ENABLE' not in caps:
+            if 'CONDSTORE' in caps:
+                # CONDSTORE は ENABLE しなくても CHANGEDSINCE を使えば有効になる
+                mail.sync_extensions.add('CONDSTORE')
+            return
+        for ext in ('QRESYNC', 'CONDSTORE'):
+            if ext in caps:
+                typ, _ = mail.enable(ext)
+                if typ == 'OK':
+                    mail.sync_extensions.add(ext)
+                    # QRESYNC を有効にすると CONDSTORE も有効になる
+                    mail.sync_extensions.add('CONDSTORE')
+                    break
+    except Exception as e:
+        print(f"拡張機能の有効化に失敗しました (通常の同期を行います): {e}")
+
+def is_configured():
+    """アカウントの設定ファイルがあるか"""
+    return os.path.exists(CREDENTIALS_PATH)
+
+def load_accounts():
+    """imap_credentials.json を読み込む (ファイルが更新されるまで解析結果をキャッシュする)"""
+    if not os.path.exists(CREDENTIALS_PATH):
+        return None
+
+    mtime = os.path.getmtime(CREDENTIALS_PATH)
+    with _accounts_lock:
+        if _accounts_cache['mtime'] != mtime:
+            with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as f:
+                _accounts_cache['accounts'] = json.load(f)
+            _accounts_cache['mtime'] = mtime
+        return _accounts_cache['accounts']
+
+def find_account(username):
+    """ユーザー名からアカウント設定を探す"""
+    accounts = load_accounts()
+    if not isinstance(accounts, list):
+        return None
+    for account in accounts:
+        if account['username'] == username:
+            return account
+    return None
+
+def _close_quietly(mail):
+    """接続をログアウトする (エラーは無視)"""
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+def _host_slot(account_config):
+    """接続先サーバーごとの同時接続数を制限するセマフォを返す
+
+    IDLE の待ち受け接続 (imap_idle) も同じセマフォで数える。
+    """
+    host = account_config.get('host')
+    with _pool_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            limit = account_config.get('max_connections') or HOST_CONNECTION_LIMITS.get(host, DEFAULT_HOST_CONNECTIONS)
+            slot = _host_slots[host] = threading.BoundedSemaphore(limit)
+            _host_limits[host] = limit
+        return slot
+
+def _host_limit(account_config):
+    """接続先サーバーに同時に使ってよい接続数 (_host_slot のセマフォの大きさ)"""
+    _host_slot(account_config)
+    return _host_limits[account_config.get('host')]
+
+@contextmanager
+def imap_session(account_config):
+    """アカウントごとにログイン済みの接続を使い回す (接続できなければNoneを渡す)
+
+    接続はアカウントごとに1本で、使用中は他のスレッドを待たせる。
+    同じサーバーへの同時使用数は _host_slot で制限する。
+    しばらく使っていない接続はNOOPで生存確認し、切れていれば再接続する。
+    """
+    username = account_config['username']
+    with _pool_lock:
+        entry = _sessions.setdefault(
+            username, {'conn': None, 'last_used': 0.0, 'lock': threading.Lock(), 'active_since': None}
+        )
+
+    # ロックの順序は必ず アカウント -> サーバー (逆順で取るとデッドロックする)
+    with entry['lock'], _host_slot(account_config):
+        entry['active_since'] = time.monotonic()
+        mail = entry['conn']
+        if mail is not None and time.monotonic() - entry['last_used'] > HEALTH_CHECK_INTERVAL:
+            try:
+                mail.noop()
+            except Exception:
+                _close_quietly(mail)
+                mail = None
+        if mail is None:
+            mail = get_imap_connection(account_config)
+        entry['conn'] = mail
+
+        try:
+            yield mail
+        except (imaplib.IMAP4.abort, OSError):
+            # 接続が切れている: 捨てて次回再接続する
+            if mail is not None:
+                _close_quietly(mail)
+            entry['conn'] = None
+            raise
+        finally:
+            entry['last_used'] = time.monotonic()
+            entry['active_since'] = None
+
+def _session_elapsed(username):
+    """アカウントの接続を使い始めてからの秒数 (使用中でなければNone)"""
+    entry = _sessions.get(username)
+    if entry is None or entry['active_since'] is None:
+        return None
+    return time.monotonic() - entry['active_since']
+
+def _abort_session(username):
+    """使用中の接続のソケットを切断し、ブロックしている送受信をエラーで終わらせる"""
+    entry = _sessions.get(username)
+    mail = entry['conn'] if entry else None
+    if mail is None:
+        return
+    try:
+        mail.sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+
+def close_all_sessions():
+    """プール中の接続をすべてログアウトする"""
+    with _pool_lock:
+        entries = list(_sessions.values())
+    for entry in entries:
+        with entry['lock']:
+            if entry['conn'] is not None:
+                _close_quietly(entry['conn'])
+                entry['conn'] = None
+
+atexit.register(close_all_sessions)
+
+def _ensure_inbox(mail):
+    """INBOXを選択する (すでに選択済みなら何もしない)"""
+    if mail.state != 'SELECTED':
+        mail.select('INBOX')
+
 def decode_header_value(header_value):
     """メールヘッダーのデコード処理"""
     if not header_value:
@@ -62,53 +293,63 @@ def get_body_snippet(msg):
     
     return " ".join(body.split())[:100]
 
-def fetch_all_unread_ids(mail, account_prefix):
-    """指定アカウントの未読IDを取得 (prefixを付与してユニークにする)"""
-    mail.select('INBOX')
-    status, data = mail.search(None, 'UNSEEN')
+def iter_unread_id_pages(mail, account_prefix, page_size=models.SYNC_CHUNK_SIZE):
+    """選択中のメールボックスの未読UIDを一定件数ごとのリストで順に返す (prefixを付与してユニークにする)
+
+    シーケンス番号は EXPUNGE でずれるため、必ず UID で扱う。
+    UIDは届いた順に増えるので、大きい(新しい)順に返す。
+    """
+    status, data = mail.uid('search', None, 'UNSEEN')
     if status != 'OK':
-        return set()
+        # 一覧が取れないまま既読判定すると全件削除になるため、例外にして同期を中断する
+        raise imaplib.IMAP4.error(f"UID SEARCH UNSEEN 失敗: {status}")
 
-    raw_ids = data[0].split()
-    # 他のアカウントとIDが被らないよう、プレフィックスにメールアドレスなどを含める
-    return {f"{account_prefix}_{uid.decode()}" for uid in raw_ids}
+    raw_ids = sorted(data[0].split(), key=int, reverse=True)
+    for i in range(0, len(raw_ids), page_size):
+        # 他のアカウントとIDが被らないよう、プレフィックスにメールアドレスなどを含める
+        yield [f"{account_prefix}_{uid.decode()}" for uid in raw_ids[i:i + page_size]]
 
-def fetch_details_and_save(mail, target_ids_with_prefix, account_config, account_prefix):
-    """詳細を取得して保存"""
-    if not target_ids_with_prefix:
-        return
+def fetch_details(mail, target_ids_with_prefix, account_config, account_prefix):
+    """詳細を取得する
 
+    (保存するメールのリスト, 処理済みのIDのリスト, 受信バイト数) を返す (backfill.run 用)。
+    削除済みや既読になっていたメールは保存せずに処理済みとし、
+    それ以外のエラーのメールは次回もう一度取得する。
+    """
     service_name = f"imap:{account_config['username']}"
     email_data_list = []
-    count = 0
+    done_ids = []
+    received_bytes = 0
 
     prefix_len = len(account_prefix) + 1 
-    
-    target_pairs = [] 
-    for tid in target_ids_with_prefix:
-        uid = tid[prefix_len:]
-        target_pairs.append((tid, uid))
-
-    for db_id, uid in target_pairs:
-        if count >= 10: 
-            print(f"[{account_config['username']}] 上限(10件)のため中断")
-            break
+
+    for db_id in target_ids_with_prefix:
+        uid = db_id[prefix_len:]
 
         try:
-            # フラグ情報も同時に取得するため (RFC822 FLAGS) とする
-            status, data = mail.fetch(uid, '(RFC822 FLAGS)')
-            if status != 'OK' or not data or data[0] is None:
+            # BODY.PEEK[] で取得する (RFC822 だとサーバー側で既読になってしまう)
+            # フラグ情報も同時に取得するため FLAGS も指定する
+            status, data = mail.uid('fetch', uid, '(FLAGS BODY.PEEK[])')
+            if status != 'OK':
+                continue
+            if not data or data[0] is None or not isinstance(data[0], tuple):
+                # 該当するUIDが無い (取得待ちの間に削除された)
+                done_ids.append(db_id)
                 continue
 
-            # data構造の解析: [ (b'SEQ (FLAGS (...) RFC822 {LEN}', b'BODY...'), b')' ]
-            # フラグは通常 data[0][0] のバイト列の中に含まれる
-            response_header = data[0][0] 
+            # data構造の解析: [ (b'SEQ (UID n FLAGS (...) BODY[] {LEN}', b'BODY...'), b')' ]
+            # フラグは通常 data[0][0] に含まれるが、本文の後ろ(b' FLAGS (...))')に来るサーバーもある
             raw_email = data[0][1]
+            received_bytes += len(raw_email)
+            flags = parse_fetch_response(data).get(uid, {}).get('flags') or []
+
+            if b'\\Seen' in flags:
+                # 取得待ちの間に既読になった
+                done_ids.append(db_id)
+                continue
             
             # フラグ判定: \Flagged が含まれているか
-            # response_header は bytes なので b'\\Flagged' を探す
-            is_flagged = b'\\Flagged' in response_header
-            db_status = 2 if is_flagged else 0
+            db_status = _status_from_flags(flags)
 
             msg = email.message_from_bytes(raw_email)
 
@@ -136,15 +377,173 @@ def fetch_details_and_save(mail, target_ids_with_prefix, account_config, account
                 'status': db_status
             })
             
+            done_ids.append(db_id)
+            
             status_str = "★重要" if db_status == 2 else "未読"
             print(f"[{account_config['username']}] 取得: {subject[:15]}... [{status_str}]")
-            count += 1
 
+        except (imaplib.IMAP4.abort, OSError) as e:
+            # 接続が切れた: 取得済みの分だけ返して打ち切る
+            print(f"接続エラー(UID: {uid}): {e}")
+            break
         except Exception as e:
             print(f"エラー(UID: {uid}): {e}")
 
-    if email_data_list:
-        models.save_emails(email_data_list)
+    return email_data_list, done_ids, received_bytes
+
+def backfill_account(mail, account_config, account_prefix, service_key, budget=None):
+    """取得待ちの新着メールを新しい順に、上限(budget)まで取得して保存する"""
+    fetch_chunk = lambda ids: fetch_details(mail, ids, account_config, account_prefix)
+    return backfill.run(service_key, fetch_chunk, BACKFILL_CHUNK_SIZE, budget)
+
+# FETCH 応答の1件目の開始 (imaplib は "* " を取り除いて "12 (UID ..." の形で返す)
+_FETCH_START_RE = re.compile(rb'\d+ \(')
+# 応答途中のリテラル {長さ} (中身は別の要素で渡される)
+_LITERAL_RE = re.compile(rb'\{\d+\}$')
+
+def _iter_fetch_texts(data):
+    """UID FETCH の応答(imaplib の data)を、メール1件ごとの属性リストの文字列にまとめて返す
+
+    リテラル(本文など)は中身を読み飛ばして "" に置き換える。
+    """
+    current = None
+    for item in data or []:
+        if item is None:
+            continue
+        piece = item[0] if isinstance(item, tuple) else item
+        if isinstance(item, tuple):
+            piece = _LITERAL_RE.sub(b'""', piece)
+        if _FETCH_START_RE.match(piece):
+            if current is not None:
+                yield bytes(current)
+            current = bytearray(piece)
+        elif current is not None:
+            current += piece
+    if current is not None:
+        yield bytes(current)
+
+def _skip_quoted(text, i):
+    """text[i] の " から始まる文字列の終わりの次の位置を返す"""
+    i += 1
+    while i < len(text):
+        c = text[i]
+        if c == 0x5c:  # バックスラッシュ
+            i += 2
+            continue
+        if c == 0x22:  # "
+            return i + 1
+        i += 1
+    return i
+
+def _read_fetch_value(text, i):
+    """text[i] から始まる値を1つ読み、(値, 次の位置) を返す (括弧の値は中身を返す)"""
+    c = text[i]
+    if c == 0x28:  # (
+        depth = 0
+        start = i
+        while i < len(text):
+            c = text[i]
+            if c == 0x22:
+                i = _skip_quoted(text, i)
+                continue
+            if c == 0x28:
+                depth += 1
+            elif c == 0x29:  # )
+                depth -= 1
+                if depth == 0:
+                    return text[start + 1:i], i + 1
+            i += 1
+        return text[start + 1:], i
+    if c == 0x22:
+        end = _skip_quoted(text, i)
+        return text[i + 1:end - 1], end
+    end = i
+    while end < len(text) and text[end] not in b' )':
+        end += 1
+    return text[i:end], end
+
+def _read_fetch_name(text, i):
+    """属性名を読む (BODY[HEADER.FIELDS (SUBJECT)] のような [] 内の空白も含める)"""
+    end = i
+    depth = 0
+    while end < len(text):
+        c = text[end]
+        if c == 0x5b:  # [
+            depth += 1
+        elif c == 0x5d:  # ]
+            depth -= 1
+        elif c == 0x20 and depth == 0:
+            break
+        end += 1
+    return text[i:end].upper(), end
+
+def parse_fetch_attributes(text):
+    """"12 (UID 123 FLAGS (\\Seen) ...)" の形の1件分を {属性名: 値(bytes)} にする"""
+    match = _FETCH_START_RE.match(text)
+    if not match:
+        return {}
+    attributes = {}
+    i = match.end()
+    n = len(text)
+    while i < n:
+        while i < n and text[i] == 0x20:
+            i += 1
+        if i >= n or text[i] == 0x29:
+            break
+        name, i = _read_fetch_name(text, i)
+        while i < n and text[i] == 0x20:
+            i += 1
+        if i >= n:
+            break
+        attributes[name], i = _read_fetch_value(text, i)
+    return attributes
+
+def parse_fetch_response(data):
+    """UID FETCH の応答から {uid: {'flags', 'size', 'modseq'}} を作る (応答の長さに比例する時間で処理する)
+
+    uid は文字列、flags はフラグ(bytes)のリスト。応答に含まれない項目は None になる。
+    """
+    result = {}
+    for text in _iter_fetch_texts(data):
+        attributes = parse_fetch_attributes(text)
+        uid = attributes.get(b'UID')
+        if uid is None or not uid.isdigit():
+            continue
+        flags = attributes.get(b'FLAGS')
+        size = attributes.get(b'RFC822.SIZE')
+        modseq = attributes.get(b'MODSEQ')
+        result[uid.decode()] = {
+            'flags': flags.split() if flags is not None else None,
+            'size': int(size) if size is not None and size.isdigit() else None,
+            'modseq': int(modseq.strip()) if modseq is not None and modseq.strip().isdigit() else None,
+        }
+    return result
+
+def iter_uid_sets(uids, max_length=MAX_UID_SET_LENGTH):
+    """UIDのリストを "1:5,8,10:12" の形のUIDセットに圧縮し、max_length 文字以下ごとに分けて返す
+
+    連続したUIDは a:b の範囲にまとめる。1つのコマンドが長くなりすぎるとサーバーに拒否されるため、
+    長くなる場合は複数のセットに分ける。
+    """
+    ordered = sorted({int(uid) for uid in uids})
+    parts = []
+    length = 0
+    i = 0
+    while i < len(ordered):
+        # 連続している範囲を探す
+        j = i
+        while j + 1 < len(ordered) and ordered[j + 1] == ordered[j] + 1:
+            j += 1
+        part = str(ordered[i]) if i == j else f"{ordered[i]}:{ordered[j]}"
+        if parts and length + 1 + len(part) > max_length:
+            yield ','.join(parts)
+            parts = []
+            length = 0
+        length += len(part) + (1 if parts else 0)
+        parts.append(part)
+        i = j + 1
+    if parts:
+        yield ','.join(parts)
 
 def update_flagged_status(mail, existing_ids_with_prefix, account_prefix):
     """既存メールのフラグ状態をIMAPサーバーと同期する"""
@@ -153,317 +552,379 @@ def update_flagged_status(mail, existing_ids_with_prefix, account_prefix):
 
     prefix_len = len(account_prefix) + 1
     
-    # UIDリストを作成
-    uids = []
-    uid_map = {} # uid -> db_id
-    for tid in existing_ids_with_prefix:
-        uid = tid[prefix_len:]
-        uids.append(uid)
-        uid_map[uid] = tid
-
-    # まとめてフラグ取得 (UID FETCH 1,2,3 (FLAGS))
-    if not uids:
-        return
+    # UID -> DB上のID
+    uid_map = {tid[prefix_len:]: tid for tid in existing_ids_with_prefix}
 
-    uid_str = ",".join(uids)
+    # まとめてフラグ取得 (UID FETCH 1:3,7 (UID FLAGS))
+    status_map = {}
     try:
-        status, data = mail.uid('fetch', uid_str, '(FLAGS)')
-        if status == 'OK':
-            for item in data:
-                if not item or item == b')': continue
-                
-                # item例: b'123 (UID 123 FLAGS (\Seen \Flagged))'
-                # parseが面倒なので簡易的にチェック
-                
-                # UIDを抽出
-                item_str = item.decode('utf-8', errors='ignore') if isinstance(item, bytes) else str(item)
-                
-                # UID特定 (簡易実装: 文字列内から探す)
-                # 正確には正規表現などで "UID <number>" を抜くべきだが、
-                # ここではループ中のUIDを使ってマッチングする
-                target_uid = None
-                for u in uids:
-                    if f"UID {u}" in item_str:
-                        target_uid = u
-                        break
-                
-                if target_uid:
-                    is_flagged = '\\Flagged' in item_str
-                    new_status = 2 if is_flagged else 0
-                    
-                    db_id = uid_map[target_uid]
-                    models.update_email_status_by_message_id(db_id, new_status)
+        for uid_set in iter_uid_sets(uid_map):
+            status, data = mail.uid('fetch', uid_set, '(UID FLAGS)')
+            if status != 'OK':
+                continue
+            for uid, info in parse_fetch_response(data).items():
+                if uid in uid_map and info['flags'] is not None:
+                    status_map[uid_map[uid]] = _status_from_flags(info['flags'])
                     
     except Exception as e:
         print(f"フラグ同期エラー: {e}")
 
-def sync_one_account(account_config):
-    """1つのアカウントについて同期処理を行う"""
-    username = account_config['username']
-    print(f"--- {username} の同期開始 ---")
+    # 変わったものだけを1回のトランザクションでまとめて更新
+    models.apply_status_map(status_map)
+
+def _parse_uid_set(uid_set):
+    """'1:3,7' のようなUIDセットを展開して返す"""
+    for part in uid_set.split(','):
+        if not part:
+            continue
+        if ':' in part:
+            start, end = sorted(int(x) for x in part.split(':'))
+            yield from range(start, end + 1)
+        else:
+            yield int(part)
+
+def _read_mailbox_state(mail):
+    """SELECT の応答から UIDVALIDITY / UIDNEXT / HIGHESTMODSEQ を読み取る"""
+    state = {}
+    for name in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+        typ, data = mail.response(name)
+        if data and data[-1] is not None:
+            try:
+                state[name.lower()] = int(data[-1])
+            except ValueError:
+                pass
+    return state
+
+def _status_from_flags(flags):
+    """IMAPのフラグからDBのステータスを求める (\Flagged なら2)"""
+    return 2 if b'\\Flagged' in flags else 0
+
+def _sync_unseen_diff(mail, account_config, account_prefix, service_key, changed_flags=None):
+    """未読UIDの一覧とDBを突き合わせて同期する (新着は取得待ちに入れる)
+
+    changed_flags (CHANGEDSINCE の結果) があれば、既存メールのフラグはそこから反映し、
+    無ければ既存メール全件のフラグをサーバーに問い合わせる。
+    """
+    prefix_len = len(account_prefix) + 1
 
-    mail = get_imap_connection(account_config)
-    if not mail:
+    # 1. サーバー(IMAP)にある未読IDを一時テーブルへ書き込み、差分はSQLで計算
+    pages = metrics.timed_iter(
+        iter_unread_id_pages(mail, account_prefix), 'sync_phase_seconds', provider='imap', phase='list'
+    )
+    with models.staged_server_ids(service_key, pages):
+        # 2. 既読になったメールを削除
+        with metrics.timer('sync_phase_seconds', provider='imap', phase='diff'):
+            for read_ids in models.iter_diff_ids(service_key, 'gone'):
+                print(f"既読検知: {len(read_ids)} 件 -> 削除")
+                models.delete_emails(read_ids)
+
+        # 3. 既存メールのフラグ同期 (新着を保存する前に対象を確定させる)
+        with metrics.timer('sync_phase_seconds', provider='imap', phase='reconcile_flags'):
+            for existing_ids in models.iter_diff_ids(service_key, 'existing'):
+                if changed_flags is None:
+                    update_flagged_status(mail, existing_ids, account_prefix)
+                else:
+                    models.apply_status_map({
+                        tid: _status_from_flags(changed_flags[tid[prefix_len:]])
+                        for tid in existing_ids if tid[prefix_len:] in changed_flags
+                    })
+
+        # 4. 新着メールを取得待ちに入れる (一覧はUIDの大きい順なので、新しいメールから取得される)
+        with metrics.timer('sync_phase_seconds', provider='imap', phase='enqueue_new'):
+            new_count = models.count_diff_ids(service_key, 'new')
+            if new_count:
+                print(f"新着検知: {new_count} 件 -> 取得待ちに追加")
+            models.enqueue_backfill_from_staging(service_key)
+
+def _fetch_changed_flags(mail, saved, qresync):
+    """前回の HIGHESTMODSEQ 以降にフラグが変わったメールと、削除(VANISHED)されたUIDを取得する"""
+    last_uid = saved['uidnext'] - 1
+    if last_uid < 1:
+        return {}, []
+
+    modifier = f"(CHANGEDSINCE {saved['highestmodseq']}{' VANISHED' if qresync else ''})"
+    typ, data = mail.uid('fetch', f"1:{last_uid}", f"(UID FLAGS) {modifier}")
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH CHANGEDSINCE 失敗: {typ}")
+    changed = {uid: info['flags'] or [] for uid, info in parse_fetch_response(data).items()}
+
+    vanished = []
+    if qresync:
+        typ, vanished_data = mail.response('VANISHED')
+        for item in vanished_data or []:
+            if item is None:
+                continue
+            text = item.decode() if isinstance(item, bytes) else str(item)
+            uid_set = text.replace('(EARLIER)', '').strip()
+            vanished.extend(str(uid) for uid in _parse_uid_set(uid_set))
+    return changed, vanished
+
+def _sync_qresync(mail, saved, current, account_config, account_prefix, service_key):
+    """QRESYNC: 変更されたフラグ・削除されたUID・新しいUIDだけで同期する (新着は取得待ちに入れる)"""
+    if saved['uidnext'] == current.get('uidnext') and saved['highestmodseq'] == current.get('highestmodseq'):
+        print("変更はありません")
         return
 
+    with metrics.timer('sync_phase_seconds', provider='imap', phase='list'):
+        changed, vanished = _fetch_changed_flags(mail, saved, qresync=True)
+
+        # 前回以降に届いた未読メール (UID n:* は最大UIDを必ず含むので範囲を確認する)
+        typ, data = mail.uid('search', None, f"UID {saved['uidnext']}:* UNSEEN")
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"UID SEARCH 失敗: {typ}")
+        new_uids = [uid.decode() for uid in data[0].split() if int(uid) >= saved['uidnext']]
+
+    with metrics.timer('sync_phase_seconds', provider='imap', phase='diff'):
+        _apply_qresync_changes(changed, vanished, new_uids, account_prefix, service_key)
+
+def _apply_qresync_changes(changed, vanished, new_uids, account_prefix, service_key):
+    """QRESYNC で取得した変更 (フラグ・削除・新着) をDBと取得待ちに反映する"""
+    to_id = lambda uid: f"{account_prefix}_{uid}"
+    touched = [to_id(uid) for uid in itertools.chain(changed, vanished)]
+    local_ids = models.get_existing_message_ids(touched)
+    # 反映待ちの操作があるメールはサーバー側がまだ古いので触らない
+    pending_ids = models.get_pending_message_ids(touched)
+
+    read_ids = [to_id(uid) for uid in vanished if to_id(uid) in local_ids]
+    status_map = {}
+    for uid, flags in changed.items():
+        tid = to_id(uid)
+        if tid in pending_ids:
+            continue
+        if b'\\Seen' in flags:
+            if tid in local_ids:
+                read_ids.append(tid)
+        elif tid in local_ids:
+            status_map[tid] = _status_from_flags(flags)
+        elif uid not in new_uids:
+            # 既読から未読に戻されたメール
+            new_uids.append(uid)
+
+    if read_ids:
+        print(f"既読検知: {len(read_ids)} 件 -> 削除")
+        models.delete_emails(read_ids)
+    models.apply_status_map(status_map)
+    if new_uids:
+        print(f"新着検知: {len(new_uids)} 件 -> 取得待ちに追加")
+        models.enqueue_backfill(service_key, [to_id(uid) for uid in sorted(new_uids, key=int, reverse=True)])
+
+def sync_one_account(account_config, budget=None):
+    """1つのアカウントについて同期処理を行う
+
+    UIDVALIDITY / UIDNEXT / HIGHESTMODSEQ をメールボックスごとに保存しておき、
+    QRESYNC 対応サーバーでは変更分だけ、CONDSTORE 対応サーバーではフラグの変更分だけを取得する。
+    新着は取得待ちに入れ、budget (backfill.make_budget) の範囲で新しい順に取得する。
+
+    結果を {'account', 'status', 'elapsed', 'error'} で返す。
+    status は 'ok' / 'partial'(上限で新着を取得待ちに残した) / 'error' のいずれか。
+    """
+    username = account_config['username']
+    print(f"--- {username} の同期開始 ---")
+    started = time.monotonic()
+    result = {'account': username, 'status': 'ok', 'error': None}
+
     account_prefix = f"imap_{username}"
     service_key = f"imap:{username}"
+    state_key = f"{service_key}:INBOX"
 
     try:
-        # 1. サーバー(IMAP)にある未読ID
-        server_unread_ids = fetch_all_unread_ids(mail, account_prefix)
-
-        # 2. ローカル(DB)にある このアカウントの IDのみを取得
-        local_stored_ids = models.get_message_ids_by_service(service_key)
-
-        # 3. 差分計算
-        new_ids = server_unread_ids - local_stored_ids
-        read_ids = local_stored_ids - server_unread_ids
-        existing_ids = server_unread_ids & local_stored_ids
-
-        # 4. DB更新
-        if read_ids:
-            print(f"既読検知: {len(read_ids)} 件 -> 削除")
-            models.delete_emails(read_ids)
-        
-        if new_ids:
-            print(f"新着検知: {len(new_ids)} 件 -> 取得")
-            fetch_details_and_save(mail, new_ids, account_config, account_prefix)
-
-        # 5. 既存メールのフラグ同期
-        if existing_ids:
-            update_flagged_status(mail, existing_ids, account_prefix)
+        with imap_session(account_config) as mail:
+            if not mail:
+                result.update(status='error', error='接続できませんでした')
+                return result
+
+            typ, _ = mail.select('INBOX')
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"SELECT INBOX 失敗: {typ}")
+            current = _read_mailbox_state(mail)
+            extensions = getattr(mail, 'sync_extensions', set())
+
+            saved = models.get_sync_state(state_key)
+            saved = json.loads(saved) if saved else None
+            if saved is None or saved.get('uidvalidity') != current.get('uidvalidity'):
+                # UIDが振り直された(または以前のシーケンス番号で保存されている):
+                # 保存済みのIDは別のメールを指している可能性があるので、消してから全件同期する
+                if saved is not None:
+                    print("UIDVALIDITY が変わったため、全件同期します")
+                saved = {'uidvalidity': current.get('uidvalidity')}
+                # 反映待ちの操作も古いUIDを指しているので捨てる (送ると別のメールを既読・削除してしまう)
+                with models.transaction():
+                    stale_ids = models.get_message_ids_by_service(service_key)
+                    if stale_ids:
+                        models.delete_emails(stale_ids)
+                    models.clear_backfill(service_key)
+                    voided = models.clear_actions(service_key)
+                    models.set_sync_state(state_key, json.dumps(saved))
+                if voided:
+                    print(f"UIDVALIDITY の変更で反映待ちの操作 {voided} 件を破棄しました")
+
+            can_use_modseq = (
+                'CONDSTORE' in extensions and 'highestmodseq' in current
+                and 'highestmodseq' in saved and 'uidnext' in saved
+            )
+            if can_use_modseq and 'QRESYNC' in extensions:
+                _sync_qresync(mail, saved, current, account_config, account_prefix, service_key)
+            elif can_use_modseq:
+                with metrics.timer('sync_phase_seconds', provider='imap', phase='list'):
+                    changed, _ = _fetch_changed_flags(mail, saved, qresync=False)
+                _sync_unseen_diff(mail, account_config, account_prefix, service_key, changed)
+            else:
+                _sync_unseen_diff(mail, account_config, account_prefix, service_key)
+
+            # 新着は取得待ちに保存済みなので、状態を進めてよい
+            models.set_sync_state(state_key, json.dumps(current))
+
+            # 見つかった新着の詳細を、前回の残りも含めて新しい順に取得する
+            progress = backfill_account(mail, account_config, account_prefix, service_key, budget)
+            if progress['remaining']:
+                result['status'] = 'partial'
             
     except Exception as e:
         print(f"同期エラー: {e}")
+        result.update(status='error', error=str(e))
     finally:
-        try:
-            mail.logout()
-        except:
-            pass
+        result['elapsed'] = round(time.monotonic() - started, 2)
+    return result
 
-def sync_imap_all():
-    """全IMAPアカウントを同期するメイン関数"""
-    if not os.path.exists(CREDENTIALS_PATH):
+def _sync_worker(account_config, budget_limits):
+    """ワーカースレッドで1アカウントを同期する"""
+    try:
+        return sync_one_account(account_config, backfill.make_budget(**budget_limits))
+    finally:
+        # ワーカースレッドはプール終了時に消えるので、DB接続を返却しておく
+        models.release_connection()
+
+def sync_imap_all(budget_limits=None):
+    """全IMAPアカウントを並列に同期するメイン関数
+
+    同時に同期するアカウント数は SYNC_WORKERS、同じサーバーへの接続数は
+    HOST_CONNECTION_LIMITS で制限する。ACCOUNT_SYNC_TIMEOUT を超えたアカウントは
+    接続を切って打ち切る。アカウントごとの結果をまとめて返す。
+    budget_limits は backfill.make_budget の引数の辞書で、アカウントごとに取得量の上限を作る。
+    """
+    budget_limits = budget_limits or {}
+    accounts = load_accounts()
+    if accounts is None:
         print("設定ファイルが見つかりません")
-        return
-
-    with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as f:
-        accounts = json.load(f)
+        return None
 
     if not isinstance(accounts, list):
         print("エラー: imap_credentials.json はリスト形式である必要があります。")
-        return
-
-    for account in accounts:
-        sync_one_account(account)
+        return None
 
-def mark_as_read(service_name, message_id):
-    """IMAPのメールを既読にする"""
+    started = time.monotonic()
+    results = []
+    if accounts:
+        timed_out = set()
+        with ThreadPoolExecutor(max_workers=min(SYNC_WORKERS, len(accounts)), thread_name_prefix='imap-sync') as executor:
+            futures = {executor.submit(_sync_worker, account, budget_limits): account['username'] for account in accounts}
+            pending = set(futures)
+            while pending:
+                _, pending = wait(pending, timeout=1.0)
+                # 時間切れのアカウントは接続を切る (ブロック中の送受信がエラーになって同期が終わる)
+                for future in pending:
+                    username = futures[future]
+                    elapsed = _session_elapsed(username)
+                    if username not in timed_out and elapsed is not None and elapsed > ACCOUNT_SYNC_TIMEOUT:
+                        print(f"[{username}] {ACCOUNT_SYNC_TIMEOUT}秒を超えたため同期を打ち切ります")
+                        timed_out.add(username)
+                        _abort_session(username)
+
+            for future, username in futures.items():
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'account': username, 'status': 'error', 'error': str(e), 'elapsed': None}
+                if username in timed_out:
+                    result['status'] = 'timeout'
+                results.append(result)
+
+    report = {
+        'accounts': results,
+        'ok': sum(1 for r in results if r['status'] == 'ok'),
+        'partial': sum(1 for r in results if r['status'] == 'partial'),
+        'failed': sum(1 for r in results if r['status'] in ('error', 'timeout')),
+        'elapsed': round(time.monotonic() - started, 2),
+    }
+    print(f"IMAP同期完了: 成功 {report['ok']} / 途中まで {report['partial']} / 失敗 {report['failed']} ({report['elapsed']}秒)")
+    for result in results:
+        if result['status'] in ('error', 'timeout'):
+            print(f"  [{result['account']}] {result['status']}: {result['error']}")
+    return report
+
+def _get_target(service_name, message_id):
+    """service名とmessage_idから (アカウント設定, UID) を求める (見つからなければ (None, None))"""
     if not service_name.startswith('imap:'):
-        return False
-        
-    target_username = service_name.replace('imap:', '')
-    
-    if not os.path.exists(CREDENTIALS_PATH):
-        return False
+        return None, None
 
-    with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as f:
-        accounts = json.load(f)
-        
-    target_account = None
-    for account in accounts:
-        if account['username'] == target_username:
-            target_account = account
-            break
-            
+    target_username = service_name.replace('imap:', '')
+    target_account = find_account(target_username)
     if not target_account:
         print(f"アカウント設定が見つかりません: {target_username}")
-        return False
-        
-    mail = get_imap_connection(target_account)
-    if not mail:
-        return False
-        
-    try:
-        mail.select('INBOX')
-        
-        prefix = f"imap_{target_username}_"
-        if not message_id.startswith(prefix):
-             print(f"ID形式エラー: {message_id}")
-             return False
-             
-        uid = message_id[len(prefix):]
-        
-        mail.store(uid, '+FLAGS', '\\Seen')
-        print(f"IMAP既読化成功: {uid} ({target_username})")
-        return True
-        
-    except Exception as e:
-        print(f"IMAP既読化エラー: {e}")
-        return False
-    finally:
-        try:
-            mail.logout()
-        except:
-            pass
+        return None, None
 
-def mark_as_important(service_name, message_id):
-    """IMAPのメールにフラグ(\Flagged)を立てる"""
-    if not service_name.startswith('imap:'):
-        return False
-        
-    target_username = service_name.replace('imap:', '')
-    
-    if not os.path.exists(CREDENTIALS_PATH):
-        return False
+    # message_id は "imap_user@example.com_123" の形式
+    prefix = f"imap_{target_username}_"
+    if not message_id.startswith(prefix):
+        print(f"ID形式エラー: {message_id}")
+        return None, None
 
-    with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as f:
-        accounts = json.load(f)
-        
+    return target_account, message_id[len(prefix):]
+
+def _store_bulk(service_name, message_ids, flag_op, flag, label, expunge=False):
+    """複数メールのフラグを UID STORE 1回でまとめて変更し、成功したIDのリストを返す"""
+    message_ids = list(message_ids)
     target_account = None
-    for account in accounts:
-        if account['username'] == target_username:
+    uid_map = {}  # uid -> message_id
+    for message_id in message_ids:
+        account, uid = _get_target(service_name, message_id)
+        if account:
             target_account = account
-            break
-            
-    if not target_account:
-        print(f"アカウント設定が見つかりません: {target_username}")
-        return False
-        
-    mail = get_imap_connection(target_account)
-    if not mail:
-        return False
-        
+            uid_map[uid] = message_id
+    if not uid_map:
+        return []
+
+    succeeded = []
     try:
-        mail.select('INBOX')
-        
-        prefix = f"imap_{target_username}_"
-        if not message_id.startswith(prefix):
-             print(f"ID形式エラー: {message_id}")
-             return False
-             
-        uid = message_id[len(prefix):]
-        
-        mail.store(uid, '+FLAGS', '\\Flagged')
-        print(f"IMAP重要設定(フラグ)成功: {uid} ({target_username})")
-        return True
-        
+        with imap_session(target_account) as mail:
+            if not mail:
+                return []
+            _ensure_inbox(mail)
+            # UIDセットは範囲に圧縮し、長すぎる場合は分けて送る
+            for uid_set in iter_uid_sets(uid_map):
+                typ, _ = mail.uid('store', uid_set, flag_op, flag)
+                if typ != 'OK':
+                    print(f"IMAP{label}エラー: UID STORE {typ}")
+                    continue
+                if expunge:
+                    # UIDPLUS があれば対象のメールだけを消す (無ければ \Deleted の付いたメールをすべて消す)
+                    if 'UIDPLUS' in mail.capabilities:
+                        mail.uid('expunge', uid_set)
+                    else:
+                        mail.expunge()
+                succeeded.extend(uid_map[str(uid)] for uid in _parse_uid_set(uid_set))
     except Exception as e:
-        print(f"IMAP重要設定エラー: {e}")
-        return False
-    finally:
-        try:
-            mail.logout()
-        except:
-            pass
+        print(f"IMAP{label}エラー: {e}")
 
-def mark_as_unimportant(service_name, message_id):
-    """IMAPのメールからフラグ(\Flagged)を外す"""
-    if not service_name.startswith('imap:'):
-        return False
-        
-    target_username = service_name.replace('imap:', '')
-    
-    if not os.path.exists(CREDENTIALS_PATH):
-        return False
+    print(f"IMAP{label}成功: {len(succeeded)}/{len(uid_map)} 件 ({target_account['username']})")
+    return succeeded
 
-    with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as f:
-        accounts = json.load(f)
-        
-    target_account = None
-    for account in accounts:
-        if account['username'] == target_username:
-            target_account = account
-            break
-            
-    if not target_account:
-        print(f"アカウント設定が見つかりません: {target_username}")
-        return False
-        
-    mail = get_imap_connection(target_account)
-    if not mail:
-        return False
-        
-    try:
-        mail.select('INBOX')
-        
-        prefix = f"imap_{target_username}_"
-        if not message_id.startswith(prefix):
-             print(f"ID形式エラー: {message_id}")
-             return False
-             
-        uid = message_id[len(prefix):]
-        
-        # フラグを外す (-FLAGS)
-        mail.store(uid, '-FLAGS', '\\Flagged')
-        print(f"IMAP重要解除(フラグ削除)成功: {uid} ({target_username})")
-        return True
-        
-    except Exception as e:
-        print(f"IMAP重要解除エラー: {e}")
-        return False
-    finally:
-        try:
-            mail.logout()
-        except:
-            pass
+def mark_as_read_bulk(service_name, message_ids):
+    """IMAPの複数メールをまとめて既読にする"""
+    return _store_bulk(service_name, message_ids, '+FLAGS', '\\Seen', '既読化')
+
+def mark_as_important_bulk(service_name, message_ids):
+    """IMAPの複数メールにまとめてフラグ(\Flagged)を立てる"""
+    return _store_bulk(service_name, message_ids, '+FLAGS', '\\Flagged', '重要設定(フラグ)')
+
+def mark_as_unimportant_bulk(service_name, message_ids):
+    """IMAPの複数メールからまとめてフラグ(\Flagged)を外す"""
+    return _store_bulk(service_name, message_ids, '-FLAGS', '\\Flagged', '重要解除(フラグ削除)')
+
+def delete_email_bulk(service_name, message_ids):
+    """IMAPの複数メールにまとめて削除フラグを立てて削除する"""
+    return _store_bulk(service_name, message_ids, '+FLAGS', '\\Deleted', '削除', expunge=True)
 
 if __name__ == '__main__':
     models.init_db()
     sync_imap_all()
-
-def delete_email(service_name, message_id):
-    """IMAPのメールに削除フラグを立てて削除する"""
-    if not service_name.startswith('imap:'):
-        return False
-        
-    target_username = service_name.replace('imap:', '')
-    
-    if not os.path.exists(CREDENTIALS_PATH):
-        return False
-
-    with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as f:
-        accounts = json.load(f)
-        
-    target_account = None
-    for account in accounts:
-        if account['username'] == target_username:
-            target_account = account
-            break
-            
-    if not target_account:
-        print(f"アカウント設定が見つかりません: {target_username}")
-        return False
-        
-    mail = get_imap_connection(target_account)
-    if not mail:
-        return False
-        
-    try:
-        mail.select('INBOX')
-        
-        # message_id は "imap_user@example.com_123" の形式
-        prefix = f"imap_{target_username}_"
-        if not message_id.startswith(prefix):
-             print(f"ID形式エラー: {message_id}")
-             return False
-             
-        uid = message_id[len(prefix):]
-        
-        # 削除フラグを立てる
-        mail.store(uid, '+FLAGS', '\\Deleted')
-        # サーバーによってはEXPUNGEが必要（完全に削除）
-        mail.expunge()
-        
-        print(f"IMAP削除成功: {uid} ({target_username})")
-        return True
-        
-    except Exception as e:
-        print(f"IMAP削除エラー: {e}")
-        return False
-    finally:
-        try:
-            mail.logout()
-        except:
-            pass
@@ -0,0 +1,252 @@
+import select
+import ssl
+import threading
+import time
+import traceback
+
+import models
+import imap_fetcher
+
+# 設定
+IDLE_RENEW_INTERVAL = 25 * 60   # サーバーの29分タイムアウト前にIDLEを張り直す(秒)
+POLL_INTERVAL = 60              # IDLE非対応サーバーでNOOPを送る間隔(秒)
+STOP_CHECK_INTERVAL = 5         # 停止要求を確認する間隔(秒)
+RECONNECT_DELAY = 10            # 接続エラー後の再接続までの秒数 (失敗ごとに2倍)
+MAX_RECONNECT_DELAY = 600       # 再接続間隔の上限(秒)
+DEBOUNCE_SECONDS = 2            # 通知が続けて届く場合にまとめて同期するための待ち時間
+
+# 同期を起こすきっかけになる応答 (新着・削除・フラグ変更)
+EVENT_KEYWORDS = (b'EXISTS', b'EXPUNGE', b'FETCH', b'VANISHED')
+
+_stop_event = threading.Event()
+_threads = {}  # username -> Thread
+_lock = threading.Lock()
+_idle_counts = {}  # host -> 待ち受け専用の接続を張っている(張ろうとしている)数
+
+def _is_event(line):
+    """IDLE中に届いた行が同期のきっかけになる応答か"""
+    if not line.startswith(b'* '):
+        return False
+    words = line.split()
+    return any(keyword in words[1:3] for keyword in EVENT_KEYWORDS)
+
+def _has_idle(mail):
+    """サーバーがIDLEに対応しているか"""
+    typ, data = mail.capability()
+    return typ == 'OK' and bool(data) and data[0] is not None and b'IDLE' in data[0].upper().split()
+
+def _has_buffered_data(mail):
+    """imaplib の読み込みバッファ (mail.file) に、まだ読んでいない応答が残っているか
+
+    "+ idling" と "* N EXISTS" が同じパケットで届くと、後者はバッファに入ったままになり、
+    ソケットを select しても読めるようにならない。
+    peek() はバッファが空だとソケットから読もうとするので、その間だけノンブロッキングにする。
+    """
+    file = getattr(mail, 'file', None)
+    if file is None or not hasattr(file, 'peek'):
+        return False
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        return bool(file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+def _wait_readable(mail, timeout):
+    """ソケットに読める行が届くまで最大timeout秒待つ"""
+    # SSL側に復号済みのデータが残っていればすぐ読める
+    pending = getattr(mail.sock, 'pending', None)
+    if pending is not None and pending():
+        return True
+    if _has_buffered_data(mail):
+        return True
+    readable, _, _ = select.select([mail.sock], [], [], timeout)
+    return bool(readable)
+
+def idle_once(mail, tag=b'SNSIDLE'):
+    """IDLEを1回行い、変更通知があればTrueを返す
+
+    通知が届くか IDLE_RENEW_INTERVAL が経つと DONE を送って終了する。
+    (imaplib には IDLE が無いため、コマンドを直接送って応答を読む)
+    """
+    mail.send(tag + b' IDLE\r\n')
+    line = mail.readline()
+    if not line.startswith(b'+'):
+        raise imap_fetcher.imaplib.IMAP4.error(f"IDLE 開始失敗: {line!r}")
+
+    changed = False
+    deadline = time.monotonic() + IDLE_RENEW_INTERVAL
+    while not _stop_event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not _wait_readable(mail, min(remaining, STOP_CHECK_INTERVAL)):
+            continue
+        line = mail.readline()
+        if not line:
+            raise imap_fetcher.imaplib.IMAP4.abort("IDLE中に接続が切断されました")
+        if _is_event(line):
+            changed = True
+            break
+
+    # IDLEを終了し、タグ付きの完了応答まで読む (途中に届いた通知も拾う)
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imap_fetcher.imaplib.IMAP4.abort("IDLE終了時に接続が切断されました")
+        if line.startswith(tag + b' '):
+            if not line[len(tag) + 1:].upper().startswith(b'OK'):
+                raise imap_fetcher.imaplib.IMAP4.error(f"IDLE 終了失敗: {line!r}")
+            break
+        if _is_event(line):
+            changed = True
+    return changed
+
+def poll_once(mail):
+    """IDLE非対応サーバー用: NOOPを送り、変更通知があればTrueを返す"""
+    _stop_event.wait(POLL_INTERVAL)
+    if _stop_event.is_set():
+        return False
+    mail.noop()
+    changed = False
+    for key in ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED'):
+        if mail.untagged_responses.pop(key, None):
+            changed = True
+    return changed
+
+def _reserve_slot(account_config):
+    """待ち受け専用の接続に、サーバーの同時接続枠 (imap_fetcher._host_slot) を1つ取る
+
+    待ち受け接続は張っている間ずっと枠を使うので、同期や画面の操作用に必ず1つは残す
+    (サーバーごとの待ち受け接続は上限-1本まで)。残せないときは枠を取らずにNoneを返す。
+    枠が空くまで待つ間も停止要求を確認する。
+    """
+    host = account_config.get('host')
+    limit = imap_fetcher._host_limit(account_config)
+    with _lock:
+        if _idle_counts.get(host, 0) >= limit - 1:
+            return None
+        _idle_counts[host] = _idle_counts.get(host, 0) + 1
+
+    slot = imap_fetcher._host_slot(account_config)
+    while not _stop_event.is_set():
+        if slot.acquire(timeout=STOP_CHECK_INTERVAL):
+            return slot
+    _release_slot(account_config, None)
+    return None
+
+def _release_slot(account_config, slot):
+    """_reserve_slot で取った枠を返す"""
+    host = account_config.get('host')
+    if slot is not None:
+        slot.release()
+    with _lock:
+        _idle_counts[host] -= 1
+
+def _sync(account_config):
+    """通知を受けたアカウントだけを差分同期する"""
+    # 続けて届く通知をまとめるため少し待つ
+    _stop_event.wait(DEBOUNCE_SECONDS)
+    try:
+        imap_fetcher.sync_one_account(account_config)
+    finally:
+        models.release_connection()
+
+def listen(account_config):
+    """1つのアカウントの変更を待ち受け、通知があるたびに同期する (停止されるまで戻らない)
+
+    待ち受け専用の接続もサーバーの同時接続数 (HOST_CONNECTION_LIMITS) に数え、接続している間は枠を1つ使う。
+    枠を残せないサーバー (上限1本など) では専用の接続を張らず、POLL_INTERVAL ごとに差分同期する。
+    """
+    username = account_config['username']
+    delay = RECONNECT_DELAY
+
+    while not _stop_event.is_set():
+        slot = _reserve_slot(account_config)
+        if slot is None:
+            _stop_event.wait(POLL_INTERVAL)
+            if _stop_event.is_set():
+                break
+            try:
+                _sync(account_config)
+            except Exception as e:
+                print(f"[{username}] 同期エラー: {e}")
+            continue
+
+        # 待ち受け専用の接続を張る (操作用のプール接続とは別)
+        mail = imap_fetcher.get_imap_connection(account_config)
+        if not mail:
+            _release_slot(account_config, slot)
+            _stop_event.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            continue
+
+        failed = False
+        try:
+            typ, _ = mail.select('INBOX')
+            if typ != 'OK':
+                raise imap_fetcher.imaplib.IMAP4.error(f"SELECT INBOX 失敗: {typ}")
+            mail.untagged_responses.clear()
+            use_idle = _has_idle(mail)
+            print(f"[{username}] 待ち受け開始 ({'IDLE' if use_idle else 'NOOPポーリング'})")
+
+            # 接続が切れていた間の変更を取り込む
+            _sync(account_config)
+            delay = RECONNECT_DELAY
+
+            while not _stop_event.is_set():
+                changed = idle_once(mail) if use_idle else poll_once(mail)
+                if changed:
+                    print(f"[{username}] 変更を検知しました -> 同期します")
+                    _sync(account_config)
+        except Exception as e:
+            print(f"[{username}] 待ち受けエラー: {e} -> {delay}秒後に再接続します")
+            failed = True
+        finally:
+            imap_fetcher._close_quietly(mail)
+            _release_slot(account_config, slot)
+
+        if failed:
+            _stop_event.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+def _run(account_config):
+    """待ち受けスレッドの本体"""
+    try:
+        listen(account_config)
+    except Exception:
+        traceback.print_exc()
+
+def start(accounts=None):
+    """全IMAPアカウント(または指定したアカウント)の待ち受けスレッドを起動する"""
+    if accounts is None:
+        accounts = imap_fetcher.load_accounts()
+    if not isinstance(accounts, list):
+        return
+
+    _stop_event.clear()
+    with _lock:
+        for account in accounts:
+            username = account['username']
+            thread = _threads.get(username)
+            if thread is not None and thread.is_alive():
+                continue
+            thread = threading.Thread(target=_run, args=(account,), name=f'imap-idle-{username}', daemon=True)
+            _threads[username] = thread
+            thread.start()
+
+def stop():
+    """待ち受けスレッドを停止する (IDLE中のスレッドは STOP_CHECK_INTERVAL 以内に終了する)"""
+    _stop_event.set()
+
+if __name__ == '__main__':
+    models.init_db()
+    start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop()
@@ -0,0 +1,157 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# ヒストグラムのバケット
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# 計測する項目 (名前 -> 種類, 説明, バケット)
+# 名前には出力時に 'sns_' を付け、カウンターには '_total' を付ける
+METRICS = {
+    'provider_request_seconds': ('histogram', 'Gmail/Graph/IMAP の呼び出し1回の所要時間(秒)', LATENCY_BUCKETS),
+    'provider_request_errors': ('counter', 'Gmail/Graph/IMAP の呼び出しのエラー数', None),
+    'db_call_seconds': ('histogram', 'models のDB関数1回の所要時間(秒)', LATENCY_BUCKETS),
+    'db_call_errors': ('counter', 'models のDB関数のエラー数', None),
+    'queue_cache_reads': ('counter', 'キュー先頭・件数のキャッシュの読み込み回数 (result: hit/miss)', None),
+    'sync_phase_seconds': ('histogram', '同期の段階(list/diff/reconcile_flags/fetch_details など)ごとの所要時間(秒)', LATENCY_BUCKETS),
+    'sync_phase_errors': ('counter', '同期の段階ごとのエラー数', None),
+    'sync_seconds': ('histogram', 'サービスごとの同期1回の所要時間(秒)', LATENCY_BUCKETS),
+    'sync_runs': ('counter', 'サービスごとの同期回数 (outcome: new_mail/no_change/error)', None),
+    'sync_new_messages': ('histogram', '同期1回で保存した新着メールの件数', COUNT_BUCKETS),
+    'messages_fetched': ('counter', '詳細を取得したメールの件数', None),
+    'bytes_received': ('counter', 'メールの詳細取得で受信したバイト数', None),
+    'http_request_seconds': ('histogram', 'このアプリのAPIの応答時間(秒)', LATENCY_BUCKETS),
+    'rate_limit_wait_seconds': ('histogram', 'Gmail/Graph のレート制限で送信を待った時間(秒)', LATENCY_BUCKETS),
+    'rate_limit_throttled': ('counter', 'Gmail/Graph にスロットリング(429など)された回数', None),
+}
+PREFIX = 'sns_'
+
+_values = {name: {} for name in METRICS}  # 名前 -> {ラベルのタプル: 値}
+_lock = threading.Lock()
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """カウンターを増やす"""
+    key = _key(labels)
+    with _lock:
+        series = _values[name]
+        series[key] = series.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """ヒストグラムに値を1つ記録する"""
+    buckets = METRICS[name][2]
+    key = _key(labels)
+    with _lock:
+        series = _values[name]
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist['buckets'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+def _error_metric(name):
+    """'xxx_seconds' に対応するエラー数の名前 (無ければNone)"""
+    error_name = name[:-len('_seconds')] + '_errors'
+    return error_name if error_name in METRICS else None
+
+@contextmanager
+def timer(name, **labels):
+    """with の中の所要時間をヒストグラムに記録する (例外が出たらエラー数も増やす)"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        error_name = _error_metric(name)
+        if error_name:
+            inc(error_name, **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def timed(name, **labels):
+    """関数の所要時間を記録するデコレーター (ラベル function に関数名を入れる)"""
+    def decorator(func):
+        func_labels = dict(labels, function=func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **func_labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_iter(iterable, name, **labels):
+    """イテレーターから次の要素を取り出すのにかかった時間の合計を記録する
+
+    ページごとに取得する一覧 (iter_unread_id_pages など) の所要時間を、
+    受け取った側の処理時間を含めずに計るために使う。
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                break
+            except BaseException:
+                elapsed += time.perf_counter() - started
+                error_name = _error_metric(name)
+                if error_name:
+                    inc(error_name, **labels)
+                raise
+            elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        observe(name, elapsed, **labels)
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = []
+    for key, value in items:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render():
+    """全項目を Prometheus のテキスト形式で返す"""
+    with _lock:
+        snapshot = {
+            name: {
+                key: (dict(value, buckets=list(value['buckets'])) if isinstance(value, dict) else value)
+                for key, value in series.items()
+            }
+            for name, series in _values.items()
+        }
+
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        full_name = PREFIX + name + ('_total' if kind == 'counter' else '')
+        lines.append(f"# HELP {full_name} {description}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in sorted(snapshot[name].items()):
+            if kind == 'counter':
+                lines.append(f"{full_name}{_format_labels(labels)} {_format_number(value)}")
+                continue
+            for bound, count in zip(buckets, value['buckets']):
+                lines.append(f"{full_name}_bucket{_format_labels(labels, ('le', _format_number(float(bound))))} {count}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels, ('le', '+Inf'))} {value['count']}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_number(value['sum'])}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
@@ -1,15 +1,166 @@
+import bisect
 import sqlite3
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+import metrics
+
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, '..', 'db', 'emails.db')
 
+# 接続プールの設定
+POOL_SIZE = 8                # 使い回す待機中接続の最大数
+BUSY_TIMEOUT_MS = 5000       # ロック競合時に待つ時間(ミリ秒)
+CACHE_SIZE_KB = 16 * 1024    # ページキャッシュ(KB)
+MMAP_SIZE = 64 * 1024 * 1024 # メモリマップI/Oのサイズ(バイト)
+SQL_CHUNK_SIZE = 500         # IN句に一度に渡すプレースホルダ数
+SYNC_CHUNK_SIZE = 500        # 同期の差分を一度に返す件数
+QUEUE_CACHE_SIZE = 50        # ステータスごとにメモリに持つキュー先頭の件数
+QUEUE_CACHE_CHECK_SECONDS = 2.0  # 別プロセスによる変更をDBに確認する間隔(秒)
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_local = threading.local()
+# 書き込みはプロセス内で1つずつ行う (複数スレッドの同期処理がロック待ちでタイムアウトしないように)
+_write_lock = threading.Lock()
+# メール一覧の変更をコミット後に受け取る関数 (add_change_listener で登録)
+_change_listeners = []
+
+def _open_connection():
+    """新しい接続を作成し、WALモードとプラグマを設定する"""
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    # isolation_level=None: トランザクションは transaction() で明示的に開始する
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+        isolation_level=None,
+        check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    # WAL: 読み込み(Webの画面)と書き込み(同期処理)がお互いをブロックしない
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WALならNORMALでもクラッシュ時にDBは壊れない (fsync回数を削減)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_connection():
+    """現在のスレッド用のDB接続を返す (プールから再利用、なければ新規作成)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = _open_connection()
+        _local.conn = conn
+        _local.depth = 0
+        _reset_pending()
+    return conn
+
+def release_connection():
+    """現在のスレッドの接続をプールに返却する (リクエスト終了時などに呼ぶ)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    _local.depth = 0
+    _reset_pending()
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@contextmanager
+def transaction():
+    """書き込み用トランザクション (ネスト時は一番外側でまとめてコミット)
+
+    中で記録したメール一覧の変更は、コミットした後に登録済みの関数へ通知する。
+    """
+    conn = get_connection()
+    if _local.depth == 0:
+        _reset_pending()
+        _write_lock.acquire()
+        try:
+            # IMMEDIATE: 書き込みロックを最初に取り、途中でのロック昇格待ちを防ぐ
+            conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            _write_lock.release()
+            raise
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth -= 1
+        if _local.depth == 0:
+            _reset_pending()
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            finally:
+                _write_lock.release()
+        raise
+    else:
+        _local.depth -= 1
+        if _local.depth == 0:
+            deltas = _local.queue_deltas
+            try:
+                # 変更後のバージョンはコミット前に読む (キャッシュに差分を反映してよいかの判定用)
+                after = _read_queue_version(conn) if deltas is not None else None
+                conn.commit()
+            finally:
+                _write_lock.release()
+            changes, dirty, before = _local.changes, _local.queue_dirty, _local.queue_before
+            _reset_pending()
+            # 通知を受けた画面がすぐに取り直しても新しい内容を返せるよう、キャッシュを先に更新する
+            if dirty:
+                _update_queue_cache(deltas, before, after)
+            _notify_changes(changes)
+
+def _reset_pending():
+    """トランザクション内で記録した変更 (通知・キャッシュ用) を捨てる"""
+    _local.changes = []
+    _local.queue_dirty = False   # メール一覧に書き込んだか
+    _local.queue_deltas = None   # キャッシュに反映する差分 (キャッシュ未読み込みならNone)
+    _local.queue_before = None   # 最初の書き込み前の一覧のバージョン
+
+def add_change_listener(callback):
+    """メール一覧の変更 (追加・削除・ステータス変更) を受け取る関数を登録する
+
+    callback(changes) はコミットした後に、そのトランザクションでの変更の辞書のリストを受け取る。
+    {'type': 'added', 'count': 件数, 'statuses': [ステータス, ...]}
+    {'type': 'removed', 'message_ids': [...]}
+    {'type': 'status', 'status': 新しいステータス, 'message_ids': [...]}
+    """
+    _change_listeners.append(callback)
+
+def _record_change(change):
+    """トランザクション内の変更を記録する (ロールバックされたら通知しない)"""
+    if _change_listeners:
+        _local.changes.append(change)
+
+def _notify_changes(changes):
+    """記録した変更を登録済みの関数に渡す (通知の失敗で書き込みを失敗させない)"""
+    if not changes:
+        return
+    for callback in _change_listeners:
+        try:
+            callback(changes)
+        except Exception as e:
+            print(f"変更通知エラー: {e}")
+
+@metrics.timed('db_call_seconds')
 def init_db():
     """データベースとテーブルの初期化"""
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     c = conn.cursor()
     # emails テーブル: アプリ内で管理するメール
     # message_id: GmailなどのAPIが持つ一意なID (ユニーク制約)
@@ -26,14 +177,123 @@ def init_db():
             status INTEGER DEFAULT 0    -- 0:Unread, 1:Pending, 2:Important
         )
     ''')
-    conn.commit()
-    conn.close()
+    # 振り分け画面の「次の1件」用インデックス
+    # (status, received_at, id) の順で並んでいるので、ソートせずに先頭から読める
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_emails_status_received
+        ON emails (status, received_at, id)
+    ''')
+    # 一覧のバージョン (画面側の先読みが古くなったかを判定するため)
+    # 別プロセス(各fetcherの単体実行)からの変更でも増えるようにトリガーで更新する
+    c.execute("CREATE TABLE IF NOT EXISTS queue_version (version INTEGER NOT NULL)")
+    c.execute("INSERT INTO queue_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM queue_version)")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS emails_version_insert AFTER INSERT ON emails
+        BEGIN UPDATE queue_version SET version = version + 1; END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS emails_version_delete AFTER DELETE ON emails
+        BEGIN UPDATE queue_version SET version = version + 1; END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS emails_version_status AFTER UPDATE OF status ON emails
+        BEGIN UPDATE queue_version SET version = version + 1; END
+    ''')
+    # 同期時の差分計算用インデックス (サービスごとのmessage_idを順に走査する)
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_emails_service_message
+        ON emails (service, message_id)
+    ''')
+    # outbox テーブル: サーバーへの反映待ちの操作 (既読・スター・削除)
+    # 画面の操作はDBに即時反映し、サーバーへはバックグラウンドで送る
+    # action: 'read', 'star', 'unstar', 'delete'
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            service TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            action TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,  -- UNIXtime。これ以降に送信する
+            last_error TEXT,
+            created_at DATETIME
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_message ON outbox (message_id)")
+    # sync_state テーブル: 差分同期のチェックポイント (GmailのhistoryIdなど)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at DATETIME
+        )
+    ''')
+    # backfill_queue テーブル: 詳細の取得待ちの新着メール (同期で見つけたID)
+    # 1回の同期で取得する量には上限があるので、残りはここに置いて次回以降に続きから取得する
+    # sort_key: 大きいほど新しい (新しいメールから取得する)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_queue (
+            service TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            sort_key INTEGER NOT NULL,
+            PRIMARY KEY (service, message_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_backfill_order ON backfill_queue (service, sort_key, message_id)")
+    _init_search_index(conn)
 
-def save_emails(email_list):
-    """取得したメールリストをデータベースに保存する"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def _init_search_index(conn):
+    """全文検索用の FTS5 インデックス (件名・差出人・スニペット) を作成する
+
+    emails を外部コンテンツとして参照し、トリガーで emails の変更に追従させる。
+    日本語は単語の区切りが無いので、部分一致で検索できる trigram トークナイザーを使う
+    (使えない古い SQLite では unicode61)。FTS5 が無い環境では作成しない (検索は LIKE になる)。
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'"
+    ).fetchone()
+    if not exists:
+        for tokenizer in ('trigram', 'unicode61'):
+            try:
+                conn.execute(f'''
+                    CREATE VIRTUAL TABLE emails_fts USING fts5(
+                        subject, sender, snippet,
+                        content='emails', content_rowid='id', tokenize='{tokenizer}'
+                    )
+                ''')
+                break
+            except sqlite3.OperationalError:
+                continue
+        else:
+            print("FTS5 が使えないため、検索は LIKE で行います")
+            return
+        # 既存のメールをインデックスに登録する
+        conn.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+            INSERT INTO emails_fts (rowid, subject, sender, snippet)
+            VALUES (new.id, new.subject, new.sender, new.snippet);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+            INSERT INTO emails_fts (emails_fts, rowid, subject, sender, snippet)
+            VALUES ('delete', old.id, old.subject, old.sender, old.snippet);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF subject, sender, snippet ON emails BEGIN
+            INSERT INTO emails_fts (emails_fts, rowid, subject, sender, snippet)
+            VALUES ('delete', old.id, old.subject, old.sender, old.snippet);
+            INSERT INTO emails_fts (rowid, subject, sender, snippet)
+            VALUES (new.id, new.subject, new.sender, new.snippet);
+        END
+    ''')
 
+def _insert_emails(conn, email_list):
+    """メールリストをINSERTし、新規に保存した件数を返す (重複は無視)"""
     # リストの中身をタプルの形式に変換
     data = []
     for e in email_list:
@@ -49,114 +309,793 @@ def save_emails(email_list):
             status
         ))
 
+    deltas = _queue_deltas(conn)
+    if deltas is not None:
+        # 書き込みロック中なので、これより大きいIDの行はこのINSERTで追加したもの
+        last_id = conn.execute("SELECT MAX(id) FROM emails").fetchone()[0] or 0
+
+    c = conn.executemany('''
+        INSERT OR IGNORE INTO emails 
+        (service, message_id, subject, sender, snippet, received_at, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', data)
+    if c.rowcount > 0:
+        _record_change({'type': 'added', 'count': c.rowcount, 'statuses': sorted({row[6] for row in data})})
+        if deltas is not None:
+            rows = conn.execute("SELECT * FROM emails WHERE id > ?", (last_id,)).fetchall()
+            deltas.extend(('add', None, dict(row)) for row in rows)
+    return c.rowcount
+
+@metrics.timed('db_call_seconds')
+def save_emails(email_list):
+    """取得したメールリストをデータベースに保存する"""
     # データベースに保存
     try:
-        c.executemany('''
-            INSERT OR IGNORE INTO emails 
-            (service, message_id, subject, sender, snippet, received_at, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', data)
-        conn.commit()
-        if c.rowcount > 0:
-            print(f"{c.rowcount} 件の新規メールを保存しました")
+        with transaction() as conn:
+            saved = _insert_emails(conn, email_list)
+        if saved > 0:
+            print(f"{saved} 件の新規メールを保存しました")
     except sqlite3.Error as e:
         print(f"保存エラー: {e}")
-    finally:
-        conn.close()
 
+@metrics.timed('db_call_seconds')
 def get_all_message_ids():
     """DBに保存されている全メールのmessage_idをセット(集合)で返す"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT message_id FROM emails")
-    ids = {row[0] for row in c.fetchall()}
-    conn.close()
-    return ids
+    c = get_connection().execute("SELECT message_id FROM emails")
+    return {row[0] for row in c.fetchall()}
 
+@metrics.timed('db_call_seconds')
 def delete_emails(message_ids):
     """指定されたIDのメールをDBから削除する（既読になったため）"""
     if not message_ids:
         return
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    placeholders = ','.join('?' for _ in message_ids)
-    # タプルに変換して渡す
-    c.execute(f"DELETE FROM emails WHERE message_id IN ({placeholders})", list(message_ids))
-    conn.commit()
-    print(f"{c.rowcount} 件のメールをDBから削除しました（外部で既読化）")
-    conn.close()
+    deleted = 0
+    with transaction() as conn:
+        deltas = _queue_deltas(conn)
+        # IN句のプレースホルダ数の上限を超えないよう分割する
+        for chunk in _chunked(message_ids):
+            placeholders = ','.join('?' for _ in chunk)
+            if deltas is not None:
+                rows = conn.execute(
+                    f"SELECT id, status, received_at FROM emails WHERE message_id IN ({placeholders})", chunk
+                ).fetchall()
+                deltas.extend(('remove', row['status'], dict(row)) for row in rows)
+            c = conn.execute(f"DELETE FROM emails WHERE message_id IN ({placeholders})", chunk)
+            deleted += c.rowcount
+        if deleted:
+            _record_change({'type': 'removed', 'message_ids': list(message_ids)})
+    print(f"{deleted} 件のメールをDBから削除しました（外部で既読化）")
 
+@metrics.timed('db_call_seconds')
 def get_message_ids_by_service(service_name):
     """指定したサービスのmessage_idのみをセットで返す"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT message_id FROM emails WHERE service=?", (service_name,))
-    ids = {row[0] for row in c.fetchall()}
-    conn.close()
-    return ids
-
-def get_next_email(status=0, offset=0):
-    """指定ステータスのメールを1件取得する (古い順, オフセット付き)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # 辞書っぽく扱えるようにする
-    c = conn.cursor()
-    # statusを指定して取得
-    c.execute("SELECT * FROM emails WHERE status=? ORDER BY received_at ASC LIMIT 1 OFFSET ?", (status, offset))
-    row = c.fetchone()
-    conn.close()
-    
-    if row:
-        return dict(row)
+    c = get_connection().execute("SELECT message_id FROM emails WHERE service=?", (service_name,))
+    return {row[0] for row in c.fetchall()}
+
+@metrics.timed('db_call_seconds')
+def get_next_emails(status=0, limit=1, offset=0, after=None):
+    """指定ステータスのメールを古い順に最大limit件まとめて取得する (1回のクエリ)
+
+    after に最後に見たメールの (received_at, id) を渡すとカーソル方式でその次から返す。
+    OFFSETと違い何件スキップしても速度が変わらず、同期で行が削除されても位置がずれない。
+    """
+    conn = get_connection()
+    # statusを指定して取得 (row_factory=sqlite3.Row なので辞書っぽく扱える)
+    if after is not None:
+        received_at, db_id = after
+        c = conn.execute('''
+            SELECT * FROM emails
+            WHERE status=? AND (received_at, id) > (?, ?)
+            ORDER BY received_at ASC, id ASC LIMIT ?
+        ''', (status, received_at, db_id, limit))
+    else:
+        c = conn.execute("SELECT * FROM emails WHERE status=? ORDER BY received_at ASC, id ASC LIMIT ? OFFSET ?", (status, limit, offset))
+    return [dict(row) for row in c.fetchall()]
+
+# 検索の並び順の重み (件名 > 差出人 > スニペット)
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+TRIGRAM_MIN_LENGTH = 3  # trigram で検索できる最短の語の長さ
+
+_search_tokenizer = {}  # DB_PATH -> 'trigram' / 'unicode61' / None(FTS5なし)
+
+def _get_search_tokenizer(conn):
+    """全文検索インデックスのトークナイザーを返す (インデックスが無ければNone)"""
+    if DB_PATH not in _search_tokenizer:
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'").fetchone()
+        if row is None:
+            _search_tokenizer[DB_PATH] = None
+        else:
+            _search_tokenizer[DB_PATH] = 'trigram' if 'trigram' in row[0] else 'unicode61'
+    return _search_tokenizer[DB_PATH]
+
+@metrics.timed('db_call_seconds')
+def search_emails(query, statuses=None, limit=20, offset=0):
+    """件名・差出人・スニペットを全文検索し、関連度の高い順に返す
+
+    query は空白区切りの語で、すべてを含むメールを返す (語はそのまま文字列として扱う)。
+    statuses を指定するとそのステータスのメールだけに絞る。
+    trigram で検索できない短い語(2文字以下)は LIKE で絞り込む。
+    """
+    conn = get_connection()
+    terms = query.split()
+    if not terms:
+        return []
+    tokenizer = _get_search_tokenizer(conn)
+
+    if tokenizer == 'trigram':
+        match_terms = [t for t in terms if len(t) >= TRIGRAM_MIN_LENGTH]
+    elif tokenizer == 'unicode61':
+        match_terms = terms
+    else:
+        match_terms = []
+    like_terms = [t for t in terms if t not in match_terms]
+
+    where = []
+    params = []
+    if match_terms:
+        # 各語をフレーズとして扱い、FTS5 の演算子として解釈されないようにする
+        where.append("emails_fts MATCH ?")
+        params.append(' '.join('"' + t.replace('"', '""') + '"' for t in match_terms))
+    for term in like_terms:
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where.append("(e.subject LIKE ? ESCAPE '\\' OR e.sender LIKE ? ESCAPE '\\' OR e.snippet LIKE ? ESCAPE '\\')")
+        params.extend([pattern] * 3)
+    if statuses:
+        statuses = list(statuses)
+        where.append(f"e.status IN ({','.join('?' for _ in statuses)})")
+        params.extend(statuses)
+
+    if match_terms:
+        weights = ', '.join(str(w) for w in SEARCH_WEIGHTS)
+        sql = f'''
+            SELECT e.* FROM emails_fts JOIN emails e ON e.id = emails_fts.rowid
+            WHERE {' AND '.join(where)}
+            ORDER BY bm25(emails_fts, {weights}), e.received_at DESC, e.id DESC
+            LIMIT ? OFFSET ?
+        '''
+    else:
+        # 短い語だけの検索は関連度を計算できないので新しい順
+        sql = f'''
+            SELECT e.* FROM emails e
+            WHERE {' AND '.join(where)}
+            ORDER BY e.received_at DESC, e.id DESC
+            LIMIT ? OFFSET ?
+        '''
+    params.extend([limit, offset])
+    return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+@metrics.timed('db_call_seconds')
+def get_next_email(status=0, offset=0, after=None):
+    """指定ステータスのメールを1件取得する (古い順, オフセット/カーソル付き)
+
+    キューの先頭 QUEUE_CACHE_SIZE 件の範囲ならメモリのキャッシュから返し、DBには触れない。
+    """
+    with _queue_cache_lock:
+        found, rows = _cached_next(status, 1, offset, after) if _ensure_queue_cache() else (False, [])
+    metrics.inc('queue_cache_reads', function='get_next_email', result='hit' if found else 'miss')
+    if not found:
+        rows = get_next_emails(status=status, limit=1, offset=offset, after=after)
+    if rows:
+        return rows[0]
     return None
 
+@metrics.timed('db_call_seconds')
+def get_latest_email_id():
+    """一番新しく保存したメールのIDを返す (新着があったかの判定用)"""
+    row = get_connection().execute("SELECT MAX(id) FROM emails").fetchone()
+    return row[0] or 0
+
+@metrics.timed('db_call_seconds')
+def get_queue_version():
+    """メール一覧のバージョンを返す (追加・削除・ステータス変更のたびに増える)"""
+    return _read_queue_version(get_connection())
+
+def _read_queue_version(conn):
+    row = conn.execute("SELECT version FROM queue_version").fetchone()
+    return row[0] if row else 0
+
+# --- キュー先頭とステータスごとの件数のキャッシュ ---
+# 振り分け画面の「次の1件」と件数表示をDBに問い合わせずに返すため、プロセス内に持つ。
+# このプロセスの書き込みはコミット後に差分で反映し、別プロセス(各fetcherの単体実行)の
+# 書き込みは QUEUE_CACHE_CHECK_SECONDS ごとに queue_version を見て気付いたら読み直す。
+_queue_cache = {
+    'version': None,      # キャッシュが表す queue_version (None: 未読み込み)
+    'generation': 0,      # キャッシュが変わるたびに増える (古い結果を見分けるため)
+    'checked_at': 0.0,    # 最後に queue_version を確認した時刻 (time.monotonic)
+    'counts': {},         # ステータス -> 件数
+    'heads': {},          # ステータス -> 先頭から最大 QUEUE_CACHE_SIZE 件のメール (古い順)
+}
+_queue_cache_lock = threading.Lock()
+
+def _queue_key(row):
+    """キューの並び順 (received_at, id) の比較用キー (SQLiteと同じくNULLを先頭にする)"""
+    received_at = row['received_at']
+    return (received_at is not None, received_at or '', row['id'])
+
+def _count_by_status(conn):
+    return dict(conn.execute("SELECT status, COUNT(*) FROM emails GROUP BY status").fetchall())
+
+def _load_queue_head(conn, status):
+    c = conn.execute(
+        "SELECT * FROM emails WHERE status=? ORDER BY received_at ASC, id ASC LIMIT ?",
+        (status, QUEUE_CACHE_SIZE)
+    )
+    return [dict(row) for row in c.fetchall()]
+
+def _load_queue_cache():
+    """件数とキュー先頭をDBから読み直す (_queue_cache_lock を取得した状態で呼ぶ)"""
+    conn = get_connection()
+    # 件数と先頭を同じ時点の内容で読むため、読み込み用のトランザクションにまとめる
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        version = _read_queue_version(conn)
+        counts = _count_by_status(conn)
+        heads = {status: _load_queue_head(conn, status) for status in counts}
+    finally:
+        if own_transaction:
+            conn.rollback()
+    _queue_cache.update(version=version, counts=counts, heads=heads, checked_at=time.monotonic())
+    _queue_cache['generation'] += 1
+
+def _ensure_queue_cache():
+    """キャッシュを使える状態にし、使えるかを返す (_queue_cache_lock を取得した状態で呼ぶ)
+
+    書き込みトランザクションの中ではコミット前の内容が見えてしまうので使わない。
+    """
+    if getattr(_local, 'depth', 0) > 0:
+        return False
+    now = time.monotonic()
+    if _queue_cache['version'] is None:
+        _load_queue_cache()
+    elif now - _queue_cache['checked_at'] >= QUEUE_CACHE_CHECK_SECONDS:
+        _queue_cache['checked_at'] = now
+        if _read_queue_version(get_connection()) != _queue_cache['version']:
+            _load_queue_cache()
+    return True
+
+def _cached_next(status, limit=1, offset=0, after=None):
+    """キャッシュから次の最大limit件を探し、(キャッシュで答えられたか, メールのリスト) を返す
+
+    キャッシュしている先頭の範囲を超える場合は (False, []) を返す (DBから取得する)。
+    """
+    head = _queue_cache['heads'].get(status, [])
+    complete = len(head) >= _queue_cache['counts'].get(status, 0)
+    if after is not None:
+        received_at, db_id = after
+        key = (True, received_at, db_id)
+        index = bisect.bisect_right([_queue_key(row) for row in head], key)
+    else:
+        index = offset
+    if index + limit <= len(head) or complete:
+        return True, [dict(row) for row in head[index:index + limit]]
+    return False, []
+
+def _queue_deltas(conn):
+    """キャッシュに反映する差分を記録するリストを返す (キャッシュ未読み込みならNone)
+
+    メール一覧に書き込む前に、トランザクションの中で呼ぶ。
+    """
+    _local.queue_dirty = True
+    if _local.queue_deltas is None and _queue_cache['version'] is not None:
+        _local.queue_before = _read_queue_version(conn)
+        _local.queue_deltas = []
+    return _local.queue_deltas
+
+def _add_status_deltas(conn, deltas, previous):
+    """ステータスを変えたメール ({message_id: 以前のステータス}) の更新後の行を差分に加える"""
+    if deltas is None or not previous:
+        return
+    for chunk in _chunked(previous):
+        placeholders = ','.join('?' for _ in chunk)
+        rows = conn.execute(f"SELECT * FROM emails WHERE message_id IN ({placeholders})", chunk).fetchall()
+        deltas.extend(('status', previous[row['message_id']], dict(row)) for row in rows)
+
+def _remove_from_queue(status, row):
+    counts = _queue_cache['counts']
+    counts[status] = counts.get(status, 0) - 1
+    head = _queue_cache['heads'].get(status, [])
+    for i, cached in enumerate(head):
+        if cached['id'] == row['id']:
+            del head[i]
+            break
+
+def _add_to_queue(row):
+    status = row['status']
+    counts = _queue_cache['counts']
+    head = _queue_cache['heads'].setdefault(status, [])
+    complete = len(head) >= counts.get(status, 0)
+    counts[status] = counts.get(status, 0) + 1
+    # 先頭の範囲に入るときだけ持つ (範囲より後ろのメールはキャッシュの外のまま)
+    key = _queue_key(row)
+    if complete or (head and key < _queue_key(head[-1])):
+        keys = [_queue_key(cached) for cached in head]
+        head.insert(bisect.bisect_left(keys, key), row)
+        del head[QUEUE_CACHE_SIZE:]
+
+def _update_queue_cache(deltas, before, after):
+    """コミットした書き込みをキャッシュに反映する
+
+    書き込み前のバージョンがキャッシュと一致するときだけ差分を当て、
+    それ以外 (別プロセスの書き込みが挟まった、差分を記録していない) は読み直す。
+    """
+    with _queue_cache_lock:
+        if _queue_cache['version'] is None:
+            return
+        try:
+            if deltas is None or before != _queue_cache['version']:
+                _load_queue_cache()
+                return
+            touched = set()
+            for kind, old_status, row in deltas:
+                if kind != 'add':
+                    _remove_from_queue(old_status, row)
+                    touched.add(old_status)
+                if kind != 'remove':
+                    _add_to_queue(row)
+            # 先頭から抜けて少なくなったら、残りがある限りDBから補充する
+            conn = get_connection()
+            for status in touched:
+                head = _queue_cache['heads'].get(status, [])
+                if len(head) < QUEUE_CACHE_SIZE // 2 and len(head) < _queue_cache['counts'].get(status, 0):
+                    _queue_cache['heads'][status] = _load_queue_head(conn, status)
+            _queue_cache['version'] = after
+            _queue_cache['generation'] += 1
+        except Exception as e:
+            # 反映に失敗したら捨てて、次の読み込みで作り直す (書き込み自体はコミット済み)
+            print(f"キューキャッシュ更新エラー: {e}")
+            _queue_cache['version'] = None
+
+@metrics.timed('db_call_seconds')
+def get_queue_counts():
+    """ステータスごとの件数をキャッシュから返す
+
+    {'counts': {ステータス: 件数}, 'generation': キャッシュの世代, 'version': 一覧のバージョン}
+    """
+    with _queue_cache_lock:
+        cached = _ensure_queue_cache()
+        if cached:
+            counts = {status: count for status, count in _queue_cache['counts'].items() if count > 0}
+            version = _queue_cache['version']
+        generation = _queue_cache['generation']
+    metrics.inc('queue_cache_reads', function='get_queue_counts', result='hit' if cached else 'miss')
+    if not cached:
+        conn = get_connection()
+        counts, version = _count_by_status(conn), _read_queue_version(conn)
+    return {'counts': counts, 'generation': generation, 'version': version}
+
+@metrics.timed('db_call_seconds')
+def get_queue_batch(status=0, limit=1, after=None):
+    """指定ステータスのメールを古い順に最大limit件と、一覧のバージョンを返す (画面側の先読み用)
+
+    キャッシュしている先頭の範囲に収まればDBに触れずに返し、超えるときだけDBから取得する。
+    {'emails': [メール], 'version': 一覧のバージョン}
+    """
+    with _queue_cache_lock:
+        found, emails = _cached_next(status, limit, after=after) if _ensure_queue_cache() else (False, [])
+        version = _queue_cache['version']
+    metrics.inc('queue_cache_reads', function='get_queue_batch', result='hit' if found else 'miss')
+    if not found:
+        # バージョンは先に読む (取得中に更新されても、古いバージョンとして次回検知される)
+        version = get_queue_version()
+        emails = get_next_emails(status=status, limit=limit, after=after)
+    return {'emails': emails, 'version': version}
+
+def get_queue_generation():
+    """キャッシュの世代を返す (DBには触れない。読み込み前は0)"""
+    with _queue_cache_lock:
+        return _queue_cache['generation']
+
+@metrics.timed('db_call_seconds')
 def get_email_by_id(db_id):
     """指定されたDB上のID(主キー)からメール情報を取得"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM emails WHERE id=?", (db_id,))
+    c = get_connection().execute("SELECT * FROM emails WHERE id=?", (db_id,))
     row = c.fetchone()
-    conn.close()
     
     if row:
         return dict(row)
     return None
 
+@metrics.timed('db_call_seconds')
+def get_emails_by_ids(db_ids):
+    """指定されたDB上のID(主キー)のメールをまとめて取得する (存在しないIDは含まれない)"""
+    emails = []
+    conn = get_connection()
+    for chunk in _chunked(db_ids):
+        placeholders = ','.join('?' for _ in chunk)
+        c = conn.execute(f"SELECT * FROM emails WHERE id IN ({placeholders})", chunk)
+        emails.extend(dict(row) for row in c.fetchall())
+    return emails
+
+@metrics.timed('db_call_seconds')
 def update_email_status(db_id, status):
     """メールのステータスを更新する"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        c.execute("UPDATE emails SET status = ? WHERE id = ?", (status, db_id))
-        conn.commit()
+        with transaction() as conn:
+            deltas = _queue_deltas(conn)
+            row = conn.execute("SELECT message_id, status FROM emails WHERE id = ?", (db_id,)).fetchone()
+            conn.execute("UPDATE emails SET status = ? WHERE id = ?", (status, db_id))
+            if row and row[1] != status:
+                _record_change({'type': 'status', 'status': status, 'message_ids': [row[0]]})
+                _add_status_deltas(conn, deltas, {row[0]: row[1]})
         return True
     except Exception as e:
         print(f"ステータス更新エラー: {e}")
         with open("db_error.log", "a") as f:
             f.write(f"ステータス更新エラー: {e}\n")
         return False
-    finally:
-        conn.close()
 
+@metrics.timed('db_call_seconds')
 def update_email_status_by_message_id(message_id, status):
     """message_idを指定してステータスを更新する"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        # 現在のステータスを取得（無駄な更新を防ぐため）
-        c.execute("SELECT status FROM emails WHERE message_id = ?", (message_id,))
-        row = c.fetchone()
-        if row and row[0] != status:
-            c.execute("UPDATE emails SET status = ? WHERE message_id = ?", (status, message_id))
-            conn.commit()
-            print(f"ステータス更新({message_id}): {row[0]} -> {status}")
-            return True
+        with transaction() as conn:
+            deltas = _queue_deltas(conn)
+            # 現在のステータスを取得（無駄な更新を防ぐため）
+            row = conn.execute("SELECT status FROM emails WHERE message_id = ?", (message_id,)).fetchone()
+            if row and row[0] != status:
+                conn.execute("UPDATE emails SET status = ? WHERE message_id = ?", (status, message_id))
+                _record_change({'type': 'status', 'status': status, 'message_ids': [message_id]})
+                _add_status_deltas(conn, deltas, {message_id: row[0]})
+                print(f"ステータス更新({message_id}): {row[0]} -> {status}")
+                return True
     except Exception as e:
         print(f"ステータス更新エラー: {e}")
-    finally:
-        conn.close()
     return False
 
+def _chunked(items, size=SQL_CHUNK_SIZE):
+    """SQLのプレースホルダ数上限を超えないようにリストを分割する"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+@metrics.timed('db_call_seconds')
+def apply_status_map(status_map):
+    """{message_id: status} をまとめて反映し、実際に変更されたmessage_idのリストを返す
+
+    1回のトランザクションで処理し、現在と同じステータスの行は更新しない。
+    外側のトランザクションの中で呼ばれたときはDBのエラーを握りつぶさずにそのまま出す
+    (外側でまとめてロールバックさせ、一緒に書いた送信キューなどだけがコミットされないように)。
+    """
+    if not status_map:
+        return []
+
+    get_connection()
+    nested = _local.depth > 0
+    changed = []
+    previous = {}
+    try:
+        with transaction() as conn:
+            deltas = _queue_deltas(conn)
+            # 現在のステータスを取得して、差分がある行だけを抽出
+            for chunk in _chunked(status_map.keys()):
+                placeholders = ','.join('?' for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT message_id, status FROM emails WHERE message_id IN ({placeholders})", chunk
+                ).fetchall()
+                for message_id, current in rows:
+                    if current != status_map[message_id]:
+                        changed.append(message_id)
+                        previous[message_id] = current
+
+            conn.executemany(
+                "UPDATE emails SET status = ? WHERE message_id = ?",
+                [(status_map[message_id], message_id) for message_id in changed]
+            )
+            by_status = {}
+            for message_id in changed:
+                by_status.setdefault(status_map[message_id], []).append(message_id)
+            for status, message_ids in by_status.items():
+                _record_change({'type': 'status', 'status': status, 'message_ids': message_ids})
+            _add_status_deltas(conn, deltas, previous)
+    except sqlite3.Error as e:
+        if nested:
+            raise
+        print(f"ステータス一括更新エラー: {e}")
+        return []
+
+    if changed:
+        print(f"{len(changed)} 件のステータスを更新しました")
+    return changed
+
+# 同期差分の種類ごとのSQL (FROM/WHERE句, 並び順に使う列)
+# new: サーバーにだけある / gone: DBにだけある(既読化) / existing: 両方にある
+# outbox に反映待ちの操作があるメールは、サーバー側がまだ古い状態なので
+# new(再取得) と existing(ステータス上書き) の対象から外す
+_DIFF_QUERIES = {
+    'new': ('''
+        FROM sync_staging s
+        WHERE s.service = ? AND NOT EXISTS (
+            SELECT 1 FROM emails e WHERE e.message_id = s.message_id AND e.service = s.service
+        ) AND NOT EXISTS (
+            SELECT 1 FROM outbox o WHERE o.message_id = s.message_id
+        )''', 's.message_id'),
+    'gone': ('''
+        FROM emails e
+        WHERE e.service = ? AND NOT EXISTS (
+            SELECT 1 FROM sync_staging s WHERE s.service = e.service AND s.message_id = e.message_id
+        )''', 'e.message_id'),
+    'existing': ('''
+        FROM sync_staging s
+        JOIN emails e ON e.message_id = s.message_id AND e.service = s.service
+        WHERE s.service = ? AND NOT EXISTS (
+            SELECT 1 FROM outbox o WHERE o.message_id = s.message_id
+        )''', 's.message_id'),
+}
+
+def _ensure_staging_table(conn):
+    """サーバー側IDを一時的に置く TEMP テーブルを作成する (接続ごとに存在する)"""
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS sync_staging (
+            service TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            position INTEGER NOT NULL,  -- サーバーの一覧での順番 (新しい順に返すサーバーなら0が最新)
+            PRIMARY KEY (service, message_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _clear_staging(service_name):
+    """一時テーブルから指定サービスの行を消す"""
+    with transaction() as conn:
+        conn.execute("DELETE FROM sync_staging WHERE service = ?", (service_name,))
+
+@contextmanager
+def staged_server_ids(service_name, id_pages):
+    """サーバー上の未読IDをページ単位で一時テーブルに書き込む
+
+    id_pages はIDのリストを順に返すイテラブル (APIのページごとなど)。
+    全ページの書き込みが終わってから差分計算に使えるようになり、件数を返す。
+    途中でAPIエラーが起きた場合は例外がそのまま伝わるので、不完全な一覧で
+    既読判定(削除)してしまうことはない。終了時に一時テーブルは片付けられる。
+    """
+    _ensure_staging_table(get_connection())
+    _clear_staging(service_name)
+    try:
+        total = 0
+        for page in id_pages:
+            if not page:
+                continue
+            with transaction() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO sync_staging (service, message_id, position) VALUES (?, ?, ?)",
+                    [(service_name, message_id, total + i) for i, message_id in enumerate(page)]
+                )
+            total += len(page)
+        yield total
+    finally:
+        _clear_staging(service_name)
+
+@metrics.timed('db_call_seconds')
+def count_diff_ids(service_name, kind):
+    """staged_server_ids の中で、差分(new/gone/existing)の件数を返す"""
+    from_where, _ = _DIFF_QUERIES[kind]
+    row = get_connection().execute(f"SELECT COUNT(*) {from_where}", (service_name,)).fetchone()
+    return row[0]
+
+def iter_diff_ids(service_name, kind, chunk_size=SYNC_CHUNK_SIZE):
+    """staged_server_ids の中で、差分(new/gone/existing)のIDをチャンクごとに返す
+
+    チャンクごとにmessage_id順のカーソルで読み直すため、受け取った側が
+    途中でDBを更新・削除しても取りこぼしや重複は起きない。
+    """
+    from_where, column = _DIFF_QUERIES[kind]
+    conn = get_connection()
+    last_id = ''
+    while True:
+        rows = conn.execute(
+            f"SELECT {column} {from_where} AND {column} > ? ORDER BY {column} LIMIT ?",
+            (service_name, last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        ids = [row[0] for row in rows]
+        yield ids
+        last_id = ids[-1]
+
+def _backfill_base_key():
+    """取得待ちに追加するときの基準の sort_key (後から見つかったメールほど大きくなる)"""
+    # ミリ秒ごとに 10^6 件分の幅を取り、その中で一覧の順番(新しい順)を引く
+    return int(time.time() * 1000) * 1_000_000
+
+@metrics.timed('db_call_seconds')
+def enqueue_backfill(service_name, message_ids):
+    """新着メールのIDを取得待ちに追加する (message_ids は新しい順に渡す)
+
+    すでに取得待ちのIDは元の順番のまま残す。保存済みのメールは追加しない。
+    """
+    base = _backfill_base_key()
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO backfill_queue (service, message_id, sort_key)
+            SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM emails WHERE message_id = ?)
+        ''', [(service_name, message_id, base - i, message_id) for i, message_id in enumerate(message_ids)])
+
+@metrics.timed('db_call_seconds')
+def recheck_messages(service_name, message_ids):
+    """メールをDBから消して取得待ちに入れ、次回の同期でサーバーの状態を取り直す
+
+    送信キューの操作を諦めたときに使う (差分同期は反映待ちだったメールを飛ばしているので、
+    そのままではサーバーと食い違ったままになる)。取得時にまだ未読なら、
+    その時点のスター/フラグの状態で保存し直される。
+    """
+    if not message_ids:
+        return
+    with transaction():
+        delete_emails(message_ids)
+        enqueue_backfill(service_name, message_ids)
+
+@metrics.timed('db_call_seconds')
+def enqueue_backfill_from_staging(service_name):
+    """staged_server_ids の差分(new)を取得待ちに追加し、サーバーで未読でなくなったものは取り除く
+
+    一覧の順番(position)を保ったまま追加するので、新しい順の一覧なら新しいメールから取得される。
+    取得待ちの件数を返す。
+    """
+    from_where, _ = _DIFF_QUERIES['new']
+    with transaction() as conn:
+        conn.execute(
+            f"INSERT OR IGNORE INTO backfill_queue (service, message_id, sort_key) "
+            f"SELECT s.service, s.message_id, ? - s.position {from_where}",
+            (_backfill_base_key(), service_name)
+        )
+        conn.execute('''
+            DELETE FROM backfill_queue
+            WHERE service = ? AND message_id NOT IN (SELECT message_id FROM sync_staging WHERE service = ?)
+        ''', (service_name, service_name))
+    return count_backfill(service_name)
+
+@metrics.timed('db_call_seconds')
+def count_backfill(service_name):
+    """取得待ちの件数を返す"""
+    row = get_connection().execute(
+        "SELECT COUNT(*) FROM backfill_queue WHERE service = ?", (service_name,)
+    ).fetchone()
+    return row[0]
+
+@metrics.timed('db_call_seconds')
+def get_backfill_ids(service_name, limit, before=None):
+    """取得待ちのIDを新しい順に返す
+
+    before=(sort_key, message_id) を指定すると、その次(より古いもの)から返す。
+    戻り値は [(sort_key, message_id), ...]。
+    """
+    conn = get_connection()
+    if before is None:
+        rows = conn.execute('''
+            SELECT sort_key, message_id FROM backfill_queue
+            WHERE service = ?
+            ORDER BY sort_key DESC, message_id DESC LIMIT ?
+        ''', (service_name, limit)).fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT sort_key, message_id FROM backfill_queue
+            WHERE service = ? AND (sort_key, message_id) < (?, ?)
+            ORDER BY sort_key DESC, message_id DESC LIMIT ?
+        ''', (service_name, before[0], before[1], limit)).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+@metrics.timed('db_call_seconds')
+def complete_backfill(service_name, email_list, message_ids):
+    """取得したメールの保存と取得待ちからの削除を1つのトランザクションで行う
+
+    途中で止まっても、保存済みの分は取得待ちから消え、未保存の分は残る。
+    """
+    with transaction() as conn:
+        saved = _insert_emails(conn, email_list) if email_list else 0
+        for chunk in _chunked(message_ids):
+            placeholders = ','.join('?' for _ in chunk)
+            conn.execute(
+                f"DELETE FROM backfill_queue WHERE service = ? AND message_id IN ({placeholders})",
+                [service_name] + chunk
+            )
+    if saved > 0:
+        print(f"{saved} 件の新規メールを保存しました")
+    return saved
+
+@metrics.timed('db_call_seconds')
+def clear_backfill(service_name):
+    """指定サービスの取得待ちをすべて消す"""
+    with transaction() as conn:
+        conn.execute("DELETE FROM backfill_queue WHERE service = ?", (service_name,))
+
+@metrics.timed('db_call_seconds')
+def enqueue_actions(actions):
+    """[(service, message_id, action), ...] をまとめて outbox に追加する"""
+    if not actions:
+        return
+    now = time.time()
+    created_at = datetime.now()
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT INTO outbox (service, message_id, action, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(service, message_id, action, now, created_at) for service, message_id, action in actions])
+
+@metrics.timed('db_call_seconds')
+def get_due_actions(limit=100):
+    """送信時刻になった outbox の操作を古い順に返す
+
+    同じメールに複数の操作がある場合は先頭の1件だけを返す
+    (前の操作が再送待ちの間に、後の操作が先にサーバーへ届かないようにする)
+    """
+    c = get_connection().execute('''
+        SELECT * FROM outbox o
+        WHERE o.next_attempt_at <= ? AND NOT EXISTS (
+            SELECT 1 FROM outbox p WHERE p.message_id = o.message_id AND p.id < o.id
+        )
+        ORDER BY o.id LIMIT ?
+    ''', (time.time(), limit))
+    return [dict(row) for row in c.fetchall()]
+
+@metrics.timed('db_call_seconds')
+def complete_actions(action_ids):
+    """送信が終わった(または諦めた) outbox の操作を削除する"""
+    if not action_ids:
+        return
+    with transaction() as conn:
+        for chunk in _chunked(action_ids):
+            placeholders = ','.join('?' for _ in chunk)
+            conn.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", chunk)
+
+@metrics.timed('db_call_seconds')
+def clear_actions(service_name):
+    """指定サービスの反映待ちの操作をすべて消し、消した件数を返す
+
+    IMAPのUIDが振り直されたときに使う (古いUIDのまま送ると別のメールに反映されてしまう)。
+    """
+    with transaction() as conn:
+        return conn.execute("DELETE FROM outbox WHERE service = ?", (service_name,)).rowcount
+
+@metrics.timed('db_call_seconds')
+def retry_action(action_id, error, delay):
+    """outbox の操作を失敗として記録し、delay秒後に再送する"""
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?
+            WHERE id = ?
+        ''', (str(error), time.time() + delay, action_id))
+
+@metrics.timed('db_call_seconds')
+def get_existing_message_ids(message_ids):
+    """指定したmessage_idのうち、DBに保存されているものをセットで返す"""
+    found = set()
+    conn = get_connection()
+    for chunk in _chunked(message_ids):
+        placeholders = ','.join('?' for _ in chunk)
+        c = conn.execute(f"SELECT message_id FROM emails WHERE message_id IN ({placeholders})", chunk)
+        found.update(row[0] for row in c.fetchall())
+    return found
+
+@metrics.timed('db_call_seconds')
+def get_pending_message_ids(message_ids):
+    """指定したmessage_idのうち、outbox に反映待ちの操作があるものをセットで返す"""
+    found = set()
+    conn = get_connection()
+    for chunk in _chunked(message_ids):
+        placeholders = ','.join('?' for _ in chunk)
+        c = conn.execute(f"SELECT DISTINCT message_id FROM outbox WHERE message_id IN ({placeholders})", chunk)
+        found.update(row[0] for row in c.fetchall())
+    return found
+
+@metrics.timed('db_call_seconds')
+def get_sync_state(key, default=None):
+    """差分同期のチェックポイントを取得する"""
+    row = get_connection().execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+@metrics.timed('db_call_seconds')
+def set_sync_state(key, value):
+    """差分同期のチェックポイントを保存する (Noneなら削除)"""
+    with transaction() as conn:
+        if value is None:
+            conn.execute("DELETE FROM sync_state WHERE key = ?", (key,))
+        else:
+            conn.execute('''
+                INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+            ''', (key, str(value), datetime.now()))
+
 # 初期化実行
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,104 @@
+import threading
+import traceback
+from collections import OrderedDict
+
+import models
+import providers
+
+# 設定
+BATCH_SIZE = 500         # 1回の送信で処理する最大件数
+POLL_INTERVAL = 5.0      # キューが空のときの待機秒数
+BASE_RETRY_DELAY = 5.0   # 1回目の再送までの秒数 (失敗ごとに2倍)
+MAX_RETRY_DELAY = 600.0  # 再送間隔の上限(秒)
+MAX_ATTEMPTS = 8         # これを超えたら諦める
+
+_wake_event = threading.Event()
+_stop_event = threading.Event()
+_thread = None
+_lock = threading.Lock()
+
+def is_supported(service):
+    """サーバー連携に対応しているサービスか"""
+    return providers.is_supported(service)
+
+def _retry_delay(attempts):
+    """失敗回数から次の再送までの秒数を求める (指数バックオフ)"""
+    return min(BASE_RETRY_DELAY * (2 ** attempts), MAX_RETRY_DELAY)
+
+def _handle_failure(service, action, error):
+    """送信に失敗した操作を再送予約する (上限を超えたら諦めてTrueを返す)"""
+    if action['attempts'] + 1 >= MAX_ATTEMPTS:
+        # 諦める: 呼び出し元がこのメールを取り直し対象にする (models.recheck_messages)
+        print(f"送信失敗のため破棄({service}): {action['action']} {action['message_id']} ({error})")
+        return True
+    delay = _retry_delay(action['attempts'])
+    print(f"送信失敗({service}): {action['action']} {action['message_id']} -> {delay:.0f}秒後に再送 ({error})")
+    models.retry_action(action['id'], error, delay)
+    return False
+
+def drain_once():
+    """送信時刻になった操作を、アカウントと操作の種類ごとにまとめて並列に送信し、処理件数を返す
+
+    get_due_actions はメールごとに先頭の操作しか返さないので、まとめても順序は崩れない。
+    """
+    actions = models.get_due_actions(limit=BATCH_SIZE)
+    if not actions:
+        return 0
+
+    # (サービス, 操作) ごとにまとめる (各グループ内では登録順を保つ)
+    groups = OrderedDict()
+    for action in actions:
+        groups.setdefault((action['service'], action['action']), []).append(action)
+
+    results = providers.run_bulk_groups([
+        (service, action_name, [a['message_id'] for a in group])
+        for (service, action_name), group in groups.items()
+    ])
+
+    done = []
+    dropped = {}  # サービス -> 諦めた操作のmessage_id
+    for ((service, _), group), (succeeded, error) in zip(groups.items(), results):
+        for action in group:
+            if action['message_id'] in succeeded:
+                done.append(action['id'])
+            elif _handle_failure(service, action, error or 'provider returned failure'):
+                done.append(action['id'])
+                dropped.setdefault(service, []).append(action['message_id'])
+    with models.transaction():
+        models.complete_actions(done)
+        # 諦めたメールはDBだけが先に変わっているので、サーバーの状態を取り直す
+        for service, message_ids in dropped.items():
+            models.recheck_messages(service, message_ids)
+    return len(actions)
+
+def _run():
+    """バックグラウンドスレッドの本体"""
+    while not _stop_event.is_set():
+        try:
+            processed = drain_once()
+        except Exception:
+            traceback.print_exc()
+            processed = 0
+
+        if not processed:
+            _wake_event.wait(POLL_INTERVAL)
+            _wake_event.clear()
+
+def wake():
+    """新しい操作が追加されたことをワーカーに知らせる"""
+    _wake_event.set()
+
+def start():
+    """送信ワーカーを起動する (2回目以降の呼び出しは何もしない)"""
+    global _thread
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop_event.clear()
+        _thread = threading.Thread(target=_run, name='outbox-worker', daemon=True)
+        _thread.start()
+
+def stop():
+    """送信ワーカーを停止する"""
+    _stop_event.set()
+    _wake_event.set()
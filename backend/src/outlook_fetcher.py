@@ -1,10 +1,14 @@
 import os
 import json
-import atexit
 import datetime
+import threading
+import time
 import requests
 import msal
 import models
+import backfill
+import metrics
+import rate_limit
 
 # パス設定
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,9 +18,45 @@ TOKEN_PATH = os.path.join(BASE_DIR, '..', 'credentials', 'outlook_token.json')
 # 設定
 SCOPES = ['User.Read', 'Mail.ReadWrite']
 GRAPH_API_ENDPOINT = 'https://graph.microsoft.com/v1.0'
+MESSAGE_FIELDS = 'subject,from,bodyPreview,receivedDateTime,flag'  # DBに保存する項目
+
+# 差分(delta)同期の設定
+DELTA_FIELDS = MESSAGE_FIELDS + ',isRead'
+DELTA_PAGE_SIZE = 100
+DELTA_STATE_KEY = 'outlook:delta_link'  # 前回の @odata.deltaLink (sync_stateのキー)
+
+# JSONバッチ($batch)の設定
+BATCH_SIZE = 20           # 1回の $batch に入れられるリクエスト数の上限
+MAX_BATCH_RETRIES = 3     # 429/503 の再送回数
+
+# レート制限の設定 (同期・画面の操作・送信キューで共有する)
+# Outlook のメールボックスごとの上限: 10分間に10000リクエスト、同時に4リクエスト
+# $batch の中のリクエストも1件ずつ数える
+REQUESTS_PER_SECOND = 10000 / 600
+REQUEST_BURST = 2000      # 続けて送ってよいリクエスト数 (10分間の上限の一部をまとめて使う)
+MAX_CONCURRENCY = 4
+THROTTLED_STATUSES = (429, 503)
+REQUEST_TIMEOUT = (10, 60)  # 接続・応答を待つ最大秒数 (止まった通信がレート制限の枠を持ち続けないように)
+
+rate_limit.configure('outlook', rate=REQUESTS_PER_SECOND, capacity=REQUEST_BURST, max_concurrency=MAX_CONCURRENCY)
+
+# 認証の設定
+REFRESH_AHEAD_SECONDS = 300  # 有効期限のこの秒数前になったら先回りして更新する
+
+_msal_app = None  # プロセス内で共有する msal のアプリ (トークンキャッシュを含む)
+_access_token = {'token': None, 'expires_at': 0.0}
+_auth_lock = threading.Lock()
+
+def is_configured():
+    """認証ファイルとログイン済みのトークンキャッシュがあるか (無いと get_access_token がブラウザでのログインを待つ)"""
+    return os.path.exists(CREDENTIALS_PATH) and os.path.exists(TOKEN_PATH)
+
+def _get_msal_app():
+    """msal のアプリを返す (認証ファイルとトークンキャッシュは初回だけ読み込む)"""
+    global _msal_app
+    if _msal_app is not None:
+        return _msal_app
 
-def get_access_token():
-    """Microsoft Graph APIのアクセストークンを取得する"""
     if not os.path.exists(CREDENTIALS_PATH):
         raise FileNotFoundError(f"認証ファイルが見つかりません: {CREDENTIALS_PATH}")
 
@@ -30,288 +70,517 @@ def get_access_token():
         with open(TOKEN_PATH, 'r') as f:
             cache.deserialize(f.read())
 
-    # 終了時にキャッシュを保存
-    def save_cache():
-        if cache.has_state_changed:
-            with open(TOKEN_PATH, 'w') as f:
-                f.write(cache.serialize())
-    atexit.register(save_cache)
-
-    app = msal.PublicClientApplication(
+    _msal_app = msal.PublicClientApplication(
         client_id,
         authority="https://login.microsoftonline.com/consumers",
         token_cache=cache
     )
+    return _msal_app
 
-    result = None
-    accounts = app.get_accounts()
-    
-    if accounts:
-        # キャッシュからトークン取得を試みる
-        result = app.acquire_token_silent(SCOPES, account=accounts[0])
-
-    if not result:
-        # 初回はブラウザでログイン
-        print("Outlook: ブラウザでログインしてください...")
-        result = app.acquire_token_interactive(scopes=SCOPES)
-
-    if "access_token" in result:
-        return result["access_token"]
-    else:
-        raise Exception(f"トークン取得失敗: {result.get('error_description')}")
+def _save_token_cache(cache):
+    """トークンキャッシュが変わったときだけファイルに書き込む"""
+    if cache.has_state_changed:
+        with open(TOKEN_PATH, 'w') as f:
+            f.write(cache.serialize())
+        cache.has_state_changed = False
 
-def fetch_all_unread_ids():
-    """Outlook上の全未読メールのIDだけを取得する"""
+def get_access_token():
+    """Microsoft Graph APIのアクセストークンを取得する
+
+    トークンはメモリに保持して使い回し、有効期限の REFRESH_AHEAD_SECONDS 秒前から更新する。
+    """
+    with _auth_lock:
+        if _access_token['token'] and time.time() < _access_token['expires_at'] - REFRESH_AHEAD_SECONDS:
+            return _access_token['token']
+
+        app = _get_msal_app()
+        result = None
+        accounts = app.get_accounts()
+
+        if accounts:
+            # キャッシュからトークン取得を試みる (期限が近ければリフレッシュトークンで更新される)
+            result = app.acquire_token_silent(SCOPES, account=accounts[0])
+            if result and "access_token" in result and result.get('expires_in', 0) <= REFRESH_AHEAD_SECONDS:
+                result = app.acquire_token_silent(SCOPES, account=accounts[0], force_refresh=True)
+
+        if not result:
+            # 初回はブラウザでログイン
+            print("Outlook: ブラウザでログインしてください...")
+            result = app.acquire_token_interactive(scopes=SCOPES)
+
+        _save_token_cache(app.token_cache)
+
+        if "access_token" in result:
+            _access_token['token'] = result["access_token"]
+            _access_token['expires_at'] = time.time() + int(result.get('expires_in', 0))
+            return result["access_token"]
+        else:
+            raise Exception(f"トークン取得失敗: {result.get('error_description')}")
+
+def _graph_request(method, url, operation, cost=1, **kwargs):
+    """Graph API をレート制限の範囲で呼び出し、所要時間とエラー(通信エラー・4xx/5xx)を記録する
+
+    cost はこの呼び出しで数えられるリクエスト数 ($batch なら中の件数)。
+    429/503 なら Retry-After (無ければバックオフ) の間待って MAX_BATCH_RETRIES 回まで再送し、
+    それでも駄目ならその応答を返す。レート制限には 2xx だけを成功として伝える。
+    応答が REQUEST_TIMEOUT 以内に来なければ requests.Timeout を出す。
+    """
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    attempt = 0
+    while True:
+        with rate_limit.limit('outlook', cost) as call:
+            with metrics.timer('provider_request_seconds', provider='outlook', operation=operation):
+                response = requests.request(method, url, **kwargs)
+            if response.status_code >= 400:
+                metrics.inc('provider_request_errors', provider='outlook', operation=operation)
+            # 同時数を増やしてよいのは 2xx のときだけ (5xx は失敗、4xx はどちらとも数えない)
+            if response.status_code >= 500:
+                call['succeeded'] = False
+            elif response.status_code >= 300:
+                call['succeeded'] = None
+            if response.status_code not in THROTTLED_STATUSES or attempt >= MAX_BATCH_RETRIES:
+                return response
+            delay = rate_limit.throttled('outlook', _retry_after_seconds(response.headers))
+        attempt += 1
+        print(f"スロットリング(Outlook): {operation} を {delay:.0f} 秒後に再送します")
+
+def iter_unread_id_pages():
+    """Outlookの受信トレイの未読メールのIDを、APIのページ単位(リスト)で順に返す"""
     token = get_access_token()
     headers = {'Authorization': 'Bearer ' + token}
     
-    unread_ids = set()
-    url = f"{GRAPH_API_ENDPOINT}/me/messages"
+    # delta (受信トレイのみ) と同じ範囲にそろえる (/me/messages だと全フォルダーが対象になり、
+    # 全件同期で保存した受信トレイ外のメールを delta が「既読」として消してしまう)
+    url = f"{GRAPH_API_ENDPOINT}/me/mailFolders/inbox/messages"
     
-    # 未読のみ、IDのみ取得
+    # 未読のみ、IDのみを新しい順に取得 (取得待ちから新しいメールを先に取得するため)
+    # $orderby の項目は $filter の先頭にも書く必要がある
     params = {
-        '$filter': 'isRead eq false',
+        '$filter': 'receivedDateTime ge 1900-01-01T00:00:00Z and isRead eq false',
+        '$orderby': 'receivedDateTime desc',
         '$select': 'id',
         '$top': 100
     }
 
     while url:
-        response = requests.get(url, headers=headers, params=params)
+        response = _graph_request('GET', url, 'messages.list', headers=headers, params=params)
         if response.status_code != 200:
-            print(f"API Error: {response.text}")
-            break
+            # 一覧が途中までしか取れないと既読判定を誤るため、例外にして同期を中断する
+            raise Exception(f"API Error: {response.text}")
             
         data = response.json()
-        messages = data.get('value', [])
-        
-        for msg in messages:
-            unread_ids.add(msg['id'])
+        yield [msg['id'] for msg in data.get('value', [])]
         
         # 次のページがある場合
         url = data.get('@odata.nextLink')
         params = None # nextLinkにはパラメータが含まれているため
 
-    return unread_ids
+def _parse_message(msg_id, detail):
+    """Graph APIのメッセージをDB保存用の辞書に変換する"""
+    subject = detail.get('subject', '(件名なし)')
+    sender_info = detail.get('from', {}).get('emailAddress', {})
+    sender = f"{sender_info.get('name', '')} <{sender_info.get('address', '')}>"
+    snippet = detail.get('bodyPreview', '')
+    
+    # 日時パース
+    received_str = detail.get('receivedDateTime')
+    if received_str:
+        received_at = datetime.datetime.fromisoformat(received_str.replace('Z', '+00:00'))
+    else:
+        received_at = datetime.datetime.now()
+
+    # フラグ判定
+    # flag: { "flagStatus": "flagged" } または "notFlagged"
+    flag_status = detail.get('flag', {}).get('flagStatus')
+    status = 2 if flag_status == 'flagged' else 0
+
+    return {
+        'service': 'outlook',
+        'message_id': msg_id,
+        'subject': subject,
+        'sender': sender,
+        'snippet': snippet,
+        'received_at': received_at,
+        'status': status
+    }
 
-def fetch_details_and_save(target_ids):
-    """指定されたIDリストのメール詳細を取得して保存"""
-    if not target_ids:
-        return
+def fetch_details(target_ids):
+    """指定されたIDリストのメール詳細を取得する
+
+    (保存するメールのリスト, 処理済みのIDのリスト, 受信バイト数) を返す (backfill.run 用)。
+    削除済み(404)や既読になっていたメールは保存せずに処理済みとし、
+    それ以外のエラーのメールは次回もう一度取得する。
+    """
+    # 詳細取得 (flag と既読状態も取得項目に追加) を $batch でまとめて行う
+    results = execute_batch({
+        msg_id: ('GET', f"/me/messages/{msg_id}?$select={DELTA_FIELDS}", None) for msg_id in target_ids
+    })
 
-    token = get_access_token()
-    headers = {'Authorization': 'Bearer ' + token}
     email_data_list = []
-    
-    count = 0
+    done_ids = []
+    received_bytes = 0
     for msg_id in target_ids:
-        if count >= 10:
-            print("一度の取得上限(10件)に達したため中断します")
-            break
+        status_code, detail = results.get(msg_id, (None, None))
+        if status_code == 404:
+            print(f"メッセージが見つかりません (ID: {msg_id})")
+            done_ids.append(msg_id)
+            continue
+        if status_code != 200:
+            print(f"エラー(ID: {msg_id}): {status_code}")
+            continue
+        received_bytes += len(json.dumps(detail))
+        if detail.get('isRead'):
+            # 取得待ちの間に既読になった
+            done_ids.append(msg_id)
+            continue
 
         try:
-            # 詳細取得 (flag も取得項目に追加)
-            url = f"{GRAPH_API_ENDPOINT}/me/messages/{msg_id}"
-            params = {'$select': 'subject,from,bodyPreview,receivedDateTime,flag'}
-            
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code == 404:
-                print(f"メッセージが見つかりません (ID: {msg_id})")
-                continue
-                
-            detail = response.json()
+            email_data = _parse_message(msg_id, detail)
+            email_data_list.append(email_data)
+            done_ids.append(msg_id)
             
-            subject = detail.get('subject', '(件名なし)')
-            sender_info = detail.get('from', {}).get('emailAddress', {})
-            sender = f"{sender_info.get('name', '')} <{sender_info.get('address', '')}>"
-            snippet = detail.get('bodyPreview', '')
-            
-            # 日時パース
-            received_str = detail.get('receivedDateTime')
-            if received_str:
-                received_at = datetime.datetime.fromisoformat(received_str.replace('Z', '+00:00'))
-            else:
-                received_at = datetime.datetime.now()
-
-            # フラグ判定
-            # flag: { "flagStatus": "flagged" } または "notFlagged"
-            flag_status = detail.get('flag', {}).get('flagStatus')
-            status = 2 if flag_status == 'flagged' else 0
-
-            email_data_list.append({
-                'service': 'outlook',
-                'message_id': msg_id,
-                'subject': subject,
-                'sender': sender,
-                'snippet': snippet,
-                'received_at': received_at,
-                'status': status
-            })
-            
-            status_str = "★重要" if status == 2 else "未読"
-            print(f"取得(Outlook): {subject[:20]}... [{status_str}]")
-            count += 1
+            status_str = "★重要" if email_data['status'] == 2 else "未読"
+            print(f"取得(Outlook): {email_data['subject'][:20]}... [{status_str}]")
             
         except Exception as e:
             print(f"エラー(ID: {msg_id}): {e}")
 
-    if email_data_list:
-        models.save_emails(email_data_list)
+    return email_data_list, done_ids, received_bytes
+
+def backfill_outlook(budget=None):
+    """取得待ちの新着メールを新しい順に、上限(budget)まで取得して保存する"""
+    return backfill.run('outlook', fetch_details, BATCH_SIZE, budget)
+
+def _retry_after_seconds(headers):
+    """Retry-After ヘッダーから待機秒数を取得する (無ければNone)"""
+    for key, value in (headers or {}).items():
+        if key.lower() == 'retry-after':
+            try:
+                return max(int(value), 1)
+            except ValueError:
+                break
+    return None
+
+def execute_batch(sub_requests):
+    """{キー: (method, url, body)} を $batch でまとめて実行する
+
+    url は GRAPH_API_ENDPOINT からの相対パス (例: /me/messages/{id})。
+    20件ずつ1回のHTTP通信で送り、429/503 になった項目だけを Retry-After 秒待ってから再送する
+    (待つ間は同期・画面の操作を含め、Outlookへのほかのリクエストも止める)。
+    キーごとに (ステータスコード, レスポンス本文) の辞書を返す (通信エラーはステータス None)。
+    """
+    token = get_access_token()
+    headers = {
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': 'application/json'
+    }
+
+    results = {}
+    items = list(sub_requests.items())
+    for i in range(0, len(items), BATCH_SIZE):
+        chunk = dict(items[i:i + BATCH_SIZE])
+        attempt = 0
+        while chunk:
+            # $batch のidは文字列である必要があるため連番を振る
+            id_map = {}
+            batch_requests = []
+            for n, (key, (method, url, body)) in enumerate(chunk.items()):
+                id_map[str(n)] = key
+                req = {'id': str(n), 'method': method, 'url': url}
+                if body is not None:
+                    req['body'] = body
+                    req['headers'] = {'Content-Type': 'application/json'}
+                batch_requests.append(req)
+
+            try:
+                response = _graph_request(
+                    'POST', f"{GRAPH_API_ENDPOINT}/$batch", 'batch', cost=len(batch_requests),
+                    headers=headers, json={'requests': batch_requests}
+                )
+            except Exception as e:
+                print(f"バッチ通信エラー(Outlook): {e}")
+                for key in chunk:
+                    results[key] = (None, None)
+                break
+
+            # バッチ全体のスロットリングは _graph_request が再送済み
+            if response.status_code != 200:
+                print(f"バッチエラー(Outlook): {response.status_code} {response.text}")
+                for key in chunk:
+                    results[key] = (response.status_code, None)
+                break
+
+            # 項目ごとのステータスを確認し、スロットリングされたものだけ再送する
+            throttled = {}
+            retry_after = None
+            for r in response.json().get('responses', []):
+                key = id_map[r['id']]
+                if r.get('status') in THROTTLED_STATUSES and attempt < MAX_BATCH_RETRIES:
+                    throttled[key] = chunk[key]
+                    item_retry_after = _retry_after_seconds(r.get('headers'))
+                    if item_retry_after is not None:
+                        retry_after = max(retry_after or 0, item_retry_after)
+                else:
+                    results[key] = (r.get('status'), r.get('body'))
+                    if r.get('status', 0) >= 400:
+                        metrics.inc('provider_request_errors', provider='outlook', operation='batch.item')
+
+            chunk = throttled
+            if chunk:
+                # 次の送信は、レート制限の待機が終わるまで待たされる
+                attempt += 1
+                delay = rate_limit.throttled('outlook', retry_after)
+                print(f"スロットリング(Outlook): {len(chunk)} 件を {delay:.0f} 秒後に再送します")
+
+    return results
+
+def _bulk_action(message_ids, method, body, label, ok_statuses=(200, 204)):
+    """複数メールに同じ操作を $batch でまとめて行い、成功したIDのリストを返す
+
+    ok_statuses: 成功として扱うステータスコード
+    """
+    results = execute_batch({
+        msg_id: (method, f"/me/messages/{msg_id}", body) for msg_id in message_ids
+    })
+    succeeded = []
+    for msg_id, (status, resp_body) in results.items():
+        if status in ok_statuses:
+            succeeded.append(msg_id)
+        else:
+            print(f"Outlook{label}失敗: {msg_id} {status} {resp_body}")
+    if succeeded:
+        print(f"Outlook{label}成功: {len(succeeded)} 件")
+    return succeeded
+
+def mark_as_read_bulk(message_ids):
+    """Outlookの複数メールをまとめて既読にする"""
+    return _bulk_action(message_ids, 'PATCH', {'isRead': True}, '既読化')
+
+def mark_as_important_bulk(message_ids):
+    """Outlookの複数メールにまとめてフラグを立てる"""
+    return _bulk_action(message_ids, 'PATCH', {'flag': {'flagStatus': 'flagged'}}, '重要設定(フラグ)')
+
+def mark_as_unimportant_bulk(message_ids):
+    """Outlookの複数メールからまとめてフラグを外す"""
+    return _bulk_action(message_ids, 'PATCH', {'flag': {'flagStatus': 'notFlagged'}}, '重要解除(フラグ削除)')
+
+def delete_email_bulk(message_ids):
+    """Outlookの複数メールをまとめて削除する (削除済み(404)のものも成功として返す)"""
+    return _bulk_action(message_ids, 'DELETE', None, '削除', ok_statuses=(200, 204, 404))
 
 def update_flagged_status(local_ids):
-    """DBにあるメールのフラグ状態をOutlookと同期する"""
+    """DBにあるメールのフラグ状態をOutlookと同期する
+
+    確認できたメールだけを反映し、確認できなかったメール (削除済みを除く) があれば
+    例外を出す (同期を失敗として扱い、次回もう一度確認する)。
+    """
     if not local_ids:
         return
 
-    token = get_access_token()
-    headers = {'Authorization': 'Bearer ' + token}
-    
     print(f"既存メール({len(local_ids)}件)のステータスを確認中(Outlook)...")
 
-    # Outlookはバッチ取得も可能ですが、実装を簡単にするためループ処理します
-    for msg_id in local_ids:
-        try:
-            url = f"{GRAPH_API_ENDPOINT}/me/messages/{msg_id}"
-            params = {'$select': 'flag'} # フラグ情報だけ取得
-            
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code == 200:
-                data = response.json()
-                flag_status = data.get('flag', {}).get('flagStatus')
-                new_status = 2 if flag_status == 'flagged' else 0
-                
-                models.update_email_status_by_message_id(msg_id, new_status)
-            elif response.status_code == 404:
-                pass # 削除済み
-        except Exception as e:
-            print(f"ステータス確認エラー(Outlook): {e}")
-
-def sync_outlook():
-    """OutlookとDBを同期する"""
+    # フラグ情報だけを $batch でまとめて取得
+    results = execute_batch({
+        msg_id: ('GET', f"/me/messages/{msg_id}?$select=flag", None) for msg_id in local_ids
+    })
+
+    status_map = {}
+    failed = 0
+    for msg_id, (status, body) in results.items():
+        if status == 200:
+            flag_status = (body or {}).get('flag', {}).get('flagStatus')
+            status_map[msg_id] = 2 if flag_status == 'flagged' else 0
+        elif status == 404:
+            pass # 削除済み
+        else:
+            failed += 1
+            print(f"ステータス確認エラー(Outlook): {msg_id} {status}")
+
+    # 変わったものだけを1回のトランザクションでまとめて更新
+    models.apply_status_map(status_map)
+    if failed:
+        raise Exception(f"Outlookのステータス確認に {failed} 件失敗しました")
+
+def sync_outlook(full=False, budget=None):
+    """OutlookとDBを同期する
+
+    受信トレイの delta クエリで前回からの変更だけを同期する。
+    deltaLink が失効していれば delta を最初からやり直し、
+    delta が使えない場合や full=True の場合は従来の全件同期を行う。
+    delta で届いた新着と、全件同期で見つけて取得待ちに入れた新着は、合わせて
+    budget (backfill.make_budget) の範囲で保存する。超えた分は取得待ちに残して次回取得する。
+    成功したらTrueを返す。
+    """
     print("Outlookの同期を開始します...")
-    
-    # 1. サーバーにある未読ID
-    try:
-        server_unread_ids = fetch_all_unread_ids()
-    except Exception as e:
-        print(f"Outlookへの接続に失敗しました: {e}")
-        return
-
-    # 2. DBにあるOutlookのID
-    if hasattr(models, 'get_message_ids_by_service'):
-        local_stored_ids = models.get_message_ids_by_service('outlook')
+    if budget is None:
+        budget = backfill.make_budget()
+    if full:
+        synced = sync_outlook_full()
     else:
-        local_stored_ids = models.get_all_message_ids()
-
-    # 3. 差分計算
-    new_ids = server_unread_ids - local_stored_ids
-    read_ids = local_stored_ids - server_unread_ids
-    existing_ids = server_unread_ids & local_stored_ids
-    
-    # 4. DB更新
-    if read_ids:
-        print(f"既読検知(Outlook): {len(read_ids)} 件 -> DBから削除します")
-        models.delete_emails(read_ids)
-    
-    if new_ids:
-        print(f"新着検知(Outlook): {len(new_ids)} 件 -> 詳細を取得して保存します")
-        fetch_details_and_save(new_ids)
-        
-    # 5. 既存メールのフラグ状態を同期
-    if existing_ids:
-        update_flagged_status(existing_ids)
-
-def mark_as_read(message_id):
-    """Outlookのメールを既読にする"""
-    token = get_access_token()
-    headers = {
-        'Authorization': 'Bearer ' + token,
-        'Content-Type': 'application/json'
-    }
-    
-    url = f"{GRAPH_API_ENDPOINT}/me/messages/{message_id}"
-    data = {'isRead': True}
+        synced = _sync_outlook_delta_or_full(budget)
+    if not synced:
+        return False
 
+    # 全件同期で見つかった新着の詳細を、前回の残りも含めて新しい順に取得する
     try:
-        response = requests.patch(url, headers=headers, json=data)
-        if response.status_code == 200:
-            print(f"Outlook既読化成功: {message_id}")
-            return True
-        else:
-            print(f"Outlook既読化失敗: {response.status_code} {response.text}")
-            return False
+        backfill_outlook(budget)
     except Exception as e:
-        print(f"Outlook既読化エラー: {e}")
+        print(f"Outlookの新着取得に失敗しました: {e}")
         return False
-    
-def mark_as_important(message_id):
-    """Outlookのメールにフラグを立てる"""
-    token = get_access_token()
-    headers = {
-        'Authorization': 'Bearer ' + token,
-        'Content-Type': 'application/json'
-    }
-    
-    url = f"{GRAPH_API_ENDPOINT}/me/messages/{message_id}"
-    data = {'flag': {'flagStatus': 'flagged'}}
+    return True
 
+def _sync_outlook_delta_or_full(budget):
+    """delta で同期し、使えなければ全件同期する (成功したらTrue)"""
+    delta_link = models.get_sync_state(DELTA_STATE_KEY)
     try:
-        response = requests.patch(url, headers=headers, json=data)
-        if response.status_code == 200:
-            print(f"Outlook重要設定(フラグ)成功: {message_id}")
-            return True
-        else:
-            print(f"Outlook重要設定失敗: {response.status_code} {response.text}")
-            return False
+        try:
+            sync_outlook_delta(delta_link, budget)
+        except requests.HTTPError as e:
+            if delta_link and e.response is not None and e.response.status_code == 410:
+                # deltaLink の期限切れ: 最初から delta をやり直す
+                print("Outlookの差分トークンが期限切れのため、最初から取得し直します")
+                models.set_sync_state(DELTA_STATE_KEY, None)
+                sync_outlook_delta(None, budget)
+            else:
+                raise
     except Exception as e:
-        print(f"Outlook重要設定エラー: {e}")
-        return False
+        print(f"Outlookの差分同期に失敗しました: {e} -> 全件同期に切り替えます")
+        return sync_outlook_full()
+    return True
 
-def mark_as_unimportant(message_id):
-    """Outlookのメールからフラグを外す"""
+def iter_delta_pages(url):
+    """delta クエリの結果をページごとに (メッセージのリスト, deltaLink, 受信バイト数) で返す"""
     token = get_access_token()
     headers = {
         'Authorization': 'Bearer ' + token,
-        'Content-Type': 'application/json'
+        'Prefer': f'odata.maxpagesize={DELTA_PAGE_SIZE}'
     }
-    
-    url = f"{GRAPH_API_ENDPOINT}/me/messages/{message_id}"
-    # フラグを外すには flagStatus: 'notFlagged'
-    data = {'flag': {'flagStatus': 'notFlagged'}}
+    # 初回だけ取得項目を指定する (nextLink/deltaLinkには含まれている)
+    params = None
+    if url is None:
+        url = f"{GRAPH_API_ENDPOINT}/me/mailFolders/inbox/messages/delta"
+        params = {'$select': DELTA_FIELDS}
 
-    try:
-        response = requests.patch(url, headers=headers, json=data)
-        if response.status_code == 200:
-            print(f"Outlook重要解除(フラグ削除)成功: {message_id}")
-            return True
+    while url:
+        response = _graph_request('GET', url, 'messages.delta', headers=headers, params=params)
+        response.raise_for_status()
+        data = response.json()
+        yield data.get('value', []), data.get('@odata.deltaLink'), len(response.content)
+
+        url = data.get('@odata.nextLink')
+        params = None
+
+def _apply_delta_page(items, budget):
+    """delta の1ページ分の変更をDBに反映し、このページ内の未読IDのリストを返す
+
+    新着は budget の範囲で保存し、使い切った後の新着は取得待ちに入れる。
+    """
+    ids = [item['id'] for item in items]
+    local_ids = models.get_existing_message_ids(ids)
+    # 反映待ちの操作があるメールはサーバー側がまだ古いので触らない
+    pending_ids = models.get_pending_message_ids(ids)
+
+    unread_ids = []
+    read_ids = []
+    status_map = {}
+    email_data_list = []
+    deferred_ids = []
+    for item in items:
+        msg_id = item['id']
+        removed = '@removed' in item
+        if not removed and not item.get('isRead', False):
+            unread_ids.append(msg_id)
+        if msg_id in pending_ids:
+            continue
+
+        if removed or item.get('isRead', False):
+            if msg_id in local_ids:
+                read_ids.append(msg_id)
+        elif msg_id in local_ids:
+            if 'flag' in item:
+                flag_status = item['flag'].get('flagStatus')
+                status_map[msg_id] = 2 if flag_status == 'flagged' else 0
+        elif backfill.is_exhausted(budget):
+            deferred_ids.append(msg_id)
         else:
-            print(f"Outlook重要解除失敗: {response.status_code} {response.text}")
-            return False
-    except Exception as e:
-        print(f"Outlook重要解除エラー: {e}")
-        return False
+            # delta に必要な項目が含まれているので、詳細を取り直さずに保存できる
+            budget['messages'] -= 1
+            email_data = _parse_message(msg_id, item)
+            email_data_list.append(email_data)
+            status_str = "★重要" if email_data['status'] == 2 else "未読"
+            print(f"取得(Outlook): {email_data['subject'][:20]}... [{status_str}]")
 
-if __name__ == '__main__':
-    models.init_db()
-    sync_outlook()
+    if read_ids:
+        print(f"既読検知(Outlook): {len(read_ids)} 件 -> DBから削除します")
+        models.delete_emails(read_ids)
+    models.apply_status_map(status_map)
+    if email_data_list:
+        models.save_emails(email_data_list)
+        metrics.inc('messages_fetched', len(email_data_list), provider='outlook')
+    if deferred_ids:
+        print(f"新着検知(Outlook): {len(deferred_ids)} 件 -> 取得の上限を超えたため取得待ちに追加します")
+        models.enqueue_backfill('outlook', deferred_ids)
+    return unread_ids
 
-def delete_email(message_id):
-    """Outlookのメールを削除する"""
-    token = get_access_token()
-    headers = {
-        'Authorization': 'Bearer ' + token
-    }
-    
-    url = f"{GRAPH_API_ENDPOINT}/me/messages/{message_id}"
+def sync_outlook_delta(delta_link, budget=None):
+    """受信トレイの delta クエリで変更を1回のストリームで反映する
+
+    delta_link が None の場合は受信トレイ全体を列挙する初回の delta になるので、
+    列挙された未読IDを一時テーブルに書き込み、DBにだけ残っているメールも削除する。
+    受信したページは budget (backfill.make_budget) から差し引く。
+    """
+    if budget is None:
+        budget = backfill.make_budget()
+    state = {}
+
+    def unread_pages():
+        pages = metrics.timed_iter(iter_delta_pages(delta_link), 'sync_phase_seconds', provider='outlook', phase='list')
+        for items, next_delta_link, page_bytes in pages:
+            if next_delta_link:
+                state['delta_link'] = next_delta_link
+            with metrics.timer('sync_phase_seconds', provider='outlook', phase='diff'):
+                unread_ids = _apply_delta_page(items, budget)
+            budget['bytes'] -= page_bytes
+            metrics.inc('bytes_received', page_bytes, provider='outlook')
+            yield unread_ids
+
+    if delta_link is None:
+        with models.staged_server_ids('outlook', unread_pages()):
+            with metrics.timer('sync_phase_seconds', provider='outlook', phase='diff'):
+                for read_ids in models.iter_diff_ids('outlook', 'gone'):
+                    print(f"既読検知(Outlook): {len(read_ids)} 件 -> DBから削除します")
+                    models.delete_emails(read_ids)
+    else:
+        for _ in unread_pages():
+            pass
+
+    if 'delta_link' in state:
+        models.set_sync_state(DELTA_STATE_KEY, state['delta_link'])
 
+def sync_outlook_full():
+    """Outlookの全未読メールとDBを突き合わせて同期する (成功したらTrue)"""
+    # 1. サーバーにある未読IDをページごとにDBの一時テーブルへ書き込む
     try:
-        # Outlook APIでは削除成功時に204 No Contentが返ることが多い
-        response = requests.delete(url, headers=headers)
-        if response.status_code == 204 or response.status_code == 200:
-            print(f"Outlook削除成功: {message_id}")
-            return True
-        else:
-            print(f"Outlook削除失敗: {response.status_code} {response.text}")
-            return False
+        pages = metrics.timed_iter(iter_unread_id_pages(), 'sync_phase_seconds', provider='outlook', phase='list')
+        with models.staged_server_ids('outlook', pages):
+            # 2. 既読になったメール (DBにだけあるID) を削除
+            with metrics.timer('sync_phase_seconds', provider='outlook', phase='diff'):
+                for read_ids in models.iter_diff_ids('outlook', 'gone'):
+                    print(f"既読検知(Outlook): {len(read_ids)} 件 -> DBから削除します")
+                    models.delete_emails(read_ids)
+
+            # 3. 既存メールのフラグ状態を同期 (新着を保存する前に対象を確定させる)
+            with metrics.timer('sync_phase_seconds', provider='outlook', phase='reconcile_flags'):
+                for existing_ids in models.iter_diff_ids('outlook', 'existing'):
+                    update_flagged_status(existing_ids)
+
+            # 4. 新着メールを取得待ちに入れる (一覧は新しい順なので、その順番で取得される)
+            with metrics.timer('sync_phase_seconds', provider='outlook', phase='enqueue_new'):
+                new_count = models.count_diff_ids('outlook', 'new')
+                if new_count:
+                    print(f"新着検知(Outlook): {new_count} 件 -> 取得待ちに追加します")
+                models.enqueue_backfill_from_staging('outlook')
     except Exception as e:
-        print(f"Outlook削除エラー: {e}")
+        print(f"Outlookの同期に失敗しました: {e}")
         return False
+    return True
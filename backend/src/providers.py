@@ -0,0 +1,83 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import gmail_fetcher
+import imap_fetcher
+import outlook_fetcher
+
+# サーバーに反映できる操作
+ACTIONS = ('read', 'star', 'unstar', 'delete')
+
+# 一括操作を同時に送るグループ(アカウントと操作の組)の数
+MAX_PARALLEL_GROUPS = 4
+
+def _ignore_service(func):
+    """アカウントが1つだけのサービスの関数を (service名, message_idのリスト) の形にそろえる"""
+    return lambda service, message_ids: func(message_ids)
+
+# サービスの種類 -> 操作ごとの一括処理関数
+# 関数は (service名, message_idのリスト) を受け取り、サーバーへの反映に成功したmessage_idのリストを返す
+PROVIDERS = {
+    'gmail': {
+        'read': _ignore_service(gmail_fetcher.mark_as_read_bulk),
+        'star': _ignore_service(gmail_fetcher.mark_as_important_bulk),
+        'unstar': _ignore_service(gmail_fetcher.mark_as_unimportant_bulk),
+        'delete': _ignore_service(gmail_fetcher.delete_email_bulk),
+    },
+    'outlook': {
+        'read': _ignore_service(outlook_fetcher.mark_as_read_bulk),
+        'star': _ignore_service(outlook_fetcher.mark_as_important_bulk),
+        'unstar': _ignore_service(outlook_fetcher.mark_as_unimportant_bulk),
+        'delete': _ignore_service(outlook_fetcher.delete_email_bulk),
+    },
+    'imap': {
+        'read': imap_fetcher.mark_as_read_bulk,
+        'star': imap_fetcher.mark_as_important_bulk,
+        'unstar': imap_fetcher.mark_as_unimportant_bulk,
+        'delete': imap_fetcher.delete_email_bulk,
+    },
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def provider_name(service):
+    """DBの service 列 ('gmail', 'outlook', 'imap:user@example.com') からサービスの種類を求める"""
+    if service.startswith('imap:'):
+        return 'imap'
+    return service if service in PROVIDERS else None
+
+def is_supported(service):
+    """サーバー連携に対応しているサービスか"""
+    return provider_name(service) is not None
+
+def run_bulk(service, action, message_ids):
+    """1つのアカウントの複数メールに同じ操作をまとめて反映し、成功したmessage_idのリストを返す"""
+    handlers = PROVIDERS[provider_name(service)]
+    return handlers[action](service, list(message_ids))
+
+def _get_executor():
+    """一括操作を並列に送るスレッドプールを返す (スレッドを使い回して認証クライアントのキャッシュを生かす)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_GROUPS, thread_name_prefix='provider')
+        return _executor
+
+def run_bulk_groups(groups):
+    """[(service, action, message_ids), ...] をグループごとに並列に反映する
+
+    グループごとに (成功したmessage_idのセット, エラー) を入力と同じ順番のリストで返す。
+    """
+    def run(group):
+        service, action, message_ids = group
+        try:
+            return set(run_bulk(service, action, message_ids)), None
+        except Exception as e:
+            traceback.print_exc()
+            return set(), e
+
+    if len(groups) == 1:
+        return [run(groups[0])]
+    return list(_get_executor().map(run, groups))
@@ -0,0 +1,149 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# 既定の設定 (サービスごとの値は各fetcherが configure で設定する)
+DEFAULT_RATE = 10.0           # 1秒あたりに補充するコスト
+DEFAULT_MAX_CONCURRENCY = 4   # 同時に送るリクエスト数の上限
+INITIAL_CONCURRENCY = 2       # 同時に送るリクエスト数の初期値 (成功が続くと上限まで増やす)
+RAMP_UP_SUCCESSES = 10        # 連続でこの回数成功したら同時数を1つ増やす
+BASE_BACKOFF = 1.0            # Retry-After が無いときの1回目の待機秒数 (スロットリングが続くと2倍)
+MAX_BACKOFF = 60.0            # 待機秒数の上限
+
+# アカウント -> 制限の状態
+# 同期・画面の操作・送信キューのどのスレッドからの呼び出しも、同じアカウントなら同じ制限を共有する
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def configure(account, rate=DEFAULT_RATE, capacity=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """アカウントの制限を設定する
+
+    rate: 1秒あたりに使えるコスト (Gmail なら quota units、Graph ならリクエスト数)
+    capacity: まとめて使えるコストの上限 (バケットの大きさ。省略時は rate と同じ=1秒分)
+    max_concurrency: 同時に送るリクエスト数の上限
+    """
+    with _limiters_lock:
+        _limiters[account] = _new_limiter(rate, capacity, max_concurrency)
+
+def _new_limiter(rate=DEFAULT_RATE, capacity=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    capacity = rate if capacity is None else capacity
+    return {
+        'rate': float(rate),
+        'capacity': float(capacity),
+        'tokens': float(capacity),
+        'updated': time.monotonic(),
+        'max_concurrency': max_concurrency,
+        'concurrency': min(INITIAL_CONCURRENCY, max_concurrency),
+        'in_flight': 0,
+        'successes': 0,          # 連続で成功した回数
+        'throttles': 0,          # 連続でスロットリングされた回数 (待機秒数の計算用)
+        'blocked_until': 0.0,    # この時刻まで新しいリクエストを送らない
+        'throttled_at': 0.0,     # 最後にスロットリングされた時刻
+        'condition': threading.Condition(),
+    }
+
+def _get(account):
+    """アカウントの制限を返す (configure されていなければ既定の設定で作る)"""
+    with _limiters_lock:
+        limiter = _limiters.get(account)
+        if limiter is None:
+            limiter = _limiters[account] = _new_limiter()
+        return limiter
+
+def _refill(limiter, now):
+    elapsed = now - limiter['updated']
+    limiter['tokens'] = min(limiter['capacity'], limiter['tokens'] + elapsed * limiter['rate'])
+    limiter['updated'] = now
+
+def _acquire(account, limiter, cost):
+    """同時数の空きとコスト分のトークンができるまで待ち、1つ分の枠を取る"""
+    started = time.monotonic()
+    condition = limiter['condition']
+    with condition:
+        while True:
+            now = time.monotonic()
+            if limiter['in_flight'] >= limiter['concurrency']:
+                condition.wait()  # ほかの呼び出しが終わるまで
+                continue
+            wait = limiter['blocked_until'] - now
+            if wait <= 0:
+                _refill(limiter, now)
+                # バケットより大きいコストは満タンになるまで待ってから借りる (トークンが負になる)
+                need = min(cost, limiter['capacity'])
+                if limiter['tokens'] >= need:
+                    limiter['tokens'] -= cost
+                    limiter['in_flight'] += 1
+                    break
+                wait = (need - limiter['tokens']) / limiter['rate']
+            condition.wait(wait)
+    waited = time.monotonic() - started
+    if waited > 0.001:
+        metrics.observe('rate_limit_wait_seconds', waited, account=account)
+    return started
+
+def _release(limiter, started, succeeded):
+    """枠を返す (成功が続いていれば同時数を増やす)
+
+    succeeded: True=成功、False=失敗 (連続成功の回数を0に戻す)、None=どちらとも数えない
+    """
+    condition = limiter['condition']
+    with condition:
+        limiter['in_flight'] -= 1
+        if succeeded is False:
+            limiter['successes'] = 0
+        # 実行中にスロットリングされていたら、成功しても増やさない
+        elif succeeded and limiter['throttled_at'] < started:
+            limiter['throttles'] = 0
+            limiter['successes'] += 1
+            if limiter['successes'] >= RAMP_UP_SUCCESSES and limiter['concurrency'] < limiter['max_concurrency']:
+                limiter['concurrency'] += 1
+                limiter['successes'] = 0
+        condition.notify_all()
+
+@contextmanager
+def limit(account, cost=1):
+    """アカウントの制限の範囲でリクエストを1回送る (with の中で送る)
+
+    cost はこのリクエストで消費する量 (Gmail のバッチなら中の全リクエストの quota units の合計)。
+    スロットリングされたら with の中で throttled() を呼ぶ。
+    with が返す辞書の 'succeeded' に結果を入れられる (既定は True、例外で抜けたら False)。
+    サーバーエラーなら False、成功とも失敗とも数えない応答 (4xx など) なら None にする。
+    """
+    limiter = _get(account)
+    started = _acquire(account, limiter, cost)
+    call = {'succeeded': True}
+    try:
+        yield call
+    except BaseException:
+        if call['succeeded']:
+            call['succeeded'] = False
+        raise
+    finally:
+        _release(limiter, started, call['succeeded'])
+
+def backoff_seconds(attempts):
+    """Retry-After が無いときの待機秒数 (指数バックオフ、同時に再送しないよう揺らす)"""
+    delay = min(BASE_BACKOFF * (2 ** attempts), MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1.0)
+
+def throttled(account, retry_after=None):
+    """スロットリング (429 など) されたことを記録し、待機する秒数を返す
+
+    retry_after (秒) の間、またはバックオフの間はこのアカウントへの新しいリクエストを止め、
+    同時数を半分にする。同じ待機中に何件報告されても半分にするのは1回だけ。
+    """
+    limiter = _get(account)
+    with limiter['condition']:
+        now = time.monotonic()
+        delay = retry_after if retry_after is not None else backoff_seconds(limiter['throttles'])
+        if now >= limiter['blocked_until']:
+            limiter['concurrency'] = max(1, limiter['concurrency'] // 2)
+            limiter['throttles'] += 1
+        limiter['blocked_until'] = max(limiter['blocked_until'], now + delay)
+        limiter['throttled_at'] = now
+        limiter['successes'] = 0
+    metrics.inc('rate_limit_throttled', account=account)
+    return delay
@@ -0,0 +1,223 @@
+import random
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import models
+import metrics
+import backfill
+import gmail_fetcher
+import imap_fetcher
+import outlook_fetcher
+
+# 設定 (秒)
+# IMAPは IDLE で新着を受け取るので、定期同期は取りこぼし対策として長めにする
+BASE_INTERVALS = {
+    'gmail': 120,
+    'outlook': 120,
+    'imap': 600,
+}
+MIN_INTERVAL = 30          # 新着が続いてもこれより短くしない
+MAX_INTERVAL = 1800        # 変化なし・エラーが続いてもこれより長くしない
+SHRINK_FACTOR = 0.5        # 新着があったときの間隔の倍率
+GROW_FACTOR = 1.5          # 変化がなかったときの間隔の倍率
+JITTER_RATIO = 0.1         # 間隔を±この割合でずらし、同期が同じ時刻に重ならないようにする
+STARTUP_DELAY = 5          # 起動直後の最初の同期までの秒数
+
+# 1回の同期で新着の詳細を取得する量の上限 (backfill.make_budget の引数。IMAPはアカウントごと)
+# 使い切った分は取得待ちに残り、次回の同期で続きから取得する
+BACKFILL_LIMITS = {
+    'max_messages': backfill.DEFAULT_MAX_MESSAGES,
+    'max_bytes': backfill.DEFAULT_MAX_BYTES,
+    'max_seconds': backfill.DEFAULT_MAX_SECONDS,
+}
+
+_states = {}  # provider -> 状態の辞書
+_events = {}  # provider -> 同期要求を知らせる Event
+_stop_event = threading.Event()
+_threads = {}
+_lock = threading.Lock()
+
+def _sync_gmail():
+    return gmail_fetcher.sync_gmail(budget=backfill.make_budget(**BACKFILL_LIMITS))
+
+def _sync_outlook():
+    return outlook_fetcher.sync_outlook(budget=backfill.make_budget(**BACKFILL_LIMITS))
+
+def _sync_imap():
+    """全IMAPアカウントを同期し、1つでも成功すればTrueを返す"""
+    report = imap_fetcher.sync_imap_all(BACKFILL_LIMITS)
+    if not report:
+        return False
+    return report['failed'] == 0 or report['ok'] + report['partial'] > 0
+
+PROVIDERS = {
+    'gmail': _sync_gmail,
+    'outlook': _sync_outlook,
+    'imap': _sync_imap,
+}
+
+# サービス -> 認証情報・トークンのファイルがあるかを返す関数
+# 無いサービスを同期すると対話的なログインを待って止まるので、定期同期しない (状態は disabled)
+CONFIGURED = {
+    'gmail': gmail_fetcher.is_configured,
+    'outlook': outlook_fetcher.is_configured,
+    'imap': imap_fetcher.is_configured,
+}
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+def _with_jitter(interval):
+    """間隔にランダムな揺らぎを加える"""
+    return interval * random.uniform(1 - JITTER_RATIO, 1 + JITTER_RATIO)
+
+def _next_interval(provider, state, outcome):
+    """同期結果から次回までの間隔を求める
+
+    新着があれば短く、変化がなければ少しずつ長く、エラーなら失敗回数に応じて指数的に長くする。
+    """
+    if outcome == 'new_mail':
+        interval = state['interval'] * SHRINK_FACTOR
+    elif outcome == 'no_change':
+        interval = state['interval'] * GROW_FACTOR
+    else:
+        interval = BASE_INTERVALS[provider] * (2 ** state['consecutive_errors'])
+    return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+def _run_once(provider):
+    """1つのサービスを同期して状態を更新する"""
+    state = _states[provider]
+    with _lock:
+        state.update(running=True, queued=False, started_at=_now())
+    started = time.monotonic()
+
+    before = models.get_latest_email_id()
+    try:
+        success = PROVIDERS[provider]()
+        error = None if success is not False else 'sync failed'
+    except Exception as e:
+        traceback.print_exc()
+        error = str(e)
+    finally:
+        after = models.get_latest_email_id()
+        models.release_connection()
+
+    if error:
+        outcome = 'error'
+    elif after != before:
+        outcome = 'new_mail'
+    else:
+        outcome = 'no_change'
+    duration = time.monotonic() - started
+    metrics.observe('sync_seconds', duration, provider=provider)
+    metrics.inc('sync_runs', provider=provider, outcome=outcome)
+    # IDは AUTOINCREMENT なので、最新IDの差が今回保存した件数になる
+    metrics.observe('sync_new_messages', max(after - before, 0), provider=provider)
+
+    with _lock:
+        state['consecutive_errors'] = state['consecutive_errors'] + 1 if error else 0
+        state['interval'] = _next_interval(provider, state, outcome)
+        state.update(
+            running=False,
+            finished_at=_now(),
+            duration=round(duration, 2),
+            outcome=outcome,
+            error=error,
+            runs=state['runs'] + 1,
+        )
+        delay = _with_jitter(state['interval'])
+        # 同期中に要求があった場合は、すぐにもう一度同期する
+        if not state['queued']:
+            state['next_run'] = time.monotonic() + delay
+    print(f"[scheduler] {provider}: {outcome} -> 次回まで {state['interval']:.0f}秒")
+
+def _loop(provider):
+    """サービスごとのスケジューラースレッドの本体"""
+    state = _states[provider]
+    event = _events[provider]
+    while not _stop_event.is_set():
+        with _lock:
+            wait = state['next_run'] - time.monotonic()
+        if wait > 0:
+            event.wait(wait)
+            event.clear()
+            continue
+        if _stop_event.is_set():
+            break
+        try:
+            _run_once(provider)
+        except Exception:
+            traceback.print_exc()
+
+def start():
+    """サービスごとの定期同期スレッドを起動する (2回目以降の呼び出しは何もしない)
+
+    認証情報の無いサービスは起動せず disabled にする (呼び出すたびに確認し直す)。
+    """
+    with _lock:
+        _stop_event.clear()
+        for provider in PROVIDERS:
+            thread = _threads.get(provider)
+            if thread is not None and thread.is_alive():
+                continue
+            if provider not in _states:
+                _states[provider] = {
+                    'interval': BASE_INTERVALS[provider],
+                    'next_run': time.monotonic() + _with_jitter(STARTUP_DELAY),
+                    'running': False,
+                    'queued': False,
+                    'started_at': None,
+                    'finished_at': None,
+                    'duration': None,
+                    'outcome': None,
+                    'error': None,
+                    'runs': 0,
+                    'consecutive_errors': 0,
+                    'disabled': None,
+                }
+                _events[provider] = threading.Event()
+            state = _states[provider]
+            if not CONFIGURED[provider]():
+                if not state['disabled']:
+                    print(f"[scheduler] {provider}: 認証情報が無いため定期同期しません")
+                state['disabled'] = True
+                continue
+            state['disabled'] = False
+            thread = threading.Thread(target=_loop, args=(provider,), name=f'sync-{provider}', daemon=True)
+            _threads[provider] = thread
+            thread.start()
+
+def stop():
+    """定期同期スレッドを停止する (実行中の同期は最後まで行われる)"""
+    _stop_event.set()
+    for event in _events.values():
+        event.set()
+
+def request_sync(provider):
+    """指定したサービスの同期をすぐに実行するよう予約し、現在の状態を返す (disabled なら予約しない)"""
+    if provider not in PROVIDERS:
+        raise KeyError(provider)
+    start()
+    with _lock:
+        state = _states[provider]
+        disabled = state['disabled']
+        if not disabled:
+            state['queued'] = True
+            state['next_run'] = time.monotonic()
+    if not disabled:
+        _events[provider].set()
+    return get_status()[provider]
+
+def get_status():
+    """各サービスの同期状況を返す (認証情報が無く定期同期していないサービスは disabled が True)"""
+    now = time.monotonic()
+    status = {}
+    with _lock:
+        for provider, state in _states.items():
+            status[provider] = {
+                key: value for key, value in state.items() if key != 'next_run'
+            }
+            status[provider]['next_run_in'] = None if state['disabled'] else max(0, round(state['next_run'] - now))
+    return status